@@ -1,13 +1,18 @@
 """
 Global default values
 """
+import logging
 import os
+
 import dotenv
-import logging
 
 #not configurable defaults
 UNIVERSAL_FUNC_NAME = "_F" 
-KNOWN_CALCULATION_METHODS = ["jaccard_distance", "jaccard_distance_w", "all"]
+KNOWN_CALCULATION_METHODS = ["jaccard_distance", "jaccard_distance_w", "jaccard_distance_opt", "jaccard_distance_w_opt", "all"]
+# methods with this suffix pair the functions with an optimal assignment instead of greedily
+OPTIMAL_CALCULATION_METHOD_SUFFIX = "_opt"
+# methods of the one to many ranking
+RANKING_CALCULATION_METHODS = ["jaccard_distance", "jaccard_distance_w", "jaccard_distance_opt", "jaccard_distance_w_opt"]
 VALID_OUTPUT_DETAILS = ["simple", "complete"]
 
 logger = logging.getLogger("cg.defaults")
@@ -47,3 +52,58 @@ FILE_COMPARE_FUNC_MATCH_SIM_THRESHOLD = float(os.environ.get( "FILE_COMPARE_FUNC
 # for the same function names, greater than or equal to this threshold will be considered as a mismatch `!`,
 # smaller wil be considered delete `-`
 FILE_COMPARE_FUNC_MISMATCH_SIM_THRESHOLD = float(os.environ.get("FILE_COMPARE_FUNC_MISMATCH_SIM_THRESHOLD",0.80))
+
+# number of nearest candidate functions considered per function by the `*_opt` compare methods
+FILE_COMPARE_ASSIGN_KNN = int(os.environ.get("FILE_COMPARE_ASSIGN_KNN", 16))
+
+# candidate genes scored at once by the one to many file compare
+FILE_COMPARE_BATCH_GENES = int(os.environ.get("FILE_COMPARE_BATCH_GENES", 8192))
+
+# the one to many file compare rescores this many times `top_k` best candidates with the pairwise compare
+FILE_COMPARE_RESCORE_FACTOR = int(os.environ.get("FILE_COMPARE_RESCORE_FACTOR", 4))
+
+# number of processes used for reading .gene files in `GenomeKG.load`. 0: number of CPUs.
+GENE_LOAD_WORKERS = int(os.environ.get("GENE_LOAD_WORKERS", 0))
+
+# number of .gene files ingested into the KG at a time during `GenomeKG.load`.
+GENE_LOAD_BATCH_SIZE = int(os.environ.get("GENE_LOAD_BATCH_SIZE", 64))
+
+# gene search index built by `GenomeKG.compute_tree`. 'balltree' (exact) or 'ivfpq' (approximate).
+GENE_INDEX_TYPE = os.environ.get("GENE_INDEX_TYPE", "balltree")
+
+# number of inverted lists scanned per query by the 'ivfpq' gene index. Higher is slower with better recall.
+GENE_INDEX_NPROBE = int(os.environ.get("GENE_INDEX_NPROBE", 8))
+
+# genes appended to the gene search index are searched by brute force until there are this many,
+# then the index is rebuilt in the background.
+GENE_INDEX_DELTA_MAX = int(os.environ.get("GENE_INDEX_DELTA_MAX", 10000))
+
+# number of processes used for the Sigmal gene extraction of a binary. 0: number of CPUs.
+SIGMAL_GENE_WORKERS = int(os.environ.get("SIGMAL_GENE_WORKERS", 0))
+
+# number of functions sent to a Sigmal gene extraction process at a time.
+SIGMAL_GENE_CHUNK_SIZE = int(os.environ.get("SIGMAL_GENE_CHUNK_SIZE", 64))
+
+# number of processes converting the canonicalization pass output to bitcode. 0: number of CPUs.
+CANON_WORKERS = int(os.environ.get("CANON_WORKERS", 0))
+
+# number of canonicalized functions sent to a bitcode conversion process at a time.
+CANON_CHUNK_SIZE = int(os.environ.get("CANON_CHUNK_SIZE", 64))
+
+# number of canon (.canon) files a GenomeKG keeps open for bitcode reads. Least recently used are closed.
+CANON_FILE_MAX_OPEN = int(os.environ.get("CANON_FILE_MAX_OPEN", 64))
+
+# read the bitcodes of canon files through mmap instead of pread.
+CANON_FILE_MMAP = os.environ.get("CANON_FILE_MMAP", "1").lower() in ["1", "true", "yes"]
+
+# cache of lifted IR under CG_CACHE_DIR/ir keyed by binary sha256, RetDec version and config.
+IR_CACHE_ENABLED = os.environ.get("IR_CACHE_ENABLED", "1").lower() in ["1", "true", "yes"]
+
+# max size of the lifted IR cache. Least recently used entries are evicted.
+IR_CACHE_MAX_SIZE_MB = int(os.environ.get("IR_CACHE_MAX_SIZE_MB", 10240))
+
+# cache of raw genes of canonical functions (CG_CACHE_DIR/genes.sqlite) keyed by gene type and gene_id.
+GENE_CACHE_ENABLED = os.environ.get("GENE_CACHE_ENABLED", "1").lower() in ["1", "true", "yes"]
+
+# max number of cached genes. Least recently used genes are evicted.
+GENE_CACHE_MAX_ENTRIES = int(os.environ.get("GENE_CACHE_MAX_ENTRIES", 5000000))
@@ -1,10 +1,27 @@
+import collections
+import io
+import json
+import mmap
 import os
+import pickle
+import struct
+import threading
+import zlib
 
 import joblib
+import numpy as np
 
-_GKG_FILE_VERSION = "0.3"
-_CANON_FILE_VERSION_ = "0.3"
-_GENE_FILE_VERSION_ = "0.3"
+from .ids import id_bytes
+
+LEGACY_GKG_FILE_VERSION = "0.3"  # single joblib pickle, read only
+_GKG_INDEX_VERSION = "0.5"
+_GKG_INDEX_TOC = "toc.json"
+_CANON_FILE_VERSION_ = "0.4"
+LEGACY_CANON_FILE_VERSION = "0.3"  # single pickle, read only
+_CANON_MAGIC = b"CGCANON\0"
+_CANON_FOOTER = struct.Struct("<QQ8s")  # header offset, header size, magic
+_GENE_FILE_VERSION_ = "0.4"
+LEGACY_GENE_FILE_VERSION = "0.3"  # hex ids, read only
 
 
 def get_file_meta(file_path, file_size=None):
@@ -14,28 +31,141 @@ def get_file_meta(file_path, file_size=None):
     return {"file_path": file_path, "file_size": file_size}
 
 
-def prep_gkg_file(gkg):
-    file_content = {
-        "type": "gkg",
-        "version": _GKG_FILE_VERSION,
-        "data": gkg.serialize(),
-    }
-    return file_content
-
-
 def read_gkg_file(path):
+    # legacy single file index
     data = joblib.load(path)
     assert data["type"] == "gkg"
-    assert data["version"] == _GKG_FILE_VERSION
+    assert data["version"] == LEGACY_GKG_FILE_VERSION
     return data
 
 
+def _crc32_file(path, chunk_size=1 << 24):
+    crc = 0
+    with open(path, "rb") as f:
+        while True:
+            buf = f.read(chunk_size)
+            if not buf:
+                break
+            crc = zlib.crc32(buf, crc)
+    return crc
+
+
+def write_gkg_index(path, sections, replace=True, remove=()):
+    """
+    Writes a gkg index directory.
+
+    `sections` is a dict of section name to data. numpy arrays are written as
+    memory-mappable `.npy` files, everything else is pickled. Each section is
+    checksummed in the table of contents (`toc.json`), which is written last.
+    If `replace` is False, sections of an existing index that are not in
+    `sections` are kept, except the ones listed in `remove`.
+    """
+    if not os.path.exists(path):
+        os.makedirs(path)
+
+    toc = {"type": "gkg", "version": _GKG_INDEX_VERSION, "sections": {}}
+    toc_path = os.path.join(path, _GKG_INDEX_TOC)
+    if (not replace) and os.path.exists(toc_path):
+        with open(toc_path) as f:
+            old_toc = json.load(f)
+        if old_toc.get("version") == _GKG_INDEX_VERSION:
+            toc["sections"].update(old_toc["sections"])
+        for name in remove:
+            toc["sections"].pop(name, None)
+
+    for name, data in sections.items():
+        if isinstance(data, np.ndarray):
+            fmt, fn = "npy", name + ".npy"
+        else:
+            fmt, fn = "pickle", name + ".pkl"
+        fpath = os.path.join(path, fn)
+        tmp = fpath + ".tmp"
+        with open(tmp, "wb") as f:
+            if fmt == "npy":
+                np.save(f, data)
+            else:
+                pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+        # atomic replace, existing memory maps of the old file remain valid
+        os.replace(tmp, fpath)
+        toc["sections"][name] = {
+            "file": fn,
+            "format": fmt,
+            "size": os.path.getsize(fpath),
+            "crc32": _crc32_file(fpath),
+        }
+
+    tmp = toc_path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(toc, f, indent=1)
+    os.replace(tmp, toc_path)
+    return path
+
+
+class GKGIndexFile(object):
+    def __init__(self, path, verify=True):
+        """
+        Reader of a gkg index directory. Sections are loaded on first access
+        only. With `verify` the size and the checksum of each section are
+        verified on its first access; a memory mapped section is read once
+        for it. `verify="size"` only checks the size of the memory mapped
+        sections, which maps them without reading.
+        """
+        self.path = path
+        self.verify = verify
+        with open(os.path.join(path, _GKG_INDEX_TOC)) as f:
+            self.toc = json.load(f)
+        if self.toc.get("type") != "gkg":
+            raise Exception(f"invalid file type {self.toc.get('type')}")
+        if self.toc.get("version") != _GKG_INDEX_VERSION:
+            raise Exception(f"Unknown index version {self.toc.get('version')}.")
+        self.version = self.toc["version"]
+        self._cache = {}
+
+    @property
+    def sections(self):
+        return list(self.toc["sections"].keys())
+
+    def __contains__(self, name):
+        return name in self.toc["sections"]
+
+    def load(self, name, mmap_mode="r"):
+        if name in self._cache:
+            return self._cache[name]
+
+        sec = self.toc["sections"][name]
+        fpath = os.path.join(self.path, sec["file"])
+        if self.verify and os.path.getsize(fpath) != sec["size"]:
+            raise Exception(f"Checksum mismatch for index section {name}.")
+
+        if sec["format"] == "npy" and mmap_mode is not None:
+            if (
+                self.verify
+                and self.verify != "size"
+                and _crc32_file(fpath) != sec["crc32"]
+            ):
+                raise Exception(f"Checksum mismatch for index section {name}.")
+            data = np.load(fpath, mmap_mode=mmap_mode)
+        else:
+            # read once, for the checksum and the data
+            with open(fpath, "rb") as f:
+                buf = f.read()
+            if self.verify and zlib.crc32(buf) != sec["crc32"]:
+                raise Exception(f"Checksum mismatch for index section {name}.")
+            if sec["format"] == "npy":
+                data = np.load(io.BytesIO(buf))
+            else:
+                data = pickle.loads(buf)
+        self._cache[name] = data
+        return data
+
+
 def prep_gene_file(genes, binid, file_meta):
+    # bin and gene ids are stored as digests
     file_content = {
         "type": "gene",
         "version": _GENE_FILE_VERSION_,
-        "binid": binid,
-        "genes": genes,
+        "binid": id_bytes(binid),
+        "genes": [(id_bytes(x[0]),) + tuple(x[1:]) for x in genes],
         "file_meta": file_meta,
     }
     return file_content
@@ -44,7 +174,7 @@ def prep_gene_file(genes, binid, file_meta):
 def read_gene_file(path):
     data = joblib.load(path)
     assert data["type"] == "gene"
-    assert data["version"] == _GENE_FILE_VERSION_
+    assert data["version"] in [_GENE_FILE_VERSION_, LEGACY_GENE_FILE_VERSION]
     return data
 
 
@@ -59,8 +189,166 @@ def prep_canon_file(ir_bin, file_meta):
     return file_content
 
 
+def write_canon_file(path, canon):
+    """
+    Writes a canon file: the magic, the function bitcodes back to back, the
+    pickled header (the canon dict with `funcs` as `(gene_id, func_name,
+    meta)` tuples and the `gene_id -> (offset, size)` bitcode `index`) and
+    a fixed size footer locating the header. Equal bitcodes are stored once.
+    """
+    funcs = None if canon["funcs"] is None else []
+    index = {}
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(_CANON_MAGIC)
+        for gid, func, bc, meta in canon["funcs"] or []:
+            key = gid.lower()
+            if key not in index:
+                index[key] = (f.tell(), len(bc))
+                f.write(bc)
+            funcs.append((gid, func, meta))
+        header = dict(canon, version=_CANON_FILE_VERSION_, funcs=funcs, index=index)
+        offset = f.tell()
+        pickle.dump(header, f, protocol=pickle.HIGHEST_PROTOCOL)
+        f.write(_CANON_FOOTER.pack(offset, f.tell() - offset, _CANON_MAGIC))
+    os.replace(tmp, path)
+    return path
+
+
+class CanonFile(object):
+    def __init__(self, path, use_mmap=True):
+        """
+        Reader of a canon file. Only the header is read when opened, each
+        bitcode is then read with a single `mmap` slice or `pread`. Legacy
+        (single pickle) canon files are loaded entirely.
+        """
+        self.path = path
+        self._f = open(path, "rb")
+        st = os.fstat(self._f.fileno())
+        self.stat_key = (st.st_mtime_ns, st.st_size)
+        self._mm = None
+        self._bcs = None  # bitcodes of a legacy file
+
+        if self._f.read(len(_CANON_MAGIC)) != _CANON_MAGIC:
+            self._f.close()
+            self._f = None
+            data = joblib.load(path)
+            assert data["type"] == "canon"
+            assert data["version"] == LEGACY_CANON_FILE_VERSION
+            self._bcs = {}
+            funcs = []
+            for gid, func, bc, meta in data["funcs"] or []:
+                self._bcs.setdefault(gid.lower(), bc)
+                funcs.append((gid, func, meta))
+            self.header = dict(data, funcs=funcs, index={})
+            return
+
+        self._f.seek(-_CANON_FOOTER.size, os.SEEK_END)
+        offset, size, magic = _CANON_FOOTER.unpack(self._f.read(_CANON_FOOTER.size))
+        if magic != _CANON_MAGIC:
+            raise Exception(f"Corrupted canon file {path}.")
+        self._f.seek(offset)
+        self.header = pickle.loads(self._f.read(size))
+        assert self.header["type"] == "canon"
+        assert self.header["version"] == _CANON_FILE_VERSION_
+        if use_mmap:
+            self._mm = mmap.mmap(self._f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    @property
+    def binid(self):
+        return self.header["binid"]
+
+    @property
+    def file_meta(self):
+        return self.header["file_meta"]
+
+    @property
+    def funcs(self):
+        # (gene_id, func_name, meta) tuples
+        return self.header["funcs"]
+
+    def gene_ids(self):
+        if self._bcs is not None:
+            return list(self._bcs)
+        return list(self.header["index"])
+
+    def __contains__(self, gene_id):
+        gene_id = gene_id.lower()
+        if self._bcs is not None:
+            return gene_id in self._bcs
+        return gene_id in self.header["index"]
+
+    def get_bc(self, gene_id):
+        gene_id = gene_id.lower()
+        if self._bcs is not None:
+            return self._bcs.get(gene_id)
+        loc = self.header["index"].get(gene_id)
+        if loc is None:
+            return None
+        offset, size = loc
+        if self._mm is not None:
+            return self._mm[offset : offset + size]
+        return os.pread(self._f.fileno(), size, offset)
+
+    def to_dict(self):
+        # canon dict with the bitcodes, as written by `write_canon_file`
+        out = {k: v for k, v in self.header.items() if k != "index"}
+        if out["funcs"] is not None:
+            out["funcs"] = [
+                (gid, func, self.get_bc(gid), meta) for gid, func, meta in out["funcs"]
+            ]
+        return out
+
+    def close(self):
+        if self._mm is not None:
+            self._mm.close()
+            self._mm = None
+        if self._f is not None:
+            self._f.close()
+            self._f = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class CanonFileCache(object):
+    def __init__(self, max_open=64, use_mmap=True):
+        """
+        LRU of open `CanonFile`s keyed by path. A file replaced on disk is
+        reopened.
+        """
+        self.max_open = max(1, max_open)
+        self.use_mmap = use_mmap
+        self._files = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, path):
+        st = os.stat(path)
+        with self._lock:
+            cf = self._files.get(path)
+            if cf is not None and cf.stat_key == (st.st_mtime_ns, st.st_size):
+                self._files.move_to_end(path)
+                return cf
+        cf = CanonFile(path, use_mmap=self.use_mmap)
+        with self._lock:
+            self._files[path] = cf
+            self._files.move_to_end(path)
+            # evicted files are closed once no reader holds them
+            while len(self._files) > self.max_open:
+                self._files.popitem(last=False)
+        return cf
+
+    def clear(self):
+        with self._lock:
+            self._files.clear()
+
+    def __len__(self):
+        return len(self._files)
+
+
 def read_canon_file(path):
-    data = joblib.load(path)
-    assert data["type"] == "canon"
-    assert data["version"] == _CANON_FILE_VERSION_
-    return data
+    with CanonFile(path, use_mmap=False) as cf:
+        return cf.to_dict()
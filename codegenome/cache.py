@@ -0,0 +1,262 @@
+##
+## This code is part of the Code Genome Framework.
+##
+## (C) Copyright IBM 2023.
+##
+## This code is licensed under the Apache License, Version 2.0. You may
+## obtain a copy of this license in the LICENSE.txt file in the root directory
+## of this source tree or at http://www.apache.org/licenses/LICENSE-2.0.
+##
+## Any modifications or derivative works of this code must retain this
+## copyright notice, and modified files need to carry a notice indicating
+## that they have been altered from the originals.
+##
+"""
+Persistent caches of the genification pipeline stages.
+"""
+
+import hashlib
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+from ._defaults import (CG_CACHE_DIR, GENE_CACHE_MAX_ENTRIES,
+                        IR_CACHE_MAX_SIZE_MB)
+
+logger = logging.getLogger("codegenome.cache")
+
+
+def cache_key(*parts):
+    return hashlib.sha256("\0".join(str(x) for x in parts).encode("utf-8")).hexdigest()
+
+
+class BlobCache(object):
+    def __init__(self, cache_dir, max_size=None, ext=".bin"):
+        """
+        Content-addressed file cache with size bounded LRU eviction.
+
+        Entries are stored as `{cache_dir}/{key[:2]}/{key}{ext}`. Reads refresh
+        the entry mtime, which is the LRU order. Writes are atomic, so the
+        cache can be shared by processes. `max_size` is in bytes, None means
+        unbounded.
+        """
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.ext = ext
+        self._size = None  # total size, computed on the first write
+        self._lock = threading.Lock()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + self.ext)
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return data
+
+    def __contains__(self, key):
+        return os.path.exists(self._path(key))
+
+    def put(self, key, data):
+        path = self._path(key)
+        d = os.path.dirname(path)
+        os.makedirs(d, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=d, prefix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except Exception:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        if self.max_size is not None:
+            with self._lock:
+                if self._size is None:
+                    self._size = sum(x[2] for x in self._entries())
+                else:
+                    self._size += len(data)
+                if self._size > self.max_size:
+                    self.evict()
+
+    def _entries(self):
+        # (mtime, path, size) of all the entries
+        out = []
+        if not os.path.exists(self.cache_dir):
+            return out
+        for sub in os.scandir(self.cache_dir):
+            if not sub.is_dir():
+                continue
+            for e in os.scandir(sub.path):
+                if e.name.endswith(self.ext) and not e.name.startswith(".tmp"):
+                    try:
+                        st = e.stat()
+                    except FileNotFoundError:
+                        continue
+                    out.append((st.st_mtime, e.path, st.st_size))
+        return out
+
+    def evict(self, max_size=None):
+        """
+        Removes the least recently used entries until the cache fits in
+        `max_size` bytes (default: `self.max_size`). Returns the removed count.
+        """
+        max_size = self.max_size if max_size is None else max_size
+        entries = sorted(self._entries())
+        size = sum(x[2] for x in entries)
+        removed = 0
+        for _, path, sz in entries:
+            if size <= max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            size -= sz
+            removed += 1
+        self._size = size
+        if removed:
+            logger.debug(f"Evicted {removed} entries from {self.cache_dir}")
+        return removed
+
+
+class GeneCache(object):
+    def __init__(self, path, max_entries=None):
+        """
+        Persistent `key -> raw_gene` store in sqlite with LRU eviction once it
+        holds more than `max_entries` genes. Keys are usually
+        `{gene_type}:{gene_id}`; the gene_id is the sha256 of the canonical
+        function bitcode, so equal functions of any binary share the entry.
+
+        Connections are per thread. Concurrent processes are serialized by
+        sqlite.
+        """
+        self.path = path
+        self.max_entries = max_entries
+        self._local = threading.local()
+        self._writes = 0
+        d = os.path.dirname(path)
+        if d:
+            os.makedirs(d, exist_ok=True)
+        with self._conn() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS genes "
+                "(key TEXT PRIMARY KEY, dtype TEXT, gene BLOB, atime INTEGER)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS genes_atime ON genes (atime)")
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=60)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get_many(self, keys):
+        """
+        Returns a dict of the cached raw genes of `keys`.
+        """
+        out = {}
+        keys = list(keys)
+        conn = self._conn()
+        for i in range(0, len(keys), 500):
+            chunk = keys[i : i + 500]
+            q = "SELECT key, dtype, gene FROM genes WHERE key IN (%s)" % (
+                ",".join("?" * len(chunk))
+            )
+            for key, dtype, gene in conn.execute(q, chunk):
+                out[key] = np.frombuffer(gene, dtype=dtype).copy()
+        if out:
+            with conn:
+                now = int(time.time())
+                conn.executemany(
+                    "UPDATE genes SET atime=? WHERE key=?", [(now, k) for k in out]
+                )
+        return out
+
+    def put_many(self, items):
+        """
+        Stores `(key, raw_gene)` items.
+        """
+        now = int(time.time())
+        rows = []
+        for key, raw_gene in items:
+            raw_gene = np.asarray(raw_gene)
+            rows.append((key, raw_gene.dtype.str, raw_gene.tobytes(), now))
+        if not rows:
+            return
+        conn = self._conn()
+        with conn:
+            conn.executemany("INSERT OR REPLACE INTO genes VALUES (?,?,?,?)", rows)
+        self._writes += len(rows)
+        if self.max_entries is not None and self._writes >= self.max_entries // 100:
+            self._writes = 0
+            self.evict()
+
+    def evict(self, max_entries=None):
+        """
+        Removes the least recently used genes above `max_entries`.
+        Returns the removed count.
+        """
+        max_entries = self.max_entries if max_entries is None else max_entries
+        conn = self._conn()
+        count = conn.execute("SELECT COUNT(*) FROM genes").fetchone()[0]
+        if count <= max_entries:
+            return 0
+        with conn:
+            conn.execute(
+                "DELETE FROM genes WHERE key IN "
+                "(SELECT key FROM genes ORDER BY atime LIMIT ?)",
+                (count - max_entries,),
+            )
+        logger.debug(f"Evicted {count - max_entries} genes from {self.path}")
+        return count - max_entries
+
+    def __len__(self):
+        return self._conn().execute("SELECT COUNT(*) FROM genes").fetchone()[0]
+
+
+_ir_cache = None
+_gene_cache = None
+
+
+def get_ir_cache():
+    """
+    Cache of the lifted IR (bitcode) of binaries.
+    """
+    global _ir_cache
+    if _ir_cache is None:
+        _ir_cache = BlobCache(
+            os.path.join(CG_CACHE_DIR, "ir"),
+            max_size=IR_CACHE_MAX_SIZE_MB * 1024 * 1024,
+            ext=".bc",
+        )
+    return _ir_cache
+
+
+def get_gene_cache():
+    """
+    Cache of the raw genes of canonical functions.
+    """
+    global _gene_cache
+    if _gene_cache is None:
+        _gene_cache = GeneCache(
+            os.path.join(CG_CACHE_DIR, "genes.sqlite"),
+            max_entries=GENE_CACHE_MAX_ENTRIES,
+        )
+    return _gene_cache
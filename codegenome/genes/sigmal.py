@@ -27,6 +27,7 @@ import scipy
 from PIL import Image
 from sklearn.neighbors import BallTree
 
+from ..utils import get_worker_count, parallel_map
 from .base import CGGeneBase
 
 logger = logging.getLogger("codegenome.gene.sigmal")
@@ -75,10 +76,32 @@ def prep_data_sigmal2(bc):
     return func_str, aux_str
 
 
+def _from_bitcode_worker(args):
+    bc, gene_type = args
+    return SigmalGene().from_bitcode(bc, gene_type)
+
+
 class SigmalGene(CGGeneBase):
     def from_data(self, data):
         return self.feats_from_binary(data)
 
+    def from_bitcodes(self, bcs, gene_type="sigmal", workers=1, chunk_size=64):
+        """
+        Batched `from_bitcode`. Yields the raw genes of the `bcs` iterable in
+        order. The bitcodes are sent to `workers` processes in chunks of
+        `chunk_size`. `workers`: 0 or None uses all CPUs.
+        """
+        if not isinstance(bcs, (list, tuple)):
+            bcs = list(bcs)
+        # small batches are not worth the pool start-up
+        workers = min(get_worker_count(workers), max(1, len(bcs) // chunk_size))
+        return parallel_map(
+            _from_bitcode_worker,
+            ((bc, gene_type) for bc in bcs),
+            workers,
+            chunk_size,
+        )
+
     def from_bitcode(self, data, gene_type="sigmal"):
         """
         gene_type can be sigmal|sigmal2|sigmal2b|func_only
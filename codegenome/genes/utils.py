@@ -5,6 +5,7 @@ import zlib
 import numpy as np
 
 from .._defaults import *
+from ..ids import id_hex
 
 
 def encode_gene(gene_data):
@@ -99,13 +100,14 @@ class GeneFile(object):
 
         self.version = self.data["version"]
 
-        if self.version == "0.3":
+        if self.version in ["0.3", "0.4"]:
             self.init_v0_3()
         else:
             raise Exception("Unknown file version.")
 
     def init_v0_3(self):
-        self.binid = self.data["binid"]
+        # v0.4 stores the ids as digests
+        self.binid = id_hex(self.data["binid"])
         self._genes = self.data["genes"]
         self._meta = self.data["file_meta"]
 
@@ -114,7 +116,7 @@ class GeneFile(object):
                 cid, funcs, gene, gene_meta = self.data[ii]
                 bc_size, file_offset = gene_meta
                 return {
-                    "canon_bc_id": cid,
+                    "canon_bc_id": id_hex(cid),
                     "func_names": funcs,
                     "gene": gene,
                     "canon_bc_size": bc_size,
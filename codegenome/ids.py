@@ -0,0 +1,76 @@
+##
+## This code is part of the Code Genome Framework.
+##
+## (C) Copyright IBM 2023.
+##
+## This code is licensed under the Apache License, Version 2.0. You may
+## obtain a copy of this license in the LICENSE.txt file in the root directory
+## of this source tree or at http://www.apache.org/licenses/LICENSE-2.0.
+##
+## Any modifications or derivative works of this code must retain this
+## copyright notice, and modified files need to carry a notice indicating
+## that they have been altered from the originals.
+##
+"""
+Gene and bin ids.
+
+Ids are sha256 hashes (of the canonical function bitcode for genes, of the
+file content for bins). The KG maps, the index, the .gene files and the job
+store keep them as 32-byte digests. The 64 character hex form is only used
+at the edges: the `GenomeKG` methods, the REST API and the command line.
+"""
+
+import numpy as np
+
+ID_SIZE = 32  # sha256 digest size
+ID_DTYPE = "V%d" % ID_SIZE  # numpy dtype of digest columns, keeps trailing NULs
+
+
+def id_bytes(x):
+    """
+    Returns the digest of an id given as hex string or digest. Raises
+    `ValueError` if `x` is not an id.
+    """
+    if isinstance(x, bytes):
+        if len(x) != ID_SIZE:
+            raise ValueError(f"Invalid id size {len(x)}.")
+        return x
+    if not isinstance(x, str):
+        raise ValueError(f"Invalid id type {type(x).__name__}.")
+    try:
+        out = bytes.fromhex(x.strip())
+    except ValueError:
+        raise ValueError(f"Invalid id {x!r}.") from None
+    if len(out) != ID_SIZE:
+        raise ValueError(f"Invalid id {x!r}.")
+    return out
+
+
+def to_id_bytes(x, default=None):
+    # lookup variant of `id_bytes`, anything that is not an id is not found
+    try:
+        return id_bytes(x)
+    except ValueError:
+        return default
+
+
+def id_hex(x):
+    """
+    Returns the hex form of an id given as digest or hex string.
+    """
+    if isinstance(x, bytes):
+        return x.hex()
+    return x.strip().lower()
+
+
+def ids_from_array(arr):
+    # digests of an `ID_DTYPE` (or legacy hex `S64`) numpy array
+    if arr.dtype.kind == "S":
+        return [id_bytes(x.decode("ascii")) for x in arr.tolist()]
+    data = arr.tobytes()
+    return [data[i : i + ID_SIZE] for i in range(0, len(data), ID_SIZE)]
+
+
+def ids_to_array(ids):
+    # `ID_DTYPE` numpy array of ids
+    return np.frombuffer(b"".join(id_bytes(x) for x in ids), dtype=ID_DTYPE).copy()
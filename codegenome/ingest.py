@@ -0,0 +1,89 @@
+##
+## This code is part of the Code Genome Framework.
+##
+## (C) Copyright IBM 2023.
+##
+## This code is licensed under the Apache License, Version 2.0. You may
+## obtain a copy of this license in the LICENSE.txt file in the root directory
+## of this source tree or at http://www.apache.org/licenses/LICENSE-2.0.
+##
+## Any modifications or derivative works of this code must retain this
+## copyright notice, and modified files need to carry a notice indicating
+## that they have been altered from the originals.
+##
+"""
+Per file state shared by the ingestion layers (service, KG and pipeline).
+"""
+
+import hashlib
+import mmap
+import os
+
+from ._file_format import get_file_meta
+
+HASH_CHUNK_SIZE = 1 << 20
+HASH_MMAP_MIN_SIZE = 1 << 26  # files from this size are hashed through mmap
+
+
+def sha256_file(file_path, chunk_size=HASH_CHUNK_SIZE):
+    """
+    Hex sha256 of the content of `file_path`, without reading it in memory.
+    Large files are mapped, the others are read in `chunk_size` blocks into a
+    reused buffer.
+    """
+    h = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size >= HASH_MMAP_MIN_SIZE:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                h.update(m)
+        else:
+            buf = bytearray(min(chunk_size, max(size, 1)))
+            view = memoryview(buf)
+            while True:
+                n = f.readinto(buf)
+                if not n:
+                    break
+                h.update(view[:n])
+    return h.hexdigest()
+
+
+class IngestContext(object):
+    def __init__(self, file_path, bin_id=None, metadata=None):
+        """
+        A binary being ingested. `bin_id` (sha256 of the file) and `metadata`
+        are computed on first use and then passed along, so the file is hashed
+        once however many layers need its id.
+        """
+        self.file_path = file_path
+        self._bin_id = bin_id
+        self._metadata = metadata
+
+    @staticmethod
+    def of(obj, bin_id=None):
+        """
+        `obj` if it is an `IngestContext`, otherwise a context of the file path.
+        """
+        if isinstance(obj, IngestContext):
+            if bin_id is not None and obj._bin_id is None:
+                obj._bin_id = bin_id
+            return obj
+        return IngestContext(obj, bin_id=bin_id)
+
+    @property
+    def bin_id(self):
+        if self._bin_id is None:
+            self._bin_id = sha256_file(self.file_path)
+        return self._bin_id
+
+    @property
+    def metadata(self):
+        if self._metadata is None:
+            self._metadata = get_file_meta(self.file_path)
+        return self._metadata
+
+    def __str__(self):
+        return str(self.file_path)
+
+    def __repr__(self):
+        return f"IngestContext({self.file_path!r}, bin_id={self._bin_id!r})"
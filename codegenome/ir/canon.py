@@ -1,18 +1,84 @@
-import os
-import time
+import contextlib
+import datetime
+import hashlib
 import json
-import jsonlines
 import logging
-import datetime
+import os
 import subprocess
-import hashlib
+import threading
+import time
+
+import jsonlines
+
+from .._defaults import CANON_CHUNK_SIZE, CANON_WORKERS
+from ..utils import get_worker_count, parallel_map
 
 DEFAULT_LLVM_PATH = '/opt/llvm'
+CANON_STAGES = ['sort', 'parse', 'bitcode', 'hash']
 logger = logging.getLogger('codegenome.canon')
 
+
+class CanonPassError(Exception):
+    pass
+
+
+def _feed(pipe, data):
+    try:
+        pipe.write(data)
+    except BrokenPipeError:
+        pass
+    finally:
+        try:
+            pipe.close()
+        except BrokenPipeError:
+            pass
+
+
+def _canon_func(func):
+    """
+    Converts a canonicalization pass record to `('OK', gid, name, bc, meta, stage_times)`
+    or `('ERR', name, error)`. Returns None for extern functions.
+    """
+    import llvmlite.binding as llvm  # lazy loading
+    func_name = func.get('name')
+    try:
+        #code, data, extern, name
+        if func['extern']:
+            return None
+        t0 = time.time()
+        #sort data
+        data = func['data'].split('\n')
+        data.sort()
+        data = '\n'.join([x for x in data if x!=''])
+        t1 = time.time()
+
+        m = llvm.parse_assembly( data + '\n' + func['code'] )
+        t2 = time.time()
+        bc =  m.as_bitcode()
+        t3 = time.time()
+
+        gid = hashlib.sha256(bc).hexdigest()
+        t4 = time.time()
+        # TODO get file_offset
+        bc_size = len(bc)
+        file_offset = 0
+        meta = (bc_size, file_offset)
+        return ('OK', gid, func_name, bc, meta, (t1-t0, t2-t1, t3-t2, t4-t3))
+    except Exception as e:
+        return ('ERR', func_name, str(e))
+
 class IRCanonPassBinary(object):
-    def __init__(self, input_data, output='canon.jsonl', bin_id='', pass_file='libcanonicalization-pass.so', llvm_path=None):
+    def __init__(self, input_data, output='canon.jsonl', bin_id='', pass_file='libcanonicalization-pass.so', llvm_path=None,
+                 workers=CANON_WORKERS, chunk_size=CANON_CHUNK_SIZE):
+        """
+        `output` is the canonicalization pass output (jsonl) file. With None
+        the output is streamed through a pipe instead.
+        `workers` processes (0: number of CPUs) convert the canonicalized
+        functions to bitcode in chunks of `chunk_size` records.
+        """
         self.input_data = input_data
+        self.workers = get_worker_count(workers)
+        self.chunk_size = chunk_size
         self._bin_id = bin_id
         self.llvm_path = os.environ.get(
             'LLVM_PATH', DEFAULT_LLVM_PATH) if llvm_path is None else llvm_path
@@ -43,64 +109,111 @@ class IRCanonPassBinary(object):
             logger.error(f"Exception: {ex}")
 
         return None
-    
+
+    def canon_pass_stream(self):
+        """
+        Runs the canonicalization pass with its output written to a pipe and
+        yields the function records while `opt` is still running.
+        Raises `CanonPassError` if `opt` fails.
+        """
+        r, w = os.pipe()
+        args = [self.opt_bin, '--load', self.pass_file,'--canonicalization', '--canon-out',
+                 '/dev/fd/%d' % w]
+        logger.info(f'running {args}')
+        t = time.time()
+        try:
+            proc = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL,
+                        stderr=subprocess.DEVNULL, pass_fds=(w,))
+        except Exception as ex:
+            os.close(r)
+            raise CanonPassError(f"Exception: {ex}")
+        finally:
+            os.close(w)
+
+        # feed the IR from a thread, opt may block writing the output first
+        feeder = threading.Thread(target=_feed, args=(proc.stdin, self.input_data), daemon=True)
+        feeder.start()
+        done = False
+        try:
+            with os.fdopen(r, 'r') as f:
+                for func in jsonlines.Reader(f):
+                    yield func
+            done = True
+        finally:
+            if not done and proc.poll() is None:
+                proc.kill()
+            ret = proc.wait()
+            feeder.join()
+            self.stat['pass_time'] = time.time() - t
+        if ret != 0:
+            logger.debug(f"CANON_PASS_ERROR. Time: {time.time()-t} secs. returncode: {ret}")
+            raise CanonPassError(f"opt exited with {ret}")
+        logger.debug(f"CANON_PASS_OK. Time: {time.time()-t} secs. streamed")
+
     def serialize(self, statf=None):
-        import llvmlite.binding as llvm #lazy loading
+        """
+        Runs the canonicalization pass and returns the `(gene_id, func_name,
+        bitcode, meta)` list. Without an `output` file the pass output is
+        streamed through a pipe, so the conversion overlaps with the pass.
+        """
         fns = []
         i = 0
         tot = 0
         err = 0
+        timing = dict.fromkeys(CANON_STAGES, 0.0)
         st = time.time()
         
-        jsonl = self.canon_pass()
-        if jsonl is None:
-            return None
-        t1 = time.time()
+        if self.output is None:
+            records = self.canon_pass_stream()
+            t1 = st
+        else:
+            jsonl = self.canon_pass()
+            if jsonl is None:
+                return None
+            t1 = time.time()
+            records = jsonlines.open(jsonl)
         
-        with jsonlines.open(jsonl) as reader:
-            for func in reader:
-                #code, data, extern, name
-                try:
-                    if func['extern']:
+        try:
+            with contextlib.closing(records) as reader:
+                # records are converted by the workers and returned in order
+                for r in parallel_map(_canon_func, reader, self.workers, self.chunk_size):
+                    if r is None:
+                        # extern
+                        continue
+                    i += 1
+                    if r[0] == 'ERR':
+                        _, func_name, e = r
+                        err += 1
+                        txt = '{"type": "ERR", "i": %d, "ts": "%s", "func": "%s", "e": "%s", "bin_id": "%s"}' % (
+                            i, str(datetime.datetime.now()), func_name, e, self._bin_id)
+                        logger.warning(txt)
+                        if statf:
+                            statf.write(txt + '\n')
                         continue
-                    s = time.time()
-                    #sort data
-                    data = func['data'].split('\n')
-                    data.sort()
-                    data = '\n'.join([x for x in data if x!=''])
-                    
-                    m = llvm.parse_assembly( data + '\n' + func['code'] )
-                    bc =  m.as_bitcode()
-                    s = time.time() - s
-                    tot += 1
-
-                    gid = hashlib.sha256(bc).hexdigest()
-                    # TODO get file_offset
-                    bc_size = len(bc)
-                    file_offset = 0
-                    meta = (bc_size, file_offset)
 
+                    _, gid, func_name, bc, meta, stages = r
+                    tot += 1
+                    for k, v in zip(CANON_STAGES, stages):
+                        timing[k] += v
                     # format (gene_id, func_name, bitcode, meta)
-                    func_name = func['name']
                     fns.append((gid, func_name, bc, meta))
-                    
+
                     if statf:
                         txt = '{"type": "OK", "i": %d, "ts": "%s", "func": "%s", "time": %f, "size": %d}' % (
-                            i, str(datetime.datetime.now()), func_name, s, len(bc))
+                            i, str(datetime.datetime.now()), func_name, sum(stages), len(bc))
                         statf.write(txt + '\n')
-                except Exception as e:
-                    err += 1
-                    txt = '{"type": "ERR", "i": %d, "ts": "%s", "func": "%s", "e": "%s", "bin_id": "%s"}' % (
-                        i, str(datetime.datetime.now()), func_name, str(e), self._bin_id)
-                    logger.warning(txt)
-                    if statf:
-                        statf.write(txt + '\n')
-                    else:
-                        pass
+        except CanonPassError as ex:
+            logger.error(f"CANON_PASS_ERROR. {ex}. bin_id: {self._bin_id}")
+            return None
         t2 = time.time()
+        logger.debug(f"CANON_SERIALIZE. pass: {t1-st} secs, serialize: {t2-t1} secs, stages: {timing}")
         if statf:
             stat = {"type": "stat", "bin_id": self._bin_id, "total": tot,
-                    "errors": err, "func_count": len(self.fs), 'pass_time': t1-st, 'time': t2-t1}
+                    "errors": err, "func_count": i, 'pass_time': t1-st, 'time': t2-t1,
+                    "workers": self.workers}
+            # summed over the functions, i.e. CPU time when running in parallel
+            for k, v in timing.items():
+                stat[k + '_time'] = v
             for k, v in self.stat.items():
                 stat[k] = v
             statf.write(json.dumps(stat) + '\n')
@@ -0,0 +1,45 @@
+##
+## This code is part of the Code Genome Framework.
+##
+## (C) Copyright IBM 2023.
+##
+## This code is licensed under the Apache License, Version 2.0. You may
+## obtain a copy of this license in the LICENSE.txt file in the root directory
+## of this source tree or at http://www.apache.org/licenses/LICENSE-2.0.
+##
+## Any modifications or derivative works of this code must retain this
+## copyright notice, and modified files need to carry a notice indicating
+## that they have been altered from the originals.
+##
+"""
+Writes the .gene file of a binary into a GenomeKG directory, without loading
+the KG. Used to run the gene pipeline in a separate process.
+
+usage: python -m codegenome.kg db_dir file_path [--bin-id ID]
+"""
+
+import argparse
+import sys
+
+from .._defaults import DEFAULT_GENE_VERSION
+from ..ingest import IngestContext
+from .kg import GenomeKG
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(prog="python -m codegenome.kg")
+    ap.add_argument("db_dir", help="GenomeKG directory.")
+    ap.add_argument("file_path", help="Binary file.")
+    ap.add_argument("--bin-id", default=None, help="sha256 of the file if known.")
+    ap.add_argument("--gene-version", default=DEFAULT_GENE_VERSION)
+    ap.add_argument("--keep-aux-files", action="store_true")
+    args = ap.parse_args(argv)
+
+    kg = GenomeKG(db_dir=args.db_dir, gene_version=args.gene_version)
+    ctx = IngestContext(args.file_path, bin_id=args.bin_id)
+    genes = kg.genify_file(ctx, keep_aux_files=args.keep_aux_files)
+    return 0 if genes else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
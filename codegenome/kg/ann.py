@@ -0,0 +1,395 @@
+##
+## This code is part of the Code Genome Framework.
+##
+## (C) Copyright IBM 2023.
+##
+## This code is licensed under the Apache License, Version 2.0. You may
+## obtain a copy of this license in the LICENSE.txt file in the root directory
+## of this source tree or at http://www.apache.org/licenses/LICENSE-2.0.
+##
+## Any modifications or derivative works of this code must retain this
+## copyright notice, and modified files need to carry a notice indicating
+## that they have been altered from the originals.
+##
+"""
+Nearest neighbour gene indexes used as `GenomeKG.gene_tree`.
+
+All indexes follow the sklearn `BallTree` interface: they are built over a gene
+matrix and `query(X, k)` returns `(dist, indx)` arrays of shape `len(X) x k`,
+sorted by distance, where `indx` are rows of the gene matrix.
+
+`IVFPQIndex` is an approximate inverted file index with product quantization
+implemented in NumPy. Its recall/latency trade-off is tuned with `nlist`,
+`nprobe`, `m` and `rerank`. See `scripts/bench_gene_index.py`.
+
+`DeltaGeneIndex` wraps a built index and accepts appended genes without a
+rebuild.
+"""
+
+import logging
+import threading
+import time
+
+import numpy as np
+from scipy.spatial import distance
+from sklearn.metrics import pairwise_distances
+from sklearn.neighbors import BallTree
+
+from .._defaults import (GENE_INDEX_DELTA_MAX, GENE_INDEX_NPROBE,
+                         GENE_INDEX_TYPE)
+
+logger = logging.getLogger("codegenome.kg.ann")
+
+EUCLIDEAN_METRICS = ["minkowski", "euclidean", "l2"]
+
+
+def _sq_dists(x, c, c_sq=None):
+    # squared euclidean distances between the rows of x and c
+    if c_sq is None:
+        c_sq = np.einsum("ij,ij->i", c, c)
+    d = np.einsum("ij,ij->i", x, x)[:, None] + c_sq[None, :] - 2.0 * (x @ c.T)
+    return np.maximum(d, 0.0, out=d)
+
+
+def kmeans(x, k, n_iter=10, seed=0, block_size=4096):
+    """
+    Lloyd's k-means. Returns `(centroids, labels)`.
+    """
+    rs = np.random.RandomState(seed)
+    k = min(k, len(x))
+    centroids = x[rs.choice(len(x), k, replace=False)].astype("float32")
+    labels = np.zeros(len(x), dtype="int64")
+    for it in range(n_iter):
+        c_sq = np.einsum("ij,ij->i", centroids, centroids)
+        for i in range(0, len(x), block_size):
+            labels[i : i + block_size] = np.argmin(
+                _sq_dists(x[i : i + block_size], centroids, c_sq), axis=1
+            )
+        counts = np.bincount(labels, minlength=k)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, labels, x)
+        empty = counts == 0
+        centroids[~empty] = sums[~empty] / counts[~empty, None]
+        # re-seed empty clusters
+        centroids[empty] = x[rs.choice(len(x), int(empty.sum()))]
+    return centroids, labels
+
+
+class GeneIndex(object):
+    """
+    Base class of gene indexes.
+    """
+
+    exact = True
+
+    def __init__(self, data, metric="minkowski"):
+        self.metric = metric
+
+    def query(self, X, k=1):
+        raise NotImplementedError()
+
+    def __len__(self):
+        raise NotImplementedError()
+
+
+class BallTreeIndex(GeneIndex):
+    def __init__(self, data, metric="minkowski"):
+        """
+        Exact index. sklearn `BallTree` over the gene matrix.
+        """
+        super().__init__(data, metric)
+        if metric == "cosine":
+            args = {"metric": "pyfunc", "func": distance.cosine}
+        else:
+            args = {"metric": metric}
+        self.tree = BallTree(data, **args)
+
+    def query(self, X, k=1):
+        return self.tree.query(X, k=k)
+
+    def __len__(self):
+        return self.tree.data.shape[0]
+
+
+class IVFPQIndex(GeneIndex):
+
+    exact = False
+
+    def __init__(
+        self,
+        data,
+        metric="minkowski",
+        nlist=None,
+        nprobe=GENE_INDEX_NPROBE,
+        m=16,
+        nbits=8,
+        rerank=4,
+        train_size=65536,
+        n_iter=10,
+        seed=0,
+    ):
+        """
+        Approximate euclidean index.
+
+        The genes are partitioned into `nlist` k-means cells (default
+        `4 * sqrt(N)`). The residual of each gene to its cell centroid is
+        product quantized into `m` codes of `nbits`. A query scans the `nprobe`
+        closest cells with asymmetric distance computation and reranks the best
+        `rerank * k` candidates with exact distances.
+
+        Higher `nprobe` and `rerank` give higher recall and slower queries.
+        `rerank=0` returns the quantized distances.
+        """
+        super().__init__(data, metric)
+        if metric not in EUCLIDEAN_METRICS:
+            raise ValueError(f"IVFPQIndex does not support metric {metric}")
+
+        data = np.ascontiguousarray(data, dtype="float32")
+        n, dim = data.shape
+        rs = np.random.RandomState(seed)
+        self.nprobe = nprobe
+        self.rerank = rerank
+        self.data = data if rerank else None
+
+        if nlist is None:
+            nlist = max(1, int(4 * np.sqrt(n)))
+        train = data
+        if n > train_size:
+            train = data[np.sort(rs.choice(n, train_size, replace=False))]
+        self.centroids, _ = kmeans(train, nlist, n_iter, seed)
+        self._c_sq = np.einsum("ij,ij->i", self.centroids, self.centroids)
+        labels = np.concatenate(
+            [
+                np.argmin(_sq_dists(data[i : i + 4096], self.centroids, self._c_sq), 1)
+                for i in range(0, n, 4096)
+            ]
+        )
+
+        # inverted lists: rows sorted by cell
+        self.order = np.argsort(labels, kind="stable")
+        self.offsets = np.concatenate(
+            [[0], np.cumsum(np.bincount(labels, minlength=len(self.centroids)))]
+        )
+
+        # product quantizer of the residuals
+        residuals = data - self.centroids[labels]
+        self.subspaces = np.array_split(np.arange(dim), min(m, dim))
+        ksub = min(2**nbits, n)
+        self.codebooks = []
+        codes = np.empty(
+            (n, len(self.subspaces)), dtype="uint8" if nbits <= 8 else "uint16"
+        )
+        for j, sub in enumerate(self.subspaces):
+            r = residuals[:, sub]
+            tr = r if n <= train_size else r[rs.choice(n, train_size, replace=False)]
+            cb, _ = kmeans(tr, ksub, n_iter, seed + j + 1)
+            self.codebooks.append(cb)
+            cb_sq = np.einsum("ij,ij->i", cb, cb)
+            codes[:, j] = np.concatenate(
+                [
+                    np.argmin(_sq_dists(r[i : i + 4096], cb, cb_sq), 1)
+                    for i in range(0, n, 4096)
+                ]
+            )
+        self.codes = codes[self.order]
+
+    def _query_one(self, q, k):
+        cells = np.argsort(_sq_dists(q[None, :], self.centroids, self._c_sq)[0])
+        n_cand = max(k, self.rerank * k)
+        rows, adc = [], []
+        count = 0
+        for probe, c in enumerate(cells):
+            if probe >= self.nprobe and count >= n_cand:
+                break
+            s, e = self.offsets[c], self.offsets[c + 1]
+            if s == e:
+                continue
+            r = q - self.centroids[c]
+            d = np.zeros(e - s, dtype="float32")
+            for j, sub in enumerate(self.subspaces):
+                table = np.sum((self.codebooks[j] - r[sub]) ** 2, axis=1)
+                d += table[self.codes[s:e, j]]
+            rows.append(self.order[s:e])
+            adc.append(d)
+            count += e - s
+        rows, adc = np.concatenate(rows), np.concatenate(adc)
+
+        if len(rows) > n_cand:
+            top = np.argpartition(adc, n_cand - 1)[:n_cand]
+            rows, adc = rows[top], adc[top]
+        if self.rerank:
+            adc = np.sum((self.data[rows] - q) ** 2, axis=1)
+        top = np.argsort(adc, kind="stable")[:k]
+        return np.sqrt(np.maximum(adc[top], 0.0)), rows[top]
+
+    def query(self, X, k=1):
+        X = np.atleast_2d(np.asarray(X, dtype="float32"))
+        k = min(k, len(self))
+        dist = np.empty((len(X), k), dtype="float64")
+        indx = np.empty((len(X), k), dtype="int64")
+        for i, q in enumerate(X):
+            dist[i], indx[i] = self._query_one(q, k)
+        return dist, indx
+
+    def __len__(self):
+        return len(self.order)
+
+
+GENE_INDEX_TYPES = {
+    "balltree": BallTreeIndex,
+    "ivfpq": IVFPQIndex,
+}
+
+
+def build_gene_index(data, metric="minkowski", index_type=GENE_INDEX_TYPE, **params):
+    """
+    Builds a gene index of `index_type` over the gene matrix `data`.
+    """
+    if index_type not in GENE_INDEX_TYPES:
+        raise Exception(
+            f"Unknown gene index type: {index_type}. Allowed types: {list(GENE_INDEX_TYPES)}"
+        )
+    return GENE_INDEX_TYPES[index_type](data, metric, **params)
+
+
+def index_size(index):
+    # gene indexes and plain sklearn BallTrees of former versions
+    if isinstance(index, BallTree):
+        return np.asarray(index.data).shape[0]
+    return len(index)
+
+
+class DeltaGeneIndex(GeneIndex):
+    def __init__(
+        self,
+        main,
+        metric="minkowski",
+        builder=None,
+        compact_threshold=GENE_INDEX_DELTA_MAX,
+    ):
+        """
+        Gene index accepting appends.
+
+        `main` is an index over the rows `[0, N)`. Rows added later are kept in
+        a delta buffer that is searched by brute force, and `query` merges both
+        results. Once the delta holds more than `compact_threshold` rows, `add`
+        rebuilds the main index over all rows with `builder(data)` in a
+        background thread. Queries keep using the former main index and delta
+        until the new index is swapped in.
+        """
+        super().__init__(None, metric)
+        self.main = main
+        self.builder = builder
+        self.compact_threshold = compact_threshold
+        self._nmain = index_size(main)
+        self._delta = None
+        self._ndelta = 0
+        self._lock = threading.Lock()
+        self._compaction = None
+
+    def _delta_metric(self):
+        return "euclidean" if self.metric in EUCLIDEAN_METRICS else self.metric
+
+    def add(self, X, source=None):
+        """
+        Appends the genes `X` as the next rows. `source(n)` returns the first
+        `n` rows of the gene matrix and enables the background compaction.
+        """
+        X = np.atleast_2d(np.asarray(X, dtype="float32"))
+        if len(X) == 0:
+            return
+        with self._lock:
+            n = self._ndelta + len(X)
+            if self._delta is None or n > len(self._delta):
+                cap = max(1024, 2 * n)
+                delta = np.empty((cap, X.shape[1]), dtype="float32")
+                if self._ndelta:
+                    delta[: self._ndelta] = self._delta[: self._ndelta]
+                self._delta = delta
+            self._delta[self._ndelta : n] = X
+            self._ndelta = n
+
+        if (
+            source is not None
+            and self.builder is not None
+            and self._ndelta > self.compact_threshold
+            and not self.compacting
+        ):
+            self.compact(source)
+
+    @property
+    def compacting(self):
+        return self._compaction is not None and self._compaction.is_alive()
+
+    def compact(self, source, background=True):
+        """
+        Rebuilds the main index over all rows. `source(n)` is called by the
+        compaction, off the calling thread.
+        """
+        n = len(self)
+
+        def _run():
+            t = time.time()
+            main = self.builder(source(n))
+            with self._lock:
+                drop = n - self._nmain
+                rest = self._ndelta - drop
+                delta = None
+                if rest > 0:
+                    delta = np.array(self._delta[drop : self._ndelta])
+                self.main, self._nmain = main, n
+                self._delta, self._ndelta = delta, max(rest, 0)
+            logger.debug(
+                "Compacted gene index of %d rows in %f secs" % (n, time.time() - t)
+            )
+
+        if not background:
+            _run()
+            return
+        self._compaction = threading.Thread(target=_run, daemon=True)
+        self._compaction.start()
+
+    def wait(self):
+        # blocks until a running compaction finishes
+        if self._compaction is not None:
+            self._compaction.join()
+
+    def query(self, X, k=1):
+        X = np.atleast_2d(np.asarray(X, dtype="float32"))
+        with self._lock:
+            main, nmain = self.main, self._nmain
+            delta = self._delta[: self._ndelta] if self._ndelta else None
+        k = min(k, nmain + (len(delta) if delta is not None else 0))
+
+        dists, indxs = [], []
+        if nmain:
+            d, i = main.query(X, k=min(k, nmain))
+            dists.append(d)
+            indxs.append(i)
+        if delta is not None:
+            d = pairwise_distances(X, delta, metric=self._delta_metric())
+            kd = min(k, len(delta))
+            i = np.argpartition(d, kd - 1, axis=1)[:, :kd]
+            dists.append(np.take_along_axis(d, i, axis=1))
+            indxs.append(i + nmain)
+        if len(dists) == 1:
+            dist, indx = dists[0], indxs[0]
+        else:
+            dist, indx = np.hstack(dists), np.hstack(indxs)
+        top = np.argsort(dist, axis=1, kind="stable")[:, :k]
+        return np.take_along_axis(dist, top, axis=1), np.take_along_axis(indx, top, 1)
+
+    def __len__(self):
+        return self._nmain + self._ndelta
+
+    def __getstate__(self):
+        self.wait()
+        state = dict(self.__dict__)
+        state["_delta"] = self._delta[: self._ndelta] if self._ndelta else None
+        state.pop("_lock")
+        state["_compaction"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
@@ -0,0 +1,460 @@
+##
+## This code is part of the Code Genome Framework.
+##
+## (C) Copyright IBM 2023.
+##
+## This code is licensed under the Apache License, Version 2.0. You may
+## obtain a copy of this license in the LICENSE.txt file in the root directory
+## of this source tree or at http://www.apache.org/licenses/LICENSE-2.0.
+##
+## Any modifications or derivative works of this code must retain this
+## copyright notice, and modified files need to carry a notice indicating
+## that they have been altered from the originals.
+##
+"""
+Bin -> gene -> function name graph of `GenomeKG`.
+
+`BinGeneGraph` stores the graph in integer encoded CSR arrays. Bin ids, gene
+ids (as digests, `DigestIDRegistry`) and function names (`GeneIDRegistry`)
+map to rows of string tables:
+
+    bin_ptr[b] : bin_ptr[b + 1]    slots (genes) of bin row b
+    slot_gene[s]                   gene row of slot s
+    slot_ptr[s] : slot_ptr[s + 1]  function names of slot s
+    slot_func[f]                   function name row
+
+The arrays are never modified in place, they can be memory mapped. Added or
+modified bins live in a dict based tail, copied from the arrays on first
+modification, and removed bins are masked until `compact` rewrites the arrays.
+
+`GenomeKG.bins` and `GenomeKG.gene_2_bin` are read-only dict views of it.
+"""
+
+import collections.abc
+import sys
+
+import numpy as np
+
+from ..ids import ids_from_array, ids_to_array
+from .store import DigestIDRegistry, GeneIDRegistry
+
+GRAPH_COLUMNS = ["bin_ptr", "slot_gene", "slot_ptr", "slot_func"]
+GRAPH_ID_COLUMNS = ["bin_ids", "gene_ids"]  # digests of the bin and gene rows
+GRAPH_COMPACT_MIN_SLOTS = 1 << 16  # tail slots merged into the arrays at once
+
+
+class BinGeneGraph(object):
+    def __init__(self):
+        self.bin_ids = DigestIDRegistry()
+        self.gene_ids = DigestIDRegistry()
+        self.func_names = GeneIDRegistry()
+        self._set_base(
+            {
+                "bin_ptr": np.zeros(1, dtype="int64"),
+                "slot_gene": np.zeros(0, dtype="int32"),
+                "slot_ptr": np.zeros(1, dtype="int64"),
+                "slot_func": np.zeros(0, dtype="int32"),
+            }
+        )
+        self.bins = BinsView(self)
+        self.gene_2_bin = Gene2BinView(self)
+
+    def _set_base(self, arrays):
+        self._bin_ptr = arrays["bin_ptr"]
+        self._slot_gene = arrays["slot_gene"]
+        self._slot_ptr = arrays["slot_ptr"]
+        self._slot_func = arrays["slot_func"]
+        self._nbase = len(self._bin_ptr) - 1
+        self._dead = set()  # removed or tail copied base bin rows
+        self._tail = {}  # bin row: {gene row: [func rows]}
+        self._tail_g2b = {}  # gene row: [tail bin rows]
+        self._tail_slots = 0
+        self._g2b_ptr = None  # reverse CSR of the base, built on demand
+        self._g2b_bin = None
+        self._slot_order = None  # slots of each base bin by gene row, on demand
+        # number of bins of each gene row. A list, updated one gene at a time.
+        self._refs = np.bincount(self._slot_gene, minlength=len(self.gene_ids))
+        self._ngenes = int(np.count_nonzero(self._refs))
+        self._refs = self._refs.tolist()
+        self._nbins = self._nbase
+
+    # bins
+
+    def _alive(self, row):
+        if row in self._tail:
+            return True
+        return row is not None and row < self._nbase and row not in self._dead
+
+    def _bin_rows(self):
+        # alive bin rows, in row order
+        rows = [x for x in range(self._nbase) if x not in self._dead]
+        if self._tail:
+            rows = sorted(rows + list(self._tail))
+        return rows
+
+    def _bin_len(self, row):
+        t = self._tail.get(row)
+        if t is not None:
+            return len(t)
+        if not self._alive(row):
+            return 0
+        return int(self._bin_ptr[row + 1] - self._bin_ptr[row])
+
+    def _bin_items(self, row):
+        # [(gene row, [func rows])] of a bin
+        t = self._tail.get(row)
+        if t is not None:
+            return list(t.items())
+        if not self._alive(row):
+            return []
+        a, b = int(self._bin_ptr[row]), int(self._bin_ptr[row + 1])
+        genes = self._slot_gene[a:b].tolist()
+        ptr = self._slot_ptr[a : b + 1].tolist()
+        funcs = self._slot_func[ptr[0] : ptr[-1]].tolist()
+        p0 = ptr[0]
+        return [(genes[i], funcs[ptr[i] - p0 : ptr[i + 1] - p0]) for i in range(b - a)]
+
+    def _bin_funcs(self, row, gene_row):
+        # func rows of a gene of a bin, None if the bin has not the gene
+        t = self._tail.get(row)
+        if t is not None:
+            return t.get(gene_row)
+        if gene_row is None or not self._alive(row):
+            return None
+        a, b = int(self._bin_ptr[row]), int(self._bin_ptr[row + 1])
+        if self._slot_order is None:
+            self._build_slot_order()
+        genes = self._slot_gene[a:b]
+        order = self._slot_order[a:b]
+        i = int(np.searchsorted(genes, gene_row, sorter=order))
+        if i == b - a or genes[order[i]] != gene_row:
+            return None
+        s = a + int(order[i])
+        return self._slot_func[self._slot_ptr[s] : self._slot_ptr[s + 1]].tolist()
+
+    def _build_slot_order(self):
+        # offsets of the slots of each bin in gene row order, a searchsorted
+        # sorter of the bin slice. The slots keep their order on disk.
+        counts = np.diff(self._bin_ptr)
+        slot_bin = np.repeat(np.arange(self._nbase, dtype="int32"), counts)
+        order = np.lexsort((self._slot_gene, slot_bin))
+        order -= np.repeat(self._bin_ptr[:-1], counts)
+        self._slot_order = order.astype("int32")
+
+    def _tail_bin(self, row):
+        # tail copy of a bin, created on its first modification
+        t = self._tail.get(row)
+        if t is not None:
+            return t
+        t = {}
+        if self._alive(row):
+            t.update(self._bin_items(row))
+            self._dead.add(row)
+            for gene_row in t:
+                self._tail_g2b.setdefault(gene_row, []).append(row)
+        else:
+            self._nbins += 1
+        self._tail[row] = t
+        self._tail_slots += len(t)
+        return t
+
+    def add(self, bin_id, gene_id, funcs):
+        """
+        Adds the `gene_id` to `bin_id` with the function names `funcs`.
+        Returns the function names that were not known for the pair.
+        """
+        row = self.bin_ids.append(bin_id)
+        t = self._tail_bin(row)
+        gene_row = self.gene_ids.append(gene_id)
+        fl = t.get(gene_row)
+        if fl is None:
+            fl = t[gene_row] = []
+            self._tail_g2b.setdefault(gene_row, []).append(row)
+            self._tail_slots += 1
+            refs = self._refs
+            if gene_row >= len(refs):
+                refs.extend([0] * (gene_row + 1 - len(refs)))
+            refs[gene_row] += 1
+            if refs[gene_row] == 1:
+                self._ngenes += 1
+        new = []
+        for func in funcs:
+            f = self.func_names.append(sys.intern(func))
+            if f not in fl:
+                fl.append(f)
+                new.append(func)
+        return new
+
+    def remove_bin(self, bin_id):
+        """
+        Removes `bin_id`. Returns the gene ids left without a bin.
+        """
+        row = self.bin_ids.row(bin_id)
+        if not self._alive(row):
+            return []
+        orphans = []
+        items = self._bin_items(row)
+        for gene_row, _ in items:
+            self._refs[gene_row] -= 1
+            if self._refs[gene_row] == 0:
+                self._ngenes -= 1
+                orphans.append(self.gene_ids[gene_row])
+        if row in self._tail:
+            self._tail_slots -= len(self._tail.pop(row))
+            for gene_row, _ in items:
+                rows = self._tail_g2b.get(gene_row, [])
+                if row in rows:
+                    rows.remove(row)
+                if len(rows) == 0:
+                    self._tail_g2b.pop(gene_row, None)
+        if row < self._nbase:
+            self._dead.add(row)
+        self._nbins -= 1
+        return orphans
+
+    # genes
+
+    def _gene_bin_rows(self, gene_row):
+        if gene_row is None or gene_row >= len(self._refs) or self._refs[gene_row] == 0:
+            return []
+        rows = []
+        if self._nbase:
+            if self._g2b_ptr is None:
+                self._build_g2b()
+            if gene_row + 1 < len(self._g2b_ptr):
+                a, b = self._g2b_ptr[gene_row], self._g2b_ptr[gene_row + 1]
+                rows = [x for x in self._g2b_bin[a:b].tolist() if x not in self._dead]
+        return rows + self._tail_g2b.get(gene_row, [])
+
+    def _build_g2b(self):
+        counts = np.diff(self._bin_ptr)
+        slot_bin = np.repeat(np.arange(self._nbase, dtype="int32"), counts)
+        order = np.argsort(self._slot_gene, kind="stable")
+        ngenes = int(self._slot_gene.max()) + 1 if len(self._slot_gene) else 0
+        ptr = np.zeros(ngenes + 1, dtype="int64")
+        np.cumsum(np.bincount(self._slot_gene, minlength=ngenes), out=ptr[1:])
+        self._g2b_bin = slot_bin[order]
+        self._g2b_ptr = ptr
+
+    # compaction and persistence
+
+    def maybe_compact(self):
+        if self._tail_slots + len(self._dead) > max(
+            GRAPH_COMPACT_MIN_SLOTS, len(self._slot_gene) // 2
+        ):
+            self.compact()
+
+    def compact(self):
+        """
+        Merges the tail into the arrays and drops the removed bins and the
+        genes and function names they leave unreferenced. Rows change.
+        """
+        if not self._tail and not self._dead:
+            return
+        rows = self._bin_rows()
+        nslots = np.zeros(len(rows), dtype="int64")
+        genes, nfuncs, funcs = [], [], []
+        for i, row in enumerate(rows):
+            t = self._tail.get(row)
+            if t is not None:
+                genes.append(np.fromiter(t.keys(), dtype="int32", count=len(t)))
+                nfuncs.append(np.array([len(x) for x in t.values()], dtype="int64"))
+                funcs.append(
+                    np.fromiter((f for x in t.values() for f in x), dtype="int32")
+                )
+                nslots[i] = len(t)
+            else:
+                a, b = int(self._bin_ptr[row]), int(self._bin_ptr[row + 1])
+                genes.append(self._slot_gene[a:b])
+                nfuncs.append(np.diff(self._slot_ptr[a : b + 1]))
+                funcs.append(self._slot_func[self._slot_ptr[a] : self._slot_ptr[b]])
+                nslots[i] = b - a
+
+        def concat(chunks, dtype):
+            return np.concatenate(chunks) if chunks else np.zeros(0, dtype=dtype)
+
+        slot_gene = concat(genes, "int32")
+        slot_func = concat(funcs, "int32")
+        nfuncs = concat(nfuncs, "int64")
+
+        # renumber the referenced genes and function names in row order
+        gene_rows = np.unique(slot_gene)
+        gene_map = np.zeros(len(self.gene_ids), dtype="int32")
+        gene_map[gene_rows] = np.arange(len(gene_rows), dtype="int32")
+        func_rows = np.unique(slot_func)
+        func_map = np.zeros(len(self.func_names), dtype="int32")
+        func_map[func_rows] = np.arange(len(func_rows), dtype="int32")
+
+        bin_ptr = np.zeros(len(rows) + 1, dtype="int64")
+        np.cumsum(nslots, out=bin_ptr[1:])
+        slot_ptr = np.zeros(len(slot_gene) + 1, dtype="int64")
+        np.cumsum(nfuncs, out=slot_ptr[1:])
+
+        self.bin_ids = DigestIDRegistry([self.bin_ids.digest(x) for x in rows])
+        self.gene_ids = DigestIDRegistry(
+            [self.gene_ids.digest(x) for x in gene_rows.tolist()]
+        )
+        self.func_names = GeneIDRegistry(
+            [self.func_names[x] for x in func_rows.tolist()]
+        )
+        self._set_base(
+            {
+                "bin_ptr": bin_ptr,
+                "slot_gene": gene_map[slot_gene],
+                "slot_ptr": slot_ptr,
+                "slot_func": func_map[slot_func],
+            }
+        )
+
+    def columns(self):
+        """
+        Returns the dict of column arrays, the id digest arrays and the function
+        names (`strings`), e.g. for writing an index. Compacts the graph.
+        """
+        self.compact()
+        return {
+            "bin_ptr": self._bin_ptr,
+            "slot_gene": self._slot_gene,
+            "slot_ptr": self._slot_ptr,
+            "slot_func": self._slot_func,
+            "bin_ids": ids_to_array(self.bin_ids.digests),
+            "gene_ids": ids_to_array(self.gene_ids.digests),
+            "strings": {"func_names": self.func_names.ids},
+        }
+
+    @classmethod
+    def from_columns(cls, columns):
+        # columns can be memory mapped arrays
+        graph = cls()
+        strings = columns["strings"]
+        for k in GRAPH_ID_COLUMNS:
+            if k in columns:
+                ids = ids_from_array(columns[k])
+            else:
+                ids = strings[k]  # hex strings of indexes written before
+            setattr(graph, k, DigestIDRegistry(ids))
+        graph.func_names = GeneIDRegistry(
+            [sys.intern(x) for x in strings["func_names"]]
+        )
+        graph._set_base({k: columns[k] for k in GRAPH_COLUMNS})
+        return graph
+
+    @classmethod
+    def from_bins(cls, bins):
+        # bins: {bin_id: {gene_id: func_names}}, e.g. of a legacy index
+        graph = cls()
+        for bin_id, genes in bins.items():
+            for gene_id, funcs in genes.items():
+                graph.add(bin_id, gene_id, funcs)
+        graph.compact()
+        return graph
+
+    def __repr__(self):
+        return "BinGeneGraph(bins=%d, genes=%d, func_names=%d)" % (
+            self._nbins,
+            self._ngenes,
+            len(self.func_names),
+        )
+
+
+class BinGenesView(collections.abc.Mapping):
+    """
+    Read-only `{gene_id: [func_name, ...]}` view of a bin. The row of the
+    bin is looked up on each access, as `compact` renumbers the rows.
+    """
+
+    def __init__(self, graph, bin_id):
+        self._graph = graph
+        self._bin_id = bin_id  # digest
+
+    @property
+    def _row(self):
+        return self._graph.bin_ids.row(self._bin_id)
+
+    def __getitem__(self, gene_id):
+        g = self._graph
+        funcs = g._bin_funcs(self._row, g.gene_ids.row(gene_id))
+        if funcs is None:
+            raise KeyError(gene_id)
+        return [g.func_names[x] for x in funcs]
+
+    def __contains__(self, gene_id):
+        g = self._graph
+        return g._bin_funcs(self._row, g.gene_ids.row(gene_id)) is not None
+
+    def __iter__(self):
+        g = self._graph
+        for gene_row, _ in g._bin_items(self._row):
+            yield g.gene_ids[gene_row]
+
+    def __len__(self):
+        return self._graph._bin_len(self._row)
+
+    def items(self):
+        g = self._graph
+        names = g.func_names
+        return [
+            (g.gene_ids[gene_row], [names[x] for x in funcs])
+            for gene_row, funcs in g._bin_items(self._row)
+        ]
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+
+class BinsView(collections.abc.Mapping):
+    """
+    Read-only `{bin_id: {gene_id: [func_name, ...]}}` view of the graph.
+    """
+
+    def __init__(self, graph):
+        self._graph = graph
+
+    def __getitem__(self, bin_id):
+        g = self._graph
+        row = g.bin_ids.row(bin_id)
+        if not g._alive(row):
+            raise KeyError(bin_id)
+        return BinGenesView(g, g.bin_ids.digest(row))
+
+    def __contains__(self, bin_id):
+        g = self._graph
+        return g._alive(g.bin_ids.row(bin_id))
+
+    def __iter__(self):
+        g = self._graph
+        for row in g._bin_rows():
+            yield g.bin_ids[row]
+
+    def __len__(self):
+        return self._graph._nbins
+
+
+class Gene2BinView(collections.abc.Mapping):
+    """
+    Read-only `{gene_id: [bin_id, ...]}` view of the graph.
+    """
+
+    def __init__(self, graph):
+        self._graph = graph
+
+    def __getitem__(self, gene_id):
+        g = self._graph
+        rows = g._gene_bin_rows(g.gene_ids.row(gene_id))
+        if len(rows) == 0:
+            raise KeyError(gene_id)
+        return [g.bin_ids[x] for x in rows]
+
+    def __contains__(self, gene_id):
+        g = self._graph
+        row = g.gene_ids.row(gene_id)
+        return row is not None and row < len(g._refs) and g._refs[row] > 0
+
+    def __iter__(self):
+        g = self._graph
+        for row, n in enumerate(g._refs):
+            if n:
+                yield g.gene_ids[row]
+
+    def __len__(self):
+        return self._graph._ngenes
@@ -41,14 +41,14 @@ of an in-memory Genome KG database until we shift to a real database backend. It
 """
 
 import collections
+import functools
 import getpass
-import hashlib
 import logging
 import os
-import pickle
 import re
 import sys
 import tempfile
+import threading
 import time
 
 import numpy as np
@@ -58,63 +58,50 @@ from sklearn.neighbors import BallTree
 from .._defaults import *
 from .._file_format import *
 from ..genes.utils import encode_gene, gene_similarity_by_ver
+from ..ids import id_hex
+from ..ingest import IngestContext
+from ..lifters.dsm import find_func_asm, get_func_asm
 from ..lifters.retdec import CGRetdec
 from ..pipelines import get_pipeline_by_version
+from ..utils import get_worker_count, parallel_map
+from .ann import DeltaGeneIndex, build_gene_index, index_size
+from .graph import GRAPH_COLUMNS, GRAPH_ID_COLUMNS, BinGeneGraph
+from .matching import (match_extra_genes, near_match_hits,
+                       optimal_match_extra_genes)
+from .store import GENE_STORE_COLUMNS, FuncNameIndex, GeneStore
 
 DB_GENE_DIR = "genes"
 DB_AUX_DIR = ".auxs"
 DB_LOG_DIR = ".logs"
-DB_INDEX_NAME = "index.gkg"
+DB_INDEX_NAME = "index.gkg"  # legacy single file index
+DB_INDEX_DIR = "index"
 NODE_IDKEY = "id"
 
+# GenomeKG attributes persisted as index sections, with their empty value
+INDEX_SECTIONS = {
+    "graph": BinGeneGraph,
+    "bin_metas": dict,
+    "genes": GeneStore,
+    "gene_tree": lambda: None,
+    "gene_files": dict,
+    "func_index": FuncNameIndex,
+}
+GENE_STORE_SECTION_PREFIX = "store."
+GRAPH_SECTION_PREFIX = "graph."
+LEGACY_GRAPH_SECTIONS = ["bins", "gene_2_bin"]  # dicts, replaced by the graph
+
 
 logger = logging.getLogger("codegenome.kg")
 
-RE_FUNC = re.compile(r"; function: ([_\w\d]+?) at (0x[0-9A-Fa-f]+) -- (0x[0-9A-Fa-f]+)")
-RE_FUNC_LINE = re.compile(r"(0x[0-9A-Fa-f]+):\s+([0-9A-Fa-f ]+)\s+(.+)")
-
-
-def get_func_asm(fn):
-    cur_func_meta = None
-    cur_func = []
-    func_matched = False
-    for l in open(fn):
-        l = l.strip()
-        if not func_matched:
-            m = RE_FUNC.match(l)
-            if m:
-                name, start_addr, end_addr = m.groups()
-                cur_func_meta = {
-                    "name": name,
-                    "start_addr": start_addr,
-                    "end_addr": end_addr,
-                }
-                func_matched = True
-            continue
-        else:
-            m = RE_FUNC_LINE.match(l)
-            if m:
-                addr, mcode, asm = m.groups()
-                cur_func.append(
-                    [addr, mcode.strip(), asm.strip()]
-                )  # {'addr': addr, 'mcode': mcode.strip(), 'asm': asm.strip()})
-            else:
-                func_matched = False
-                out_func = cur_func
-                out_func_meta = cur_func_meta
-                cur_func = []
-                # check if it's a function line
-                m = RE_FUNC.match(l)
-                if m:
-                    name, start_addr, end_addr = m.groups()
-                    cur_func_meta = {
-                        "name": name,
-                        "start_addr": start_addr,
-                        "end_addr": end_addr,
-                    }
-                    func_matched = True
-
-                yield {"metadata": out_func_meta, "asms": out_func}
+LOAD_PROGRESS_INTERVAL_SECS = 10
+
+
+def _read_gene_file_safe(path):
+    # `parallel_map` worker. Returns (path, genes, error)
+    try:
+        return path, read_gene_file(path), None
+    except Exception as ex:
+        return path, None, str(ex)
 
 
 class BinGene:
@@ -126,7 +113,7 @@ class BinGene:
         self.binid = binid
         self._genes = None  # dict of raw_genes keyed by gene_ids
         self.gene_id_2_func = None  # list of gene_ids
-        self.bcs = None  # IR bitcodes keyed by gene_ids
+        self._canon = None  # CanonFile of the IR bitcodes
         self._gene_ids = None  # cache of list of gene_ids
         self.gene_tree = None  # raw_gene search tree
         self._gkg = None
@@ -144,10 +131,11 @@ class BinGene:
             self._genes = {}
 
             genes = read_gene_file(source)
-            self.binid = genes["binid"]
+            self.binid = id_hex(genes["binid"])
             self.bin_meta = genes["file_meta"]
 
             for hs, func, fsg, meta in genes["genes"]:
+                hs = id_hex(hs)
                 self.gene_id_2_func[hs] = func
                 self._genes[hs] = (fsg, meta)
         else:
@@ -204,13 +192,11 @@ class BinGene:
         if self._canon_file is None:
             self._canon_file = self._get_canon_file_path()
 
-        self.bcs = {}
-        canon = read_canon_file(self._canon_file)
-        assert canon["binid"] == self.binid
-
-        for gid, _k, _bc, meta in canon["funcs"]:
-            gid = gid.lower()
-            self.bcs[gid] = _bc
+        if self._gkg is not None:
+            self._canon = self._gkg._canon_files.get(self._canon_file)
+        else:
+            self._canon = CanonFile(self._canon_file, use_mmap=CANON_FILE_MMAP)
+        assert self._canon.binid == self.binid
 
     def get_func_name(self, gid):
         # get function name by gene_id
@@ -243,15 +229,14 @@ class BinGene:
 
     def get_bc(self, x):
         # get IR bitcode by gene_id or function name
-        if self.bcs is None:
+        if self._canon is None:
             self._init_canon()
-        if self.bcs is not None:
-            if x in self.bcs:
-                return self.bcs[x]
-            elif x in self.func_2_gene:
-                return self.bcs[self.func_2_gene[x]]
-            else:
-                raise Exception("%s is not gene_id or function name." % (x))
+        if x in self._canon:
+            return self._canon.get_bc(x)
+        elif x in self.func_2_gene:
+            return self._canon.get_bc(self.func_2_gene[x])
+        else:
+            raise Exception("%s is not gene_id or function name." % (x))
 
     def get_ll(self, x):
         # lazy loading
@@ -374,15 +359,47 @@ class BinGene:
             f.write(str(llvm.parse_bitcode(self.get_bc(g1))))
 
 
+def _index_section(name):
+    """
+    GenomeKG attribute backed by an index section. The section is only read
+    from the index on first access.
+    """
+    attr = "_" + name
+
+    def fget(self):
+        if name in self._pending_sections:
+            with self._index_lock:
+                if name in self._pending_sections:
+                    setattr(self, attr, self._read_index_section(name))
+                    self._pending_sections.discard(name)
+        return getattr(self, attr)
+
+    def fset(self, value):
+        self._pending_sections.discard(name)
+        setattr(self, attr, value)
+
+    return property(fget, fset)
+
+
 class GenomeKG:
+    graph = _index_section("graph")
+    genes = _index_section("genes")
+    gene_tree = _index_section("gene_tree")
+    bin_metas = _index_section("bin_metas")
+    gene_files = _index_section("gene_files")
+    func_index = _index_section("func_index")
+
     def __init__(
         self,
         db_dir=None,
         gene_version=DEFAULT_GENE_VERSION,
         distance_metric="minkowski",
         aux_file_search_paths=[],
+        verify_index=True,
+        gene_index_type=GENE_INDEX_TYPE,
     ):
         self.distance_metric = distance_metric
+        self.gene_index_type = gene_index_type
         self._idkey = NODE_IDKEY
         default_dbdir = os.path.join(
             os.path.expanduser(os.environ.get("CG_CACHE_DIR", "~/.cg/cache")),
@@ -396,19 +413,30 @@ class GenomeKG:
         self.gene_version = gene_version
         self._pipeline = get_pipeline_by_version(gene_version)
 
-        self.bins = {}  # mapping of bin_id to corresponding gene_ids and func names.
-        # keys: bin_ids, values: dict{ gene_ids: list of func_names }
-        self.genes = collections.OrderedDict()  # dict of raw_genes keyed by gene_ids
-        self._gene_ids = None  # gene_id cache
-        self.gene_2_bin = {}  # mapping from gene_id to bin_id
+        self._index = None  # opened GKGIndexFile
+        self._pending_sections = set()  # index sections not loaded yet
+        self._index_lock = threading.RLock()
+        self._verify_index = verify_index
+
+        # bin -> gene -> func names graph. `bins` and `gene_2_bin` are views of it.
+        self.graph = BinGeneGraph()
+        # columnar raw_gene store keyed by gene_ids. Rows follow the gene_id registry.
+        self.genes = GeneStore()
         self.gene_tree = None  # raw_gene search tree
         self.bin_metas = {}  # binary metadata
+        # manifest of ingested .gene files. {file_name: (mtime_ns, size, bin_id)}
+        self.gene_files = {}
+        # function name -> [(gene_id, bin_id)], maintained with `bins`
+        self.func_index = FuncNameIndex()
         self.aux_file_search_paths = aux_file_search_paths
+        # open canon files of the bitcode reads
+        self._canon_files = CanonFileCache(CANON_FILE_MAX_OPEN, CANON_FILE_MMAP)
 
         self.re_h = re.compile("[a-z0-9]{64}")
         self.logger = logger
 
         self._index_fn = os.path.join(self._dbdir, DB_INDEX_NAME)
+        self._index_dir = os.path.join(self._dbdir, DB_INDEX_DIR)
         self._gene_dir = os.path.join(self._dbdir, DB_GENE_DIR, gene_version)
         self._aux_dir = os.path.join(self._dbdir, DB_AUX_DIR)
         self._log_dir = os.path.join(self._dbdir, DB_LOG_DIR)
@@ -422,81 +450,128 @@ class GenomeKG:
 
     @property
     def gene_ids(self):
-        if self._gene_ids is None:
-            self._gene_ids = list(self.genes.keys())
-        return self._gene_ids
+        return self.genes.ids
+
+    @property
+    def bins(self):
+        # read-only mapping of bin_id to corresponding gene_ids and func names.
+        # keys: bin_ids, values: dict{ gene_ids: list of func_names }
+        return self.graph.bins
+
+    @property
+    def gene_2_bin(self):
+        # read-only mapping from gene_id to bin_ids
+        return self.graph.gene_2_bin
+
+    def _invalidate_gene_ids(self):
+        # rows are only stable while genes are appended. The store compacts
+        # and rebuilds its registry on removal, so the tree rows are stale.
+        self.gene_tree = None
 
     def get_gene_ids(self, func, bin_id=False, include_bin_id=False):
-        # TODO create a func_2_gene map
-        out = set()
-        if bin_id:
-            v = self.bins.get(bin_id, {})
-            for gid, v2 in v.items():
-                if func in v2:
-                    if include_bin_id:
-                        out.add((gid, bin_id))
-                    else:
-                        out.add(gid)
+        refs = self.func_index.get(func, bin_id)
+        if include_bin_id:
+            return refs
+        return list(dict.fromkeys(gid for gid, _ in refs))
 
-        else:
-            for bid, v in self.bins.items():
-                for gid, v2 in v.items():
-                    if func in v2:
-                        if include_bin_id:
-                            out.add((gid, bid))
-                        else:
-                            out.add(gid)
-        return list(out)
+    def find_functions(self, pattern, bin_id=None):
+        """
+        Returns `{func_name: [(gene_id, bin_id), ...]}` of the functions
+        matching the glob `pattern`, e.g. `"main"`, `"ssl_*"` or `"f?[0-9]"`.
+        """
+        return self.func_index.find(pattern, bin_id)
 
     def get_bin_id(self, gid):
         if gid in self.gene_2_bin:
             return self.gene_2_bin[gid]
 
-    def serialize(self):
-        return [
-            self._dbdir,
-            self.bins,
-            self.genes,
-            self.gene_2_bin,
-            self.gene_tree,
-            self.bin_metas,
-        ]
-
     def deserialize(self, sdata):
+        # legacy (v0.3) index data
         (
             self._dbdir,
-            self.bins,
-            self.genes,
-            self.gene_2_bin,
+            bins,
+            genes,
+            _gene_2_bin,
             self.gene_tree,
             self.bin_metas,
         ) = sdata
-
-    def _get_index_file(self):
-        return
+        self.graph = BinGeneGraph.from_bins(bins)
+        self.genes = GeneStore.from_items(genes.items())
+        self.func_index = FuncNameIndex.from_bins(self.bins)
+
+    def _read_index_section(self, name):
+        if self._index is not None:
+            if name == "genes":
+                prefix = GENE_STORE_SECTION_PREFIX
+                if prefix + "genes" in self._index:
+                    return GeneStore.from_columns(
+                        {k: self._index.load(prefix + k) for k in GENE_STORE_COLUMNS}
+                    )
+            elif name == "graph":
+                prefix = GRAPH_SECTION_PREFIX
+                if prefix + "strings" in self._index:
+                    return BinGeneGraph.from_columns(
+                        {
+                            k: self._index.load(prefix + k)
+                            for k in GRAPH_COLUMNS + GRAPH_ID_COLUMNS + ["strings"]
+                            if prefix + k in self._index
+                        }
+                    )
+                elif "bins" in self._index:
+                    # index written before the graph existed
+                    return BinGeneGraph.from_bins(self._index.load("bins"))
+            elif name in self._index:
+                return self._index.load(name)
+            elif name == "func_index":
+                # index written before the section existed
+                return FuncNameIndex.from_bins(self.bins)
+        return INDEX_SECTIONS[name]()
+
+    def _has_index(self):
+        return os.path.isdir(self._index_dir) or os.path.isfile(self._index_fn)
 
     def load_index(self, inf=None):
+        """
+        Opens the index. Sections are loaded on first access of the
+        corresponding attribute.
+        """
         if inf is None:
-            inf = self._index_fn
-        if os.path.exists(inf):
+            inf = self._index_dir if os.path.isdir(self._index_dir) else self._index_fn
+
+        if os.path.isdir(inf):
+            self._index = GKGIndexFile(inf, verify=self._verify_index)
+            self._pending_sections = set(INDEX_SECTIONS.keys())
+            return True
+        elif os.path.isfile(inf):
             data = read_gkg_file(inf)
             self.deserialize(data["data"])
+            return True
+        return False
+
+    def _index_sections(self, genes=True):
+        sections = {
+            "bin_metas": self.bin_metas,
+            "gene_files": self.gene_files,
+            "func_index": self.func_index,
+        }
+        for k, v in self.graph.columns().items():
+            sections[GRAPH_SECTION_PREFIX + k] = v
+        if genes:
+            for k, v in self.genes.columns().items():
+                sections[GENE_STORE_SECTION_PREFIX + k] = v
+            if self.gene_tree is not None:
+                sections["gene_tree"] = self.gene_tree
+        return sections
 
     def save_index(self, outf=None):
         assert os.path.isdir(self._dbdir)
         if outf is None:
-            outf = self._index_fn
-        data = prep_gkg_file(self)
-
-        joblib.dump(data, outf, compress=False, protocol=pickle.HIGHEST_PROTOCOL)
-        return outf
+            outf = self._index_dir
+        return write_gkg_index(outf, self._index_sections())
 
     def get_gene(self, gene_id):
         # get raw gene by gene_id
-        if gene_id in self.genes:
-            return self.genes[gene_id][0]
-        else:
-            return None
+        return self.genes.get_gene(gene_id)
 
     def get_gene_info(
         self,
@@ -543,10 +618,7 @@ class GenomeKG:
         return out
 
     def get_gene_size(self, gene_id):
-        if gene_id in self.genes:
-            return self.genes[gene_id][1]
-        else:
-            return None
+        return self.genes.get_meta(gene_id)
 
     def get_gene_maps(self, gene_id, limit=10):
         # get gene maps (all the bin_ids along with all genes associated with them) by gene_id
@@ -593,11 +665,7 @@ class GenomeKG:
             binid = self.gene_2_bin[gene_id][0]
             cpath = self._get_canon_file_path(binid)
             if cpath:
-                with open(cpath, "rb") as f:
-                    canon = pickle.load(f)
-                    for _gid, _k, _bc, _meta in canon["funcs"]:
-                        if _gid.lower() == gene_id:
-                            return _bc
+                return self._canon_files.get(cpath).get_bc(gene_id)
         return None
 
     def get_ll(self, x):
@@ -620,45 +688,21 @@ class GenomeKG:
                     func_name = func_names[-1]
             cpath = self._get_asm_file_path(bin_id)
             if cpath and func_name:
-                for fobj in get_func_asm(cpath):
-                    if func_name == fobj.get("metadata").get("name"):
-                        return fobj
+                return find_func_asm(cpath, name=func_name)
 
         return None
 
     def get_bin(self, binid):
         return BinGene(binid, source=self)
 
-    def _upsort(self, binid, gid, funcs, raw_gene, sz):
-        if binid in self.bins:
-            bn = self.bins[binid]
-        else:
-            bn = self.bins[binid] = {}
-
-        if gid in bn:
-            fns = bn[gid]
-        else:
-            fns = bn[gid] = []
-
-        for func in funcs:
-            if func not in fns:
-                fns.append(func)
-
-        # update genes
-        if gid not in self.genes:
-            self.genes[gid] = (raw_gene, sz)
-
-        # update cache
-        self._gene_ids = list(self.genes.keys())
+    def _upsort(self, binid, gid, funcs, raw_gene=None, sz=None):
+        # updates `bins` and the `gene_2_bin` reverse map
+        new_funcs = self.graph.add(binid, gid, funcs)
+        self.func_index.add(binid, gid, new_funcs)
 
-        # update reverse map
-        if gid in self.gene_2_bin:
-            bns = self.gene_2_bin[gid]
-        else:
-            bns = self.gene_2_bin[gid] = []
-
-        if binid not in bns:
-            bns.append(binid)
+        # update genes. raw_gene is None if the caller adds genes in bulk.
+        if raw_gene is not None:
+            self.genes.add(gid, raw_gene, sz)
         return True
 
     def delete_file(self, file_id):
@@ -682,6 +726,7 @@ class GenomeKG:
                 os.remove(gene_fn)
             except Exception as ex:
                 logger.error(f"Error removing file {file_fn}")
+        self.gene_files.pop(os.path.basename(gene_fn), None)
 
         # clear aux files
         for fn in os.listdir(self._aux_dir):
@@ -691,21 +736,36 @@ class GenomeKG:
                 except:
                     pass
 
-        if file_id in self.bin_metas:
-            self.bin_metas.pop(file_id)
-        if file_id in self.bins:
-            self.bins.pop(file_id)
+        self._remove_bin(file_id)
 
         return status
 
+    def _remove_bin(self, binid):
+        if binid in self.bin_metas:
+            self.bin_metas.pop(binid)
+        if binid in self.bins:
+            return self._remove_bin_genes(binid)
+        return []
+
+    def _remove_bin_genes(self, binid):
+        # drop the bin and any gene not referenced by other bins
+        self.func_index.remove_bin(binid, self.bins[binid])
+        orphans = self.graph.remove_bin(binid)
+        self.graph.maybe_compact()
+
+        if self.genes.remove(orphans):
+            self._invalidate_gene_ids()
+        return orphans
+
     def add_file(self, file_path, overwrite=False, keep_aux_files=True):
         # TODO move to pipeline
-        if not os.path.exists(file_path):
-            self.logger.error(f"File does not exist. {file_path}.")
+        # `file_path` can be an `IngestContext` with an already computed bin_id
+        ctx = IngestContext.of(file_path)
+        if not os.path.exists(ctx.file_path):
+            self.logger.error(f"File does not exist. {ctx.file_path}.")
             return False
 
-        with open(file_path, "rb") as f:
-            bin_id = hashlib.sha256(f.read()).hexdigest()
+        bin_id = ctx.bin_id
 
         dst = os.path.join(self._gene_dir, bin_id + ".gene")
 
@@ -714,10 +774,27 @@ class GenomeKG:
                 self.logger.warning(f"Genes already processed.")
                 genes = read_gene_file(dst)
                 self._add_bin_genes(genes)
+                self._track_gene_file(dst, bin_id)
                 return bin_id
 
+        genes = self.genify_file(ctx, keep_aux_files=keep_aux_files)
+        if genes:
+            self._add_bin_genes(genes)
+            self._track_gene_file(dst, bin_id)
+            return bin_id
+        else:
+            return None
+
+    def genify_file(self, file_path, keep_aux_files=True):
+        """
+        Runs the gene pipeline on `file_path` and writes its .gene file to the
+        gene directory, without adding the genes to the KG. Returns the genes,
+        or None if the processing failed.
+        """
+        ctx = IngestContext.of(file_path)
+        bin_id = ctx.bin_id
         genes = self._pipeline.process_file(
-            file_path,
+            ctx,
             output_dir=self._aux_dir,
             output_fname=bin_id,
             keep_aux_files=keep_aux_files,
@@ -726,83 +803,243 @@ class GenomeKG:
             return_genes=True,
             keep_gene_file=True,
         )
-        if genes:
-            src = os.path.join(self._aux_dir, bin_id + ".gene")
-            os.rename(src, dst)
-            self._add_bin_genes(genes)
-            return bin_id
-        else:
+        if not genes:
             return None
+        src = os.path.join(self._aux_dir, bin_id + ".gene")
+        os.rename(src, self._get_gene_file_path(bin_id))
+        return genes
 
     def _add_bin_genes(self, genes):
-        binid = genes["binid"]
-        bmeta = self.bin_metas.setdefault(binid, [])
-        bmeta.append(genes["file_meta"])
-        for hs, func, fsg, gn_meta in genes["genes"]:
-            self._upsort(binid, hs, func, fsg, gn_meta)
+        return self._add_bins_genes([genes])
+
+    def _add_bins_genes(self, genes_list):
+        # batch version of `_add_bin_genes`. Raw genes are appended in bulk.
+        new_genes = []
+        for genes in genes_list:
+            binid = id_hex(genes["binid"])
+            bmeta = self.bin_metas.setdefault(binid, [])
+            bmeta.append(genes["file_meta"])
+            for hs, func, fsg, gn_meta in genes["genes"]:
+                self._upsort(binid, hs, func)
+                new_genes.append((hs, fsg, gn_meta))
+        self.graph.maybe_compact()
+        start = len(self.genes)
+        n = self.genes.extend(new_genes)
+        if n > 0:
+            self._append_gene_tree(start)
+        return n
+
+    def _append_gene_tree(self, start):
+        # new genes take the store rows from `start`. They go to the delta
+        # buffer of the gene search index, so it does not need a rebuild.
+        tree = self.gene_tree
+        if tree is None:
+            return
+        if index_size(tree) != start:
+            self.logger.warning("Gene tree is out of sync with the genes. Dropping.")
+            self.gene_tree = None
+            return
+        if not isinstance(tree, DeltaGeneIndex):
+            builder = functools.partial(
+                build_gene_index,
+                metric=self.distance_metric,
+                index_type=self.gene_index_type,
+            )
+            tree = self.gene_tree = DeltaGeneIndex(tree, self.distance_metric, builder)
+        tree.add(
+            self.genes.matrix(np.arange(start, len(self.genes))),
+            source=self.genes.head,
+        )
 
     def _get_gene_file_path(self, bin_id):
         return os.path.join(self._gene_dir, bin_id + ".gene")
 
+    def _track_gene_file(self, path, bin_id):
+        st = os.stat(path)
+        self.gene_files[os.path.basename(path)] = (st.st_mtime_ns, st.st_size, bin_id)
+
+    def _scan_gene_files(self):
+        out = {}
+        with os.scandir(self._gene_dir) as it:
+            for e in it:
+                if e.is_file() and e.name.strip().lower().split(".")[-1] == "gene":
+                    st = e.stat()
+                    out[e.name] = (st.st_mtime_ns, st.st_size)
+        return out
+
     def _load_bin_genes(self, bin_id):
         fn = self._get_gene_file_path(bin_id)
         if os.path.exists(fn):
             self.logger.debug("Reading: " + fn)
             genes = read_gene_file(fn)
             self._add_bin_genes(genes)
+            self._track_gene_file(fn, bin_id)
             return True
         return False
 
-    def load(self, update=True):
-        if os.path.exists(self._index_fn):
+    def load(
+        self,
+        update=True,
+        incremental=False,
+        workers=GENE_LOAD_WORKERS,
+        batch_size=GENE_LOAD_BATCH_SIZE,
+        progress=None,
+    ):
+        """
+        Loads the KG. With `update=False` the saved index is used if available.
+        With `incremental=True` the saved index is updated with the changes of
+        the genes directory (see `refresh_index`), or written after a full load
+        if there is none yet.
+        Otherwise all the .gene files are decoded by `workers` processes and
+        streamed into the KG in batches of `batch_size` files. Corrupt files are
+        skipped. `progress` is an optional callback receiving the load stats.
+        """
+        if self._has_index():
             if not update:
-                self.load_index()
+                return self.load_index()
+            if incremental:
+                self.refresh_index(workers, batch_size, progress)
                 return True
 
         dbdir = self._gene_dir
-        for fn in os.listdir(dbdir):
+        paths = []
+        for fn in sorted(os.listdir(dbdir)):
             ext = fn.strip().lower().split(".")[-1]
             if ext == "gene":
-                try:
-                    fn = os.path.join(dbdir, fn)
-                    self.logger.debug("Reading: " + fn)
-                    genes = read_gene_file(fn)
-                    binid = genes["binid"]
-
-                    if binid in self.bin_metas:
-                        bmeta = self.bin_metas[binid]
-                    else:
-                        bmeta = self.bin_metas[binid] = []
-                    bmeta.append(genes["file_meta"])
-
-                    for hs, func, fsg, gn_meta in genes["genes"]:
-                        self._upsort(binid, hs, func, fsg, gn_meta)
+                paths.append(os.path.join(dbdir, fn))
 
-                except Exception as e:
-                    print(e)
-                    self.logger.error("ERR:" + str(e))
-                    return False
+        self._load_gene_files(paths, workers, batch_size, progress)
+        if incremental:
+            # the next incremental load only reads the changed files
+            self.save_index()
         return True
 
-    def compute_tree(self, metric=None):
+    def refresh_index(
+        self, workers=GENE_LOAD_WORKERS, batch_size=GENE_LOAD_BATCH_SIZE, progress=None
+    ):
+        """
+        Opens the saved index and diffs its manifest against the genes
+        directory using file mtime and size. Only the added (or modified) .gene
+        files are read and only the removed ones are dropped. Then only the
+        changed index sections are rewritten.
+        Falls back to a full rebuild if the index has no manifest.
+        Returns a dict of `added` and `removed` file counts.
+        """
+        if self._index is None:
+            self.load_index()
+        if self._index is None or "gene_files" not in self._index:
+            self.logger.info("Index has no gene file manifest. Rebuilding.")
+            for name, empty in INDEX_SECTIONS.items():
+                setattr(self, name, empty())
+            self.load(
+                update=True, workers=workers, batch_size=batch_size, progress=progress
+            )
+            self.save_index()
+            return {"added": len(self.gene_files), "removed": 0}
+
+        current = self._scan_gene_files()
+        known = self.gene_files
+        removed = [k for k, v in known.items() if current.get(k) != tuple(v[:2])]
+        added = [k for k, v in current.items() if k not in known or k in removed]
+        self.logger.info(f"Index refresh. added: {len(added)}, removed: {len(removed)}")
+        if len(added) == 0 and len(removed) == 0:
+            return {"added": 0, "removed": 0}
+
+        gene_count = len(self.genes)
+        genes_changed = False
+        for k in removed:
+            if self._remove_bin(known.pop(k)[2]):
+                genes_changed = True
+
+        paths = [os.path.join(self._gene_dir, k) for k in sorted(added)]
+        self._load_gene_files(paths, workers, batch_size, progress)
+        genes_changed = genes_changed or len(self.genes) != gene_count
+
+        remove = list(LEGACY_GRAPH_SECTIONS)
+        if genes_changed and self.gene_tree is None:
+            # invalidated by removed genes. Added genes are appended to the tree.
+            remove.append("gene_tree")
+        sections = self._index_sections(genes=genes_changed)
+        write_gkg_index(self._index_dir, sections, replace=False, remove=remove)
+        return {"added": len(added), "removed": len(removed)}
+
+    def _load_gene_files(self, paths, workers, batch_size, progress=None):
+        workers = min(get_worker_count(workers), max(1, len(paths) // batch_size))
+        stats = {"total": len(paths), "files": 0, "skipped": 0, "genes": 0}
+        self.logger.info(f"Loading {len(paths)} gene files using {workers} workers.")
+
+        st = last = time.time()
+        batch = []
+
+        def _flush():
+            stats["genes"] += self._add_bins_genes([x[1] for x in batch])
+            stats["files"] += len(batch)
+            for path, genes in batch:
+                self._track_gene_file(path, id_hex(genes["binid"]))
+            del batch[:]
+
+        for path, genes, err in parallel_map(
+            _read_gene_file_safe, paths, workers, chunk_size=batch_size
+        ):
+            if genes is None:
+                stats["skipped"] += 1
+                self.logger.error(f"Skipping gene file {path}. {err}")
+            else:
+                batch.append((path, genes))
+                if len(batch) >= batch_size:
+                    _flush()
+
+            t = time.time()
+            if t - last >= LOAD_PROGRESS_INTERVAL_SECS:
+                last = t
+                self._log_load_progress(stats, t - st, progress)
+        _flush()
+        self._log_load_progress(stats, time.time() - st, progress)
+        return stats
+
+    def _log_load_progress(self, stats, t, progress=None):
+        stats["time"] = t
+        stats["files_per_sec"] = stats["files"] / t if t > 0 else 0.0
+        stats["genes_per_sec"] = stats["genes"] / t if t > 0 else 0.0
+        self.logger.info(
+            "Loaded %d/%d gene files (%d skipped), %d new genes in %f secs. %.1f files/sec, %.1f genes/sec"
+            % (
+                stats["files"],
+                stats["total"],
+                stats["skipped"],
+                stats["genes"],
+                t,
+                stats["files_per_sec"],
+                stats["genes_per_sec"],
+            )
+        )
+        if progress:
+            progress(dict(stats))
+
+    def compute_tree(self, metric=None, index_type=None, **params):
+        """
+        Builds the gene search index. `index_type` is one of
+        `ann.GENE_INDEX_TYPES`, `params` are passed to the index.
+        """
         if metric is None:
             metric = self.distance_metric
+        if index_type is None:
+            index_type = self.gene_index_type
         self.logger.debug(
-            "Calculating Gene tree of size: %d, metric: %s" % (len(self.genes), metric)
+            "Calculating Gene tree of size: %d, metric: %s, type: %s"
+            % (len(self.genes), metric, index_type)
         )
         t = time.time()
-        all_g = np.vstack([x[0] for x in self.genes.values()])
+        # matrix rows follow the gene_id registry rows
+        all_g = self.genes.matrix()
         t = time.time() - t
         self.logger.debug("Matrix creation done in %f secs" % t)
 
         t = time.time()
-        if metric == "cosine":
-            metric = "pyfunc"
-            args = {"metric": metric, "func": distance.cosine}
-        else:
-            args = {"metric": metric}
-
-        self.gene_tree = BallTree(all_g, **args)
+        builder = functools.partial(
+            build_gene_index, metric=metric, index_type=index_type, **params
+        )
+        self.gene_tree = DeltaGeneIndex(builder(all_g), metric, builder)
 
         t = time.time() - t
         self.logger.debug("Gene tree creation done in %f secs" % t)
@@ -934,39 +1171,47 @@ class GenomeKG:
                     "error": f"Not an executable file or no function level gene found for the file '{fnode['metadata.name']}'. NodeID: '{fnode['id']}'"
                 }, {}
 
-        genes1 = self.get_file2genes(
-            node_id1,
-            gene_version,
-            limit=MAX_GENES_PER_FILE_COMPARE,
-            return_edges=True,
-            min_gene_size=MIN_GENE_SIZE_FILE_COMPARE,
-        )
-        genes2 = self.get_file2genes(
-            node_id2,
-            gene_version,
-            limit=MAX_GENES_PER_FILE_COMPARE,
-            return_edges=True,
-            min_gene_size=MIN_GENE_SIZE_FILE_COMPARE,
-        )
+        genes1 = self._file_compare_genes(node_id1, gene_version)
+        genes2 = self._file_compare_genes(node_id2, gene_version)
 
         t2 = time.time()
+        results, t3 = self._compare_file_genes(
+            genes1, genes2, match_sim_thr, mismatch_sim_thr, method
+        )
+        t4 = time.time()
 
-        g1dict, e1dict = {x["id"]: x for x in genes1[0]}, {
-            x["to"]: x for x in genes1[1]
-        }
-        g2dict, e2dict = {x["id"]: x for x in genes2[0]}, {
-            x["to"]: x for x in genes2[1]
+        stats = {
+            "main_query_time": t2 - t1,
+            "dist_compute_time": t3 - t2,
+            "result_prep_time": t4 - t3,
         }
 
-        def get_func_dict(edges, fdict):
-            for x in edges:
-                gid = x["to"]
-                for func in x.get("func_names", []):
-                    fdict[func] = gid
-            return fdict
+        return results, stats
 
-        f1dict = get_func_dict(genes1[1], {})
-        f2dict = get_func_dict(genes2[1], {})
+    def _file_compare_genes(self, node_id, gene_version):
+        # (gene_id: gene, gene_id: edge, func_name: gene_id) dicts of a file
+        genes, edges = self.get_file2genes(
+            node_id,
+            gene_version,
+            limit=MAX_GENES_PER_FILE_COMPARE,
+            return_edges=True,
+            min_gene_size=MIN_GENE_SIZE_FILE_COMPARE,
+        )
+        fdict = {}
+        for x in edges:
+            for func in x.get("func_names", []):
+                fdict[func] = x["to"]
+        return {x["id"]: x for x in genes}, {x["to"]: x for x in edges}, fdict
+
+    def _compare_file_genes(
+        self, genes1, genes2, match_sim_thr, mismatch_sim_thr, method, details=True
+    ):
+        """
+        Matches the `_file_compare_genes` of two files. Returns the results
+        dict, with the diff rows if `details`, and the end time of the matching.
+        """
+        g1dict, e1dict, _ = genes1
+        g2dict, e2dict, f2dict = genes2
 
         match = set(g1dict).intersection(set(g2dict))
         g1extra = list(set(g1dict) - match)
@@ -977,73 +1222,22 @@ class GenomeKG:
             f"g1count: {len(g1dict)}, g2count: {len(g2dict)}, match: {len(match)}"
         )
 
-        # g2extra_genes = {g2dict[x]['id']]:decode_gene_by_ver(g2dict[x] for x in g2extra}
-        xmatch = []
-        xdel = []
-        xadd = []
-        xmismatch = []
-        for g1id in g1extra:
-            best_match_id = None
-            best_match_sim = 0.0
-
-            # try function name heuristics first
-            f1s = e1dict.get(g1id).get("func_names", [])
-            func_match = None
-            for f1 in f1s:
-                g2id = f2dict.get(f1)
-                if g2id:
-                    best_match_id = g2id
-                    best_match_sim = gene_similarity_by_ver(
-                        g1dict[g1id], g2dict[g2id], adjusted=False, normalized=True
-                    )
-                    if best_match_sim >= match_sim_thr:
-                        xmatch.append([g1id, best_match_id, best_match_sim])
-                        if best_match_id in g2extra:
-                            g2extra.remove(
-                                best_match_id
-                            )  # remove it so it does not match for next
-                        func_match = True
-                        break
-                    func_match = False
-
-            if func_match is not None:
-                # do not consider address based func name for negative match
-                if not f1.startswith("function_"):
-                    if func_match == False:
-                        if (
-                            best_match_sim > mismatch_sim_thr
-                        ):  # if the genes are not too diff
-                            xmismatch.append([g1id, g2id, best_match_sim])
-                        else:
-                            xdel.append([g1id, best_match_id, best_match_sim])
-                            xadd.append([g2id, best_match_sim])
-                        if g2id in g2extra:
-                            g2extra.remove(
-                                g2id
-                            )  # remove it so it does not match for next
-                    continue
-
-            if best_match_sim < match_sim_thr:
-                # compare all
-                for g2id in g2extra:
-                    sim = gene_similarity_by_ver(
-                        g1dict[g1id], g2dict[g2id], adjusted=False, normalized=True
-                    )
-                    if best_match_sim is None:
-                        best_match_sim = sim
-                        best_match_id = g2id
-                    elif best_match_sim < sim:
-                        best_match_sim = sim
-                        best_match_id = g2id
-
-            if best_match_sim >= match_sim_thr:
-                xmatch.append([g1id, best_match_id, best_match_sim])
-                if best_match_id in g2extra:
-                    g2extra.remove(
-                        best_match_id
-                    )  # remove it so it does not match for next
-            else:
-                xdel.append([g1id, best_match_id, best_match_sim])
+        if method.endswith(OPTIMAL_CALCULATION_METHOD_SUFFIX):
+            method = method[: -len(OPTIMAL_CALCULATION_METHOD_SUFFIX)]
+            xmatch, xmismatch, xdel, xadd, g2extra = optimal_match_extra_genes(
+                g1extra, g2extra, g1dict, g2dict, match_sim_thr, mismatch_sim_thr
+            )
+        else:
+            xmatch, xmismatch, xdel, xadd, g2extra = match_extra_genes(
+                g1extra,
+                g2extra,
+                g1dict,
+                g2dict,
+                e1dict,
+                f2dict,
+                match_sim_thr,
+                mismatch_sim_thr,
+            )
 
         t3 = time.time()
         self.logger.info(
@@ -1090,27 +1284,28 @@ class GenomeKG:
                 row = {"op": op, "f1": "", "f2": f2, "score": score, "g1": "", "g2": m}
                 out.append(row)
 
-        for m in match:
-            append_match_rows(m, m, "=", 100)
+        if details:
+            for m in match:
+                append_match_rows(m, m, "=", 100)
 
-        for m1, m2, score in xmatch:
-            append_match_rows(m1, m2, "~", int(score * 100))
+            for m1, m2, score in xmatch:
+                append_match_rows(m1, m2, "~", int(score * 100))
 
-        out.sort(key=lambda x: x["f1"])
+            out.sort(key=lambda x: x["f1"])
 
-        for m1, m2, score in xmismatch:
-            append_match_rows(m1, m2, "!", int(score * 100))
+            for m1, m2, score in xmismatch:
+                append_match_rows(m1, m2, "!", int(score * 100))
 
-        for m1, m2, score in xdel:
-            append_nomatch_rows(m1, "-", int(score * 100))
+            for m1, m2, score in xdel:
+                append_nomatch_rows(m1, "-", int(score * 100))
 
-        # remaining g2extra is addition
-        xadd_ids = [x[0] for x in xadd]
-        for x in g2extra:
-            if x not in xadd_ids:
-                xadd.append([x, 0.0])
-        for x, score in xadd:
-            append_nomatch_rows(x, "+", int(score * 100))
+            # remaining g2extra is addition
+            xadd_ids = [x[0] for x in xadd]
+            for x in g2extra:
+                if x not in xadd_ids:
+                    xadd.append([x, 0.0])
+            for x, score in xadd:
+                append_nomatch_rows(x, "+", int(score * 100))
 
         lm, lxm, ld, lr = len(match), len(xmatch), len(xdel), len(g2extra)
         mcount = lm + lxm
@@ -1149,18 +1344,168 @@ class GenomeKG:
             "similarity": int(100 * (1.0 - dist)),
             "jaccard_distance": round(dist, 2),
             "matches": metadata,
-            "diff_details": out,
         }
+        if details:
+            results["diff_details"] = out
+        return results, t3
+
+    def _file_gene_rows(self, node_id, min_gene_size=MIN_GENE_SIZE_FILE_COMPARE):
+        # (gene_ids, store rows, bc_sizes) of the file genes used by the compares
+        if node_id not in self.bins:
+            self._load_bin_genes(node_id)
+        gids = list(self.bins.get(node_id, {}))
+        rows = self.genes.rows(gids)
+        sizes = self.genes.bc_sizes(rows)
+        if min_gene_size > 0 and len(gids):
+            keep = (sizes == 0) | (sizes >= min_gene_size)
+            gids = [x for x, k in zip(gids, keep) if k]
+            rows, sizes = rows[keep], sizes[keep]
+        return gids, rows, sizes
+
+    def files_compare_one_to_many(
+        self,
+        node1,
+        nodes=None,
+        match_sim_thr=FILE_COMPARE_FUNC_MATCH_SIM_THRESHOLD,
+        mismatch_sim_thr=FILE_COMPARE_FUNC_MISMATCH_SIM_THRESHOLD,
+        method="jaccard_distance_w",
+        top_k=0,
+        batch_genes=FILE_COMPARE_BATCH_GENES,
+        rescore_factor=FILE_COMPARE_RESCORE_FACTOR,
+    ):
+        """
+        Ranks the files of `nodes` (default: all the other files) by similarity
+        to file `node1`. Returns a list of `(node_id, results)` tuples, the
+        `top_k` most similar only if `top_k > 0`. `method` is one of
+        `RANKING_CALCULATION_METHODS`.
+
+        The candidates are first ranked by an estimate of their similarity,
+        counting near matches without pairing the functions: the query genes
+        are prepared once and the candidate genes are scored in stacked batches
+        of about `batch_genes` genes. Then the `rescore_factor * top_k` best
+        candidates (all of them if `top_k` is 0) are scored by the pairwise
+        compare of `files_compare_by_shared_genes`, reusing the query gene
+        matrix, and ranked by that similarity. `results` are the pairwise
+        compare results without the diff details, plus the
+        `candidate_similarity` estimate. With `top_k > 0`, a file whose estimate
+        is not among the rescored ones is not returned even if its pairwise
+        similarity is higher.
+        """
+        if method not in RANKING_CALCULATION_METHODS:
+            raise ValueError(
+                f"Unsupported method: {method}. Allowed methods: {RANKING_CALCULATION_METHODS}"
+            )
 
-        t4 = time.time()
+        node_id1 = node1[self._idkey] if type(node1) == dict else node1
+        t1 = time.time()
+        gids1, rows1, sizes1 = self._file_gene_rows(node_id1)
+        if len(gids1) == 0:
+            raise Exception(f"No function level gene found for file id {node_id1}")
+        raw1 = self.genes.matrix(rows1)
+        bounds = self._files_similarity_bounds(
+            node_id1,
+            gids1,
+            raw1.astype("float64"),
+            sizes1,
+            nodes,
+            match_sim_thr,
+            method,
+            batch_genes,
+        )
+        if top_k > 0:
+            bounds = bounds[: rescore_factor * top_k]
+        t2 = time.time()
 
-        stats = {
-            "main_query_time": t2 - t1,
-            "dist_compute_time": t3 - t2,
-            "result_prep_time": t4 - t3,
-        }
+        # the query genes of the pairwise compares are the rows of its matrix
+        genes1 = self._file_compare_genes(node_id1, self.gene_version)
+        index1 = {x: i for i, x in enumerate(gids1)}
+        genes1 = (
+            {k: dict(v, value=raw1[index1[k]]) for k, v in genes1[0].items()},
+        ) + genes1[1:]
+        scored = []
+        for bound, node_id in bounds:
+            genes2 = self._file_compare_genes(node_id, self.gene_version)
+            results, _ = self._compare_file_genes(
+                genes1, genes2, match_sim_thr, mismatch_sim_thr, method, details=False
+            )
+            results["candidate_similarity"] = int(100 * bound)
+            scored.append((node_id, results))
+        scored.sort(key=lambda x: (-x[1]["similarity"], x[1]["jaccard_distance"], x[0]))
+        if top_k > 0:
+            scored = scored[:top_k]
+        self.logger.info(
+            f"files_compare_one_to_many({node_id1}): {len(bounds)} files rescored in {time.time() - t2:.2f}s, bounds in {t2 - t1:.2f}s"
+        )
+        return scored
 
-        return results, stats
+    def _files_similarity_bounds(
+        self, node_id1, gids1, m1, sizes1, nodes, match_sim_thr, method, batch_genes
+    ):
+        # (similarity estimate, node_id) of the files, best first
+        if method.endswith(OPTIMAL_CALCULATION_METHOD_SUFFIX):
+            method = method[: -len(OPTIMAL_CALCULATION_METHOD_SUFFIX)]
+        index1 = {x: i for i, x in enumerate(gids1)}
+        if nodes is None:
+            nodes = [x for x in self.bins if x != node_id1]
+
+        scored = []
+
+        def score(node_id, exact, n2, rows, cols, extra2_size):
+            # exact: rows of the query genes in the candidate
+            lm = len(exact)
+            n1x, n2x = len(gids1) - lm, n2 - lm
+            mcount = lm + min(rows.sum(), cols)
+            tot = len(gids1) + n2 - mcount
+            if method == "jaccard_distance":
+                sim = float(mcount) / tot if tot else 0.0
+            else:
+                # the near matched query genes, scaled down to the matched count
+                xm = mcount - lm
+                msize = float(sizes1[exact].sum())
+                if xm:
+                    msize += float(sizes1[rows].sum()) * xm / rows.sum()
+                q_tot = float(sizes1.sum())
+                if n2x:
+                    q_tot += extra2_size * (n2x - xm) / n2x
+                sim = msize / q_tot if q_tot else 0.0
+            scored.append((sim, node_id))
+
+        def flush(batch):
+            starts = np.cumsum([0] + [len(x[3]) for x in batch[:-1]])
+            m2 = self.genes.matrix(np.concatenate([x[3] for x in batch]))
+            hits, cols = near_match_hits(
+                m1, m2.astype("float64"), starts, match_sim_thr
+            )
+            for j, (node_id, exact, n2, _, extra2_size) in enumerate(batch):
+                rows = hits[:, j]
+                rows[exact] = False  # their candidate gene is an exact match
+                score(node_id, exact, n2, rows, int(cols[j]), extra2_size)
+
+        batch, batch_size = [], 0
+        no_rows = np.zeros(len(gids1), dtype=bool)
+        for node_id in nodes:
+            if node_id == node_id1:
+                continue
+            gids2, rows2, sizes2 = self._file_gene_rows(node_id)
+            if len(gids2) == 0:
+                continue
+            shared = [index1.get(x) for x in gids2]
+            extra = np.array([x is None for x in shared], dtype=bool)
+            exact = np.array([x for x in shared if x is not None], dtype="int64")
+            extra2_size = float(sizes2[extra].sum())
+            if not extra.any():
+                score(node_id, exact, len(gids2), no_rows, 0, extra2_size)
+                continue
+            batch.append((node_id, exact, len(gids2), rows2[extra], extra2_size))
+            batch_size += int(extra.sum())
+            if batch_size >= batch_genes:
+                flush(batch)
+                batch, batch_size = [], 0
+        if batch:
+            flush(batch)
+
+        scored.sort(key=lambda x: (-x[0], x[1]))
+        return scored
 
     def bindiff(
         self,
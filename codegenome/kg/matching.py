@@ -0,0 +1,325 @@
+##
+## This code is part of the Code Genome Framework.
+##
+## (C) Copyright IBM 2023.
+##
+## This code is licensed under the Apache License, Version 2.0. You may
+## obtain a copy of this license in the LICENSE.txt file in the root directory
+## of this source tree or at http://www.apache.org/licenses/LICENSE-2.0.
+##
+## Any modifications or derivative works of this code must retain this
+## copyright notice, and modified files need to carry a notice indicating
+## that they have been altered from the originals.
+##
+"""
+Gene matching stage of `GenomeKG.files_compare_by_shared_genes`.
+"""
+
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import min_weight_full_bipartite_matching
+
+from .._defaults import FILE_COMPARE_ASSIGN_KNN
+from ..genes.utils import decode_gene_by_ver, gene_similarity_by_ver
+
+MATCH_BLOCK_SIZE = 1024  # rows of the similarity matrix computed at once
+MATCH_SIM_EPS = 1e-4  # candidates within this of the approximate best are rescored
+
+
+def gene_matrix(genes):
+    return np.stack([decode_gene_by_ver(x) for x in genes]).astype("float64")
+
+
+def similarity_blocks(m1, m2, block_size=MATCH_BLOCK_SIZE):
+    """
+    Yields `(start, sims)` blocks of the `len(m1) x len(m2)` similarity matrix.
+    Similarity is `1 - normalized euclidean distance`, same as `gene_similarity`.
+    """
+    sq2 = np.einsum("ij,ij->i", m2, m2)
+    norm = np.sqrt(m2.shape[1])
+    for i in range(0, len(m1), block_size):
+        b = m1[i : i + block_size]
+        d = np.einsum("ij,ij->i", b, b)[:, None] + sq2[None, :] - 2.0 * (b @ m2.T)
+        np.maximum(d, 0.0, out=d)
+        yield i, 1.0 - np.sqrt(d) / norm
+
+
+def _func_name_match(g1id, g1dict, g2dict, e1dict, f2dict, match_sim_thr):
+    # function name heuristics, independent of the already matched genes
+    best_match_id = None
+    best_match_sim = 0.0
+    func_match = None
+    f1 = g2id = None
+    for f1 in e1dict.get(g1id).get("func_names", []):
+        g2id = f2dict.get(f1)
+        if g2id:
+            best_match_id = g2id
+            best_match_sim = gene_similarity_by_ver(
+                g1dict[g1id], g2dict[g2id], adjusted=False, normalized=True
+            )
+            if best_match_sim >= match_sim_thr:
+                func_match = True
+                break
+            func_match = False
+    return func_match, f1, g2id, best_match_id, best_match_sim
+
+
+def match_extra_genes(
+    g1extra,
+    g2extra,
+    g1dict,
+    g2dict,
+    e1dict,
+    f2dict,
+    match_sim_thr,
+    mismatch_sim_thr,
+    block_size=MATCH_BLOCK_SIZE,
+):
+    """
+    Greedily matches the genes of file 1 that are not in file 2 (`g1extra`) to
+    the genes of file 2 that are not in file 1 (`g2extra`).
+
+    Genes are visited in `g1extra` order. A gene is first matched by function
+    name, otherwise to the most similar `g2extra` gene that is not matched yet.
+    The similarities of the latter are computed blockwise on the stacked gene
+    matrices; the selected scores are recomputed with `gene_similarity_by_ver`.
+
+    Returns `(xmatch, xmismatch, xdel, xadd, g2extra)` where `g2extra` are the
+    remaining unmatched genes of file 2.
+    """
+    heuristics = [
+        _func_name_match(g1id, g1dict, g2dict, e1dict, f2dict, match_sim_thr)
+        for g1id in g1extra
+    ]
+
+    def needs_scan(h):
+        func_match, f1, _, _, best_match_sim = h
+        if func_match is not None and not f1.startswith("function_"):
+            return False
+        return best_match_sim < match_sim_thr
+
+    scan = [i for i, h in enumerate(heuristics) if needs_scan(h)]
+    scan_rows = {x: i for i, x in enumerate(scan)}
+    g2cols = {x: j for j, x in enumerate(g2extra)}
+    avail = np.ones(len(g2extra), dtype=bool)
+
+    def take(g2id):
+        j = g2cols.get(g2id)
+        if j is not None:
+            avail[j] = False
+
+    blocks = None
+    if len(scan) > 0 and len(g2extra) > 0:
+        m1 = gene_matrix([g1dict[g1extra[i]] for i in scan])
+        m2 = gene_matrix([g2dict[x] for x in g2extra])
+        blocks = similarity_blocks(m1, m2, block_size)
+    block_start, block = 0, None
+
+    def best_available(g1id, row, best_match_id, best_match_sim):
+        nonlocal block_start, block
+        if blocks is None or not avail.any():
+            return best_match_id, best_match_sim
+        while block is None or row >= block_start + len(block):
+            block_start, block = next(blocks)
+        sims = np.where(avail, block[row - block_start], -np.inf)
+        cand = np.flatnonzero(sims >= sims.max() - MATCH_SIM_EPS)
+        for j in cand:
+            sim = gene_similarity_by_ver(
+                g1dict[g1id], g2dict[g2extra[j]], adjusted=False, normalized=True
+            )
+            if best_match_sim < sim:
+                best_match_sim = sim
+                best_match_id = g2extra[j]
+        return best_match_id, best_match_sim
+
+    xmatch = []
+    xdel = []
+    xadd = []
+    xmismatch = []
+    for i, g1id in enumerate(g1extra):
+        func_match, f1, g2id, best_match_id, best_match_sim = heuristics[i]
+        if func_match:
+            xmatch.append([g1id, best_match_id, best_match_sim])
+            take(best_match_id)
+
+        if func_match is not None:
+            # do not consider address based func name for negative match
+            if not f1.startswith("function_"):
+                if func_match == False:
+                    if best_match_sim > mismatch_sim_thr:
+                        # if the genes are not too diff
+                        xmismatch.append([g1id, g2id, best_match_sim])
+                    else:
+                        xdel.append([g1id, best_match_id, best_match_sim])
+                        xadd.append([g2id, best_match_sim])
+                    take(g2id)
+                continue
+
+        if best_match_sim < match_sim_thr:
+            # compare all
+            best_match_id, best_match_sim = best_available(
+                g1id, scan_rows[i], best_match_id, best_match_sim
+            )
+
+        if best_match_sim >= match_sim_thr:
+            xmatch.append([g1id, best_match_id, best_match_sim])
+            take(best_match_id)
+        else:
+            xdel.append([g1id, best_match_id, best_match_sim])
+
+    g2extra = [x for j, x in enumerate(g2extra) if avail[j]]
+    return xmatch, xmismatch, xdel, xadd, g2extra
+
+
+def knn_candidates(m1, m2, k, min_sim, block_size=MATCH_BLOCK_SIZE):
+    """
+    Returns `(rows, cols, sims)` of the `k` most similar `m2` genes of each
+    `m1` gene having similarity greater than `min_sim`.
+    """
+    k = min(k, len(m2))
+    rows, cols, sims = [], [], []
+    for start, block in similarity_blocks(m1, m2, block_size):
+        if k < len(m2):
+            top = np.argpartition(-block, k - 1, axis=1)[:, :k]
+        else:
+            top = np.broadcast_to(np.arange(len(m2)), block.shape)
+        top_sims = np.take_along_axis(block, top, axis=1)
+        keep = top_sims > min_sim
+        rows.append(np.nonzero(keep)[0] + start)
+        cols.append(top[keep])
+        sims.append(top_sims[keep])
+    if len(rows) == 0:
+        return np.empty(0, "int64"), np.empty(0, "int64"), np.empty(0)
+    return np.concatenate(rows), np.concatenate(cols), np.concatenate(sims)
+
+
+def optimal_match_extra_genes(
+    g1extra,
+    g2extra,
+    g1dict,
+    g2dict,
+    match_sim_thr,
+    mismatch_sim_thr,
+    k=FILE_COMPARE_ASSIGN_KNN,
+    block_size=MATCH_BLOCK_SIZE,
+):
+    """
+    Matches `g1extra` to `g2extra` genes with a min-cost bipartite assignment
+    maximizing the number of pairs with similarity `>= match_sim_thr`, then the
+    total similarity of the assigned pairs.
+
+    A pair is a candidate if either gene is among the `k` nearest genes of the
+    other, with similarity greater than `mismatch_sim_thr`. Every gene can also
+    stay unmatched. Genes are sorted by id first, so the result does not depend
+    on the input order and swapping the files swaps the result.
+
+    Pairs with similarity `>= match_sim_thr` are returned in `xmatch`, the other
+    assigned pairs in `xmismatch`. Unassigned genes of file 1 are returned in
+    `xdel` with their nearest gene, the unassigned genes of file 2 in `xadd`
+    with the similarity of their nearest gene and in `g2extra`. Returns
+    `(xmatch, xmismatch, xdel, xadd, g2extra)` like `match_extra_genes`.
+    """
+    g1extra, g2extra = sorted(g1extra), sorted(g2extra)
+    n1, n2 = len(g1extra), len(g2extra)
+    if n1 == 0 or n2 == 0:
+        return (
+            [],
+            [],
+            [[x, None, 0.0] for x in g1extra],
+            [[x, 0.0] for x in g2extra],
+            g2extra,
+        )
+
+    def exact_sim(i, j):
+        return gene_similarity_by_ver(
+            g1dict[g1extra[i]], g2dict[g2extra[j]], adjusted=False, normalized=True
+        )
+
+    m1 = gene_matrix([g1dict[x] for x in g1extra])
+    m2 = gene_matrix([g2dict[x] for x in g2extra])
+    rows, cols, sims = knn_candidates(m1, m2, k, mismatch_sim_thr, block_size)
+    cols2, rows2, sims2 = knn_candidates(m2, m1, k, mismatch_sim_thr, block_size)
+    _, first = np.unique(
+        np.concatenate([rows * n2 + cols, rows2 * n2 + cols2]), return_index=True
+    )
+    rows = np.concatenate([rows, rows2])[first]
+    cols = np.concatenate([cols, cols2])[first]
+    sims = np.concatenate([sims, sims2])[first]
+
+    # Each row also gets a private dummy column (n2 + i) so a full matching of
+    # the rows always exists. Costs are offset by 1 as zero weights are
+    # treated as missing edges: pair = 2 - sim, unmatched = 2. Mismatch pairs
+    # and unmatched rows cost `big` more, which is more than all the other
+    # costs together, so no number of mismatches is worth losing a match.
+    big = 2.0 * (n1 + 1)
+    rows = np.concatenate([rows, np.arange(n1)])
+    cols = np.concatenate([cols, n2 + np.arange(n1)])
+    costs = 2.0 - sims + np.where(sims >= match_sim_thr, 0.0, big)
+    costs = np.concatenate([costs, np.full(n1, 2.0 + big)])
+    graph = csr_matrix((costs, (rows, cols)), shape=(n1, n2 + n1))
+    _, assigned = min_weight_full_bipartite_matching(graph)
+
+    nearest1 = nearest2 = None
+
+    def nearest():
+        # nearest file 2 gene of each file 1 gene and conversely
+        nonlocal nearest1, nearest2
+        if nearest1 is None:
+            nearest1 = np.empty(n1, dtype="int64")
+            best = np.full(n2, -np.inf)
+            nearest2 = np.zeros(n2, dtype="int64")
+            for start, block in similarity_blocks(m1, m2, block_size):
+                nearest1[start : start + len(block)] = np.argmax(block, axis=1)
+                col = np.argmax(block, axis=0)
+                col_sim = block[col, np.arange(n2)]
+                better = col_sim > best
+                best[better] = col_sim[better]
+                nearest2[better] = col[better] + start
+        return nearest1, nearest2
+
+    xmatch = []
+    xmismatch = []
+    xdel = []
+    taken = np.zeros(n2, dtype=bool)
+    for i, j in enumerate(assigned):
+        if j < n2:
+            sim = exact_sim(i, j)
+            if sim >= match_sim_thr:
+                xmatch.append([g1extra[i], g2extra[j], sim])
+                taken[j] = True
+                continue
+            if sim > mismatch_sim_thr:
+                xmismatch.append([g1extra[i], g2extra[j], sim])
+                taken[j] = True
+                continue
+        j = nearest()[0][i]
+        xdel.append([g1extra[i], g2extra[j], exact_sim(i, j)])
+
+    xadd = []
+    for j in np.flatnonzero(~taken):
+        i = nearest()[1][j]
+        xadd.append([g2extra[j], exact_sim(i, j)])
+    g2extra = [x for j, x in enumerate(g2extra) if not taken[j]]
+    return xmatch, xmismatch, xdel, xadd, g2extra
+
+
+def near_match_hits(m1, m2, starts, match_sim_thr, block_size=MATCH_BLOCK_SIZE):
+    """
+    Near matches between the `m1` genes and each segment of the `m2` genes,
+    e.g. the genes of several candidate files stacked, segment `j` starting at
+    row `starts[j]` of `m2`. Segments must not be empty.
+
+    Returns `(hits, cols)`: the `len(m1) x len(starts)` boolean matrix of the
+    `m1` genes having a gene of segment `j` with similarity `>= match_sim_thr`,
+    and the number of genes of each segment having such an `m1` gene.
+    """
+    starts = np.asarray(starts, dtype="int64")
+    hits = np.zeros((len(m1), len(starts)), dtype=bool)
+    col_max = np.full(len(m2), -np.inf)
+    for i, block in similarity_blocks(m1, m2, block_size):
+        hits[i : i + len(block)] = (
+            np.maximum.reduceat(block, starts, axis=1) >= match_sim_thr
+        )
+        np.maximum(col_max, block.max(axis=0), out=col_max)
+    cols = np.add.reduceat((col_max >= match_sim_thr).astype("int64"), starts)
+    return hits, cols
@@ -0,0 +1,540 @@
+##
+## This code is part of the Code Genome Framework.
+##
+## (C) Copyright IBM 2023.
+##
+## This code is licensed under the Apache License, Version 2.0. You may
+## obtain a copy of this license in the LICENSE.txt file in the root directory
+## of this source tree or at http://www.apache.org/licenses/LICENSE-2.0.
+##
+## Any modifications or derivative works of this code must retain this
+## copyright notice, and modified files need to carry a notice indicating
+## that they have been altered from the originals.
+##
+"""
+Gene storage datastructures used by `GenomeKG`.
+
+`GeneIDRegistry` assigns each `gene_id` a stable integer row. The row is the index
+of the gene in the gene matrix used by the gene search tree, so `gene_ids`,
+`compute_tree` and `query_genes` all agree on the same ordering.
+`DigestIDRegistry` is the registry of sha256 ids, kept as 32-byte digests.
+
+`GeneStore` keeps the raw genes and their metadata in columnar numpy arrays
+indexed by those rows.
+
+`FuncNameIndex` maps function names to the `(gene_id, bin_id)` pairs of the
+bins defining them.
+"""
+
+import bisect
+import collections.abc
+import fnmatch
+import re
+import sys
+
+import numpy as np
+
+from ..ids import ID_DTYPE, id_bytes, ids_from_array, ids_to_array, to_id_bytes
+
+GENE_DTYPE = "float32"
+GENE_ID_DTYPE = ID_DTYPE  # sha256 digest. Indexes written before hold hex "S64".
+GENE_STORE_COLUMNS = ["genes", "bc_size", "file_offset", "gene_ids"]
+
+
+class GeneIDRegistry(object):
+    def __init__(self, gene_ids=None):
+        """
+        Append-only `gene_id` -> row registry.
+
+        Rows are never reused or reordered by `append`. Removing genes requires an
+        explicit `rebuild`, which invalidates all previously handed out rows.
+        """
+        self._ids = []  # row -> gene_id
+        self._rows = {}  # gene_id -> row
+        if gene_ids is not None:
+            self.extend(gene_ids)
+
+    def append(self, gene_id):
+        # O(1), returns the existing row for known gene_ids
+        row = self._rows.get(gene_id)
+        if row is None:
+            row = len(self._ids)
+            self._ids.append(gene_id)
+            self._rows[gene_id] = row
+        return row
+
+    def extend(self, gene_ids):
+        for gid in gene_ids:
+            self.append(gid)
+
+    def rebuild(self, gene_ids):
+        # invalidation path, e.g. after genes are removed from the KG
+        self._ids = []
+        self._rows = {}
+        self.extend(gene_ids)
+
+    def row(self, gene_id, default=None):
+        return self._rows.get(gene_id, default)
+
+    @property
+    def ids(self):
+        # list of gene_ids ordered by row. Must be treated as read-only.
+        return self._ids
+
+    def __getitem__(self, row):
+        return self._ids[row]
+
+    def __contains__(self, gene_id):
+        return gene_id in self._rows
+
+    def __iter__(self):
+        return iter(self._ids)
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __repr__(self):
+        return "GeneIDRegistry(size=%d)" % (len(self._ids))
+
+
+class DigestIDRegistry(GeneIDRegistry):
+    """
+    `GeneIDRegistry` of sha256 ids. Ids are stored as 32-byte digests, given
+    as hex strings or digests, and handed out as hex strings. Anything that is
+    not an id is not found.
+    """
+
+    def append(self, gene_id):
+        return super().append(id_bytes(gene_id))
+
+    def row(self, gene_id, default=None):
+        return self._rows.get(to_id_bytes(gene_id), default)
+
+    def digest(self, row):
+        return self._ids[row]
+
+    @property
+    def digests(self):
+        # list of digests ordered by row. Must be treated as read-only.
+        return self._ids
+
+    @property
+    def ids(self):
+        return HexIDs(self._ids)
+
+    def __getitem__(self, row):
+        return self._ids[row].hex()
+
+    def __contains__(self, gene_id):
+        return to_id_bytes(gene_id) in self._rows
+
+    def __iter__(self):
+        return (x.hex() for x in self._ids)
+
+    def __repr__(self):
+        return "DigestIDRegistry(size=%d)" % (len(self._ids))
+
+
+class HexIDs(collections.abc.Sequence):
+    # read-only hex view of a list of digests
+    def __init__(self, digests):
+        self._digests = digests
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [x.hex() for x in self._digests[i]]
+        return self._digests[i].hex()
+
+    def __len__(self):
+        return len(self._digests)
+
+    def __eq__(self, other):
+        if isinstance(other, HexIDs):
+            return self._digests == other._digests
+        if isinstance(other, (list, tuple)):
+            return list(self) == list(other)
+        return NotImplemented
+
+    def __repr__(self):
+        return "HexIDs(size=%d)" % len(self)
+
+
+class GeneStore(collections.abc.Mapping):
+    def __init__(self, dim=None, capacity=1024):
+        """
+        Columnar store of raw genes.
+
+        Genes are kept in a contiguous float32 `N x dim` matrix with parallel
+        `bc_size`, `file_offset` and `gene_id` arrays. Rows follow the
+        `GeneIDRegistry` order. A store created `from_columns` of memory-mapped
+        arrays (base) appends new genes to an in-memory tail, so opening is O(1)
+        and the pages are shared between processes.
+
+        For compatibility with the former `OrderedDict` of genes, `store[gene_id]`
+        returns `(raw_gene, (bc_size, file_offset))`.
+        """
+        self._dim = dim
+        self._capacity = capacity
+        self._registry = None  # built lazily from the `gene_ids` column
+        self._base = self._empty_arrays(0)
+        self._nbase = 0
+        self._tail = None
+        self._ntail = 0
+
+    def _empty_arrays(self, n):
+        return {
+            "genes": np.empty((n, self._dim if self._dim else 0), dtype=GENE_DTYPE),
+            "bc_size": np.empty(n, dtype="int64"),
+            "file_offset": np.empty(n, dtype="int64"),
+            "gene_ids": np.empty(n, dtype=GENE_ID_DTYPE),
+        }
+
+    @property
+    def registry(self):
+        if self._registry is None:
+            self._registry = DigestIDRegistry(
+                ids_from_array(self._base["gene_ids"][: self._nbase])
+            )
+        return self._registry
+
+    @property
+    def ids(self):
+        return self.registry.ids
+
+    @property
+    def dim(self):
+        return self._dim
+
+    def _grow_tail(self, n):
+        cap = self._capacity
+        while cap < n:
+            cap *= 2
+        tail = self._empty_arrays(cap)
+        if self._tail is not None:
+            for k, v in self._tail.items():
+                tail[k][: self._ntail] = v[: self._ntail]
+        self._tail = tail
+        self._capacity = cap
+
+    def add(self, gene_id, raw_gene, meta):
+        """
+        Appends a gene. Returns its row. Existing `gene_id`s are not updated.
+        """
+        registry = self.registry
+        row = registry.row(gene_id)
+        if row is not None:
+            return row
+
+        if self._dim is None:
+            self._dim = len(raw_gene)
+            self._base = self._empty_arrays(0)
+        if self._tail is None or self._ntail >= len(self._tail["bc_size"]):
+            self._grow_tail(self._ntail + 1)
+
+        i = self._ntail
+        bc_size, file_offset = meta
+        self._tail["genes"][i] = raw_gene
+        self._tail["bc_size"][i] = bc_size
+        self._tail["file_offset"][i] = file_offset
+        self._tail["gene_ids"][i] = np.void(id_bytes(gene_id))
+        self._ntail += 1
+        return registry.append(gene_id)
+
+    def extend(self, genes):
+        """
+        Appends a batch of `(gene_id, raw_gene, meta)`. Existing `gene_id`s are
+        skipped. Returns the number of added genes.
+        """
+        registry = self.registry
+        new = {}
+        for gid, raw_gene, meta in genes:
+            gid = id_bytes(gid)
+            if gid not in registry and gid not in new:
+                new[gid] = (raw_gene, meta)
+        if len(new) == 0:
+            return 0
+
+        if self._dim is None:
+            self._dim = len(next(iter(new.values()))[0])
+            self._base = self._empty_arrays(0)
+        n = len(new)
+        if self._tail is None or self._ntail + n > len(self._tail["bc_size"]):
+            self._grow_tail(self._ntail + n)
+
+        i, j = self._ntail, self._ntail + n
+        self._tail["genes"][i:j] = np.stack([x[0] for x in new.values()])
+        metas = np.array([x[1] for x in new.values()], dtype="int64").reshape((n, 2))
+        self._tail["bc_size"][i:j] = metas[:, 0]
+        self._tail["file_offset"][i:j] = metas[:, 1]
+        self._tail["gene_ids"][i:j] = ids_to_array(new.keys())
+        self._ntail = j
+        registry.extend(new.keys())
+        return n
+
+    def remove(self, gene_ids):
+        """
+        Removes genes and compacts the arrays. Invalidates all rows.
+        """
+        registry = self.registry
+        drop = [registry.row(x) for x in gene_ids if x in registry]
+        if len(drop) == 0:
+            return 0
+        keep = np.ones(len(self), dtype=bool)
+        keep[drop] = False
+
+        arrays = {k: self._column(k)[keep] for k in GENE_STORE_COLUMNS}
+        self._set_base(arrays)
+        self._registry = None
+        return len(drop)
+
+    def _set_base(self, arrays):
+        self._base = arrays
+        self._nbase = len(arrays["bc_size"])
+        self._tail = None
+        self._ntail = 0
+
+    def _column(self, name):
+        base = self._base[name][: self._nbase]
+        if name == "gene_ids" and base.dtype != GENE_ID_DTYPE:
+            base = ids_to_array(ids_from_array(base))  # legacy hex column
+        if self._ntail == 0:
+            return base
+        return np.concatenate([base, self._tail[name][: self._ntail]])
+
+    def _get_row(self, name, row):
+        if row < self._nbase:
+            return self._base[name][row]
+        return self._tail[name][row - self._nbase]
+
+    def row(self, gene_id):
+        return self.registry.row(gene_id)
+
+    def rows(self, gene_ids):
+        registry = self.registry
+        return np.array([registry.row(x) for x in gene_ids], dtype="int64")
+
+    def matrix(self, rows=None):
+        """
+        Returns the `N x dim` gene matrix, or the selected `rows` of it.
+        """
+        if rows is None:
+            return self._column("genes")
+        rows = np.asarray(rows, dtype="int64")
+        if self._ntail == 0:
+            return self._base["genes"][rows]
+        out = np.empty((len(rows), self._dim), dtype=GENE_DTYPE)
+        in_base = rows < self._nbase
+        out[in_base] = self._base["genes"][rows[in_base]]
+        out[~in_base] = self._tail["genes"][rows[~in_base] - self._nbase]
+        return out
+
+    def head(self, n):
+        """
+        Returns the first `n` rows of the gene matrix. Appends do not change
+        them, so they can be read while genes are added.
+        """
+        base, nbase, tail = self._base["genes"], self._nbase, self._tail
+        if n <= nbase:
+            return base[:n]
+        return np.concatenate([base[:nbase], tail["genes"][: n - nbase]])
+
+    def bc_sizes(self, rows):
+        """
+        Returns the canonical bitcode sizes of the selected `rows`.
+        """
+        rows = np.asarray(rows, dtype="int64")
+        if self._ntail == 0:
+            return self._base["bc_size"][rows]
+        out = np.empty(len(rows), dtype="int64")
+        in_base = rows < self._nbase
+        out[in_base] = self._base["bc_size"][rows[in_base]]
+        out[~in_base] = self._tail["bc_size"][rows[~in_base] - self._nbase]
+        return out
+
+    def get_gene(self, gene_id):
+        row = self.registry.row(gene_id)
+        if row is None:
+            return None
+        return self._get_row("genes", row)
+
+    def get_meta(self, gene_id):
+        row = self.registry.row(gene_id)
+        if row is None:
+            return None
+        return (
+            int(self._get_row("bc_size", row)),
+            int(self._get_row("file_offset", row)),
+        )
+
+    def __getitem__(self, gene_id):
+        row = self.registry.row(gene_id)
+        if row is None:
+            raise KeyError(gene_id)
+        return (
+            self._get_row("genes", row),
+            (
+                int(self._get_row("bc_size", row)),
+                int(self._get_row("file_offset", row)),
+            ),
+        )
+
+    def __contains__(self, gene_id):
+        return gene_id in self.registry
+
+    def __iter__(self):
+        return iter(self.registry)
+
+    def __len__(self):
+        return self._nbase + self._ntail
+
+    def __repr__(self):
+        return "GeneStore(size=%d, dim=%s)" % (len(self), self._dim)
+
+    def columns(self):
+        """
+        Returns the dict of column arrays, e.g. for writing an index.
+        """
+        return {k: self._column(k) for k in GENE_STORE_COLUMNS}
+
+    @classmethod
+    def from_columns(cls, columns):
+        # columns can be memory mapped arrays
+        store = cls(dim=columns["genes"].shape[1])
+        store._set_base({k: columns[k] for k in GENE_STORE_COLUMNS})
+        return store
+
+    @classmethod
+    def from_items(cls, items):
+        # items of (gene_id, (raw_gene, (bc_size, file_offset)))
+        store = cls()
+        for gid, (raw_gene, meta) in items:
+            store.add(gid, raw_gene, meta)
+        return store
+
+
+GLOB_CHARS = re.compile(r"[*?\[]")
+
+
+class FuncNameIndex(object):
+    def __init__(self):
+        """
+        Function name -> `[(gene_id, bin_id), ...]` inverted index.
+
+        Ids are stored as digests, each once, and names are interned. The
+        sorted name list used by the prefix and glob lookups is rebuilt lazily
+        after names are added or removed.
+        """
+        self._names = {}  # name: {(gene digest, bin digest): None}, ordered set
+        self._digests = {}  # digest: shared digest object
+        self._sorted = None
+
+    def _digest(self, x):
+        x = id_bytes(x)
+        return self._digests.setdefault(x, x)
+
+    def add(self, bin_id, gene_id, funcs):
+        ref = (self._digest(gene_id), self._digest(bin_id))
+        for func in funcs:
+            refs = self._names.get(func)
+            if refs is None:
+                refs = self._names[sys.intern(func)] = {}
+                self._sorted = None
+            refs[ref] = None
+
+    def remove_bin(self, bin_id, genes):
+        # `genes` is the {gene_id: func_names} dict of the bin
+        bin_id = id_bytes(bin_id)
+        for gene_id, funcs in genes.items():
+            ref = (id_bytes(gene_id), bin_id)
+            for func in funcs:
+                refs = self._names.get(func)
+                if refs is None:
+                    continue
+                refs.pop(ref, None)
+                if len(refs) == 0:
+                    del self._names[func]
+                    self._sorted = None
+
+    def get(self, func, bin_id=None):
+        """
+        Returns the `(gene_id, bin_id)` pairs of `func`, of `bin_id` only if set.
+        """
+        refs = self._names.get(func, {})
+        if bin_id:
+            bin_id = to_id_bytes(bin_id)
+            refs = [x for x in refs if x[1] == bin_id]
+        return [(g.hex(), b.hex()) for g, b in refs]
+
+    def _sorted_names(self):
+        names = self._sorted
+        if names is None:
+            names = self._sorted = sorted(self._names)
+        return names
+
+    def prefix(self, prefix):
+        """
+        Returns the sorted names starting with `prefix`.
+        """
+        names = self._sorted_names()
+        i = bisect.bisect_left(names, prefix)
+        out = []
+        while i < len(names) and names[i].startswith(prefix):
+            out.append(names[i])
+            i += 1
+        return out
+
+    def glob(self, pattern):
+        """
+        Returns the sorted names matching the `fnmatch` style `pattern`
+        (case sensitive). Only the names sharing its literal prefix are tested.
+        """
+        m = GLOB_CHARS.search(pattern)
+        if m is None:
+            return [pattern] if pattern in self._names else []
+        return [
+            x
+            for x in self.prefix(pattern[: m.start()])
+            if fnmatch.fnmatchcase(x, pattern)
+        ]
+
+    def find(self, pattern, bin_id=None):
+        """
+        Returns `{name: [(gene_id, bin_id), ...]}` of the names matching
+        `pattern`, of `bin_id` only if set.
+        """
+        out = {}
+        for name in self.glob(pattern):
+            refs = self.get(name, bin_id)
+            if refs:
+                out[name] = refs
+        return out
+
+    def __contains__(self, func):
+        return func in self._names
+
+    def __len__(self):
+        return len(self._names)
+
+    def __repr__(self):
+        return "FuncNameIndex(names=%d)" % len(self)
+
+    def __getstate__(self):
+        return {"names": {k: list(v) for k, v in self._names.items()}}
+
+    def __setstate__(self, state):
+        # ids of indexes written before are hex strings
+        self._sorted = None
+        self._digests = {}
+        self._names = {
+            sys.intern(k): {(self._digest(g), self._digest(b)): None for g, b in v}
+            for k, v in state["names"].items()
+        }
+
+    @classmethod
+    def from_bins(cls, bins):
+        # bins: {bin_id: {gene_id: func_names}}
+        index = cls()
+        for bin_id, genes in bins.items():
+            for gene_id, funcs in genes.items():
+                index.add(bin_id, gene_id, funcs)
+        return index
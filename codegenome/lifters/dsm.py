@@ -0,0 +1,206 @@
+##
+## This code is part of the Code Genome Framework.
+##
+## (C) Copyright IBM 2023.
+##
+## This code is licensed under the Apache License, Version 2.0. You may
+## obtain a copy of this license in the LICENSE.txt file in the root directory
+## of this source tree or at http://www.apache.org/licenses/LICENSE-2.0.
+##
+## Any modifications or derivative works of this code must retain this
+## copyright notice, and modified files need to carry a notice indicating
+## that they have been altered from the originals.
+##
+"""
+RetDec disassembly (`.dsm`) parsing and its function index.
+
+The index of `{name}.dsm` is the sidecar `{name}.dsm.idx`. It records the
+byte range of each function, so a function is read without parsing the file.
+"""
+
+import collections
+import logging
+import os
+import pickle
+import re
+import threading
+
+RE_FUNC = re.compile(r"; function: ([_\w\d]+?) at (0x[0-9A-Fa-f]+) -- (0x[0-9A-Fa-f]+)")
+RE_FUNC_LINE = re.compile(r"(0x[0-9A-Fa-f]+):\s+([0-9A-Fa-f ]+)\s+(.+)")
+
+DSM_INDEX_EXT = ".idx"
+_DSM_INDEX_VERSION = "0.1"
+DSM_INDEX_CACHE_SIZE = 64  # loaded indexes kept in memory
+
+logger = logging.getLogger("codegenome.lifters.dsm")
+
+_index_cache = collections.OrderedDict()  # dsm path: (stat key, index)
+_index_cache_lock = threading.Lock()
+
+
+def _func_meta(m):
+    name, start_addr, end_addr = m.groups()
+    return {"name": name, "start_addr": start_addr, "end_addr": end_addr}
+
+
+def _parse_func_asm(lines):
+    cur_func_meta = None
+    cur_func = []
+    func_matched = False
+    for l in lines:
+        l = l.strip()
+        if not func_matched:
+            m = RE_FUNC.match(l)
+            if m:
+                cur_func_meta = _func_meta(m)
+                func_matched = True
+            continue
+        else:
+            m = RE_FUNC_LINE.match(l)
+            if m:
+                addr, mcode, asm = m.groups()
+                cur_func.append(
+                    [addr, mcode.strip(), asm.strip()]
+                )  # {'addr': addr, 'mcode': mcode.strip(), 'asm': asm.strip()})
+            else:
+                func_matched = False
+                out_func = cur_func
+                out_func_meta = cur_func_meta
+                cur_func = []
+                # check if it's a function line
+                m = RE_FUNC.match(l)
+                if m:
+                    cur_func_meta = _func_meta(m)
+                    func_matched = True
+
+                yield {"metadata": out_func_meta, "asms": out_func}
+
+
+def get_func_asm(fn):
+    """
+    Yields the `{"metadata": ..., "asms": [[addr, mcode, asm], ...]}` functions
+    of a `.dsm` file.
+    """
+    with open(fn) as f:
+        yield from _parse_func_asm(f)
+
+
+def _stat_key(path):
+    st = os.stat(path)
+    return (st.st_mtime_ns, st.st_size)
+
+
+def _scan_dsm(dsm_path):
+    stat_key = _stat_key(dsm_path)
+    funcs = []  # [name, start_addr, end_addr, offset, size]
+    cur = None
+    offset = 0
+    with open(dsm_path, "rb") as f:
+        for raw in f:
+            l = raw.decode("utf-8", "replace").strip()
+            if cur is not None:
+                if RE_FUNC_LINE.match(l):
+                    offset += len(raw)
+                    continue
+                # same as `_parse_func_asm`, any other line ends the function
+                cur[4] = offset - cur[3]
+                funcs.append(tuple(cur))
+                cur = None
+            m = RE_FUNC.match(l)
+            if m:
+                cur = [*m.groups(), offset, None]
+            offset += len(raw)
+    if cur is not None:
+        cur[4] = offset - cur[3]
+        funcs.append(tuple(cur))
+
+    names, addrs = {}, {}
+    for i, (name, start_addr, _, _, _) in enumerate(funcs):
+        names.setdefault(name, i)
+        addrs.setdefault(int(start_addr, 16), i)
+    index = {
+        "type": "dsm_index",
+        "version": _DSM_INDEX_VERSION,
+        "dsm_stat": stat_key,
+        "funcs": funcs,
+        "names": names,
+        "addrs": addrs,
+    }
+    logger.debug(f"Indexed {len(funcs)} functions of {dsm_path}")
+    return index
+
+
+def build_dsm_index(dsm_path, index_path=None):
+    """
+    Scans `dsm_path` once and writes its function index to `index_path`
+    (default: the sidecar). Returns the index.
+    """
+    if index_path is None:
+        index_path = dsm_path + DSM_INDEX_EXT
+    index = _scan_dsm(dsm_path)
+    tmp = index_path + ".tmp"
+    with open(tmp, "wb") as f:
+        pickle.dump(index, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, index_path)
+    return index
+
+
+def load_dsm_index(dsm_path):
+    """
+    Returns the function index of `dsm_path`. A missing or stale sidecar is
+    (re)built.
+    """
+    stat_key = _stat_key(dsm_path)
+    with _index_cache_lock:
+        cached = _index_cache.get(dsm_path)
+        if cached is not None and cached[0] == stat_key:
+            _index_cache.move_to_end(dsm_path)
+            return cached[1]
+
+    index = None
+    try:
+        with open(dsm_path + DSM_INDEX_EXT, "rb") as f:
+            index = pickle.load(f)
+        if (
+            index.get("version") != _DSM_INDEX_VERSION
+            or tuple(index.get("dsm_stat", ())) != stat_key
+        ):
+            index = None
+    except FileNotFoundError:
+        pass
+    except Exception as err:
+        logger.warning(f"Invalid index of {dsm_path}. {err}")
+    if index is None:
+        try:
+            index = build_dsm_index(dsm_path)
+        except OSError:
+            # read only aux dir, the index is kept in memory only
+            index = _scan_dsm(dsm_path)
+
+    with _index_cache_lock:
+        _index_cache[dsm_path] = (stat_key, index)
+        while len(_index_cache) > DSM_INDEX_CACHE_SIZE:
+            _index_cache.popitem(last=False)
+    return index
+
+
+def find_func_asm(dsm_path, name=None, addr=None):
+    """
+    Returns the function of `dsm_path` named `name` or starting at `addr`
+    (int or hex string), reading only its byte range. None if not found.
+    """
+    index = load_dsm_index(dsm_path)
+    i = None
+    if name is not None:
+        i = index["names"].get(name)
+    elif addr is not None:
+        i = index["addrs"].get(int(addr, 16) if type(addr) == str else addr)
+    if i is None:
+        return None
+    _, _, _, offset, size = index["funcs"][i]
+    with open(dsm_path, "rb") as f:
+        f.seek(offset)
+        data = f.read(size)
+    # the trailing empty line ends the function
+    lines = data.decode("utf-8", "replace").splitlines() + [""]
+    return next(_parse_func_asm(lines), None)
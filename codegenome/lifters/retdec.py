@@ -1,3 +1,4 @@
+import hashlib
 import logging
 import os
 import shutil
@@ -10,6 +11,7 @@ from .base import CGLifterBase
 logger = logging.getLogger("codegenome.lifter.retdec")
 
 DEFAULT_RETDEC_PATH = "/opt/retdec"
+RETDEC_CONFIG_PATH = "share/retdec/decompiler-config.json"
 
 
 class CGRetdec(CGLifterBase):
@@ -20,6 +22,44 @@ class CGRetdec(CGLifterBase):
             else retdec_path
         )
         self.logger = logger
+        self._version = None
+        self._config_hash = None
+
+    def version(self):
+        """
+        Output of `retdec-decompiler --version`. "unknown" if it can not be run.
+        """
+        if self._version is None:
+            try:
+                out = subprocess.run(
+                    [
+                        os.path.join(self.retdec_path, "bin/retdec-decompiler"),
+                        "--version",
+                    ],
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.DEVNULL,
+                    timeout=60,
+                ).stdout
+                self._version = out.decode("utf-8", "replace").strip() or "unknown"
+            except Exception as ex:
+                self.logger.warning(f"Can not get RetDec version. {ex}")
+                self._version = "unknown"
+        return self._version
+
+    def config_hash(self):
+        # sha256 of decompiler-config.json
+        if self._config_hash is None:
+            path = os.path.join(self.retdec_path, RETDEC_CONFIG_PATH)
+            if os.path.exists(path):
+                with open(path, "rb") as f:
+                    self._config_hash = hashlib.sha256(f.read()).hexdigest()
+            else:
+                self._config_hash = ""
+        return self._config_hash
+
+    def cache_key_parts(self):
+        # lifter configuration the lifted IR depends on
+        return ("retdec", self.version(), self.config_hash())
 
     def process_file(
         self,
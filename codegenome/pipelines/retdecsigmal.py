@@ -12,18 +12,22 @@
 ## that they have been altered from the originals.
 ##
 
-import hashlib
 import logging
 import os
 import pickle
-import tempfile
 import time
 import traceback
 
+from .._defaults import (DEFAULT_GENE_VERSION, GENE_CACHE_ENABLED,
+                         IR_CACHE_ENABLED, SIGMAL_GENE_CHUNK_SIZE,
+                         SIGMAL_GENE_WORKERS)
 from .._file_format import *
+from ..cache import cache_key, get_gene_cache, get_ir_cache
 from ..genes.sigmal import GENE_TYPE_CONFIG, SigmalGene, prep_data_sigmal2
+from ..ingest import IngestContext
 from ..ir import IRBinary
 from ..ir.canon import IRCanonPassBinary
+from ..lifters.dsm import build_dsm_index
 from ..lifters.retdec import CGRetdec
 from .base import CGPipeline
 
@@ -32,6 +36,7 @@ DB_AUX_DIR = ".auxs"
 DB_LOG_DIR = ".logs"
 DB_INDEX_NAME = "index.gkg"
 DEFAULT_GENE_TYPE = "sigmal2"
+IR_CACHE_AUX_EXTS = [".dsm", ".ll"]  # lifter outputs cached with the IR
 
 _logger = logging.getLogger("codegenome.pipelines.RetdecSigmal")
 
@@ -43,8 +48,39 @@ def _retdec_bin_to_ir(
     keep_aux_files=False,
     overwrite=True,
     logger=None,
+    bin_id=None,
+    use_cache=IR_CACHE_ENABLED,
 ):
+    logger = _logger if logger is None else logger
     retdec = CGRetdec(logger=logger)
+    if output_dir is None:
+        output_dir = os.path.dirname(file_path)
+    if output_fname is None:
+        output_fname = os.path.basename(file_path)
+
+    ir_cache = key = None
+    if use_cache and bin_id:
+        ir_cache = get_ir_cache()
+        key = cache_key(bin_id, *retdec.cache_key_parts())
+        out = ir_cache.get(key)
+        aux = {}
+        if out is not None and keep_aux_files:
+            # the aux files are cached only by the lifts that kept them
+            for ext in IR_CACHE_AUX_EXTS:
+                aux[ext] = ir_cache.get(cache_key(key, ext))
+            if any(x is None for x in aux.values()):
+                logger.debug(f"IR cache hit without aux files. bin_id: {bin_id}")
+                out = None
+        if out is not None:
+            logger.debug(f"IR cache hit. bin_id: {bin_id}")
+            aux[".bc"] = out if keep_aux_files else None
+            for ext, data in aux.items():
+                path = os.path.join(output_dir, output_fname + ext)
+                if data is not None and (overwrite or not os.path.exists(path)):
+                    with open(path, "wb") as f:
+                        f.write(data)
+            return out
+
     bc_path = retdec.process_file(
         file_path,
         output_dir=output_dir,
@@ -56,6 +92,14 @@ def _retdec_bin_to_ir(
         out = f.read()
     if not keep_aux_files:
         os.remove(bc_path)
+    if ir_cache is not None and out:
+        ir_cache.put(key, out)
+        if keep_aux_files:
+            for ext in IR_CACHE_AUX_EXTS:
+                path = os.path.join(output_dir, output_fname + ext)
+                if os.path.exists(path):
+                    with open(path, "rb") as f:
+                        ir_cache.put(cache_key(key, ext), f.read())
     return out
 
 
@@ -68,8 +112,7 @@ def _ir_to_canon(
     canon = prep_canon_file(irb, metadata)
 
     if output_path:
-        with open(output_path, "wb") as cf:
-            pickle.dump(canon, cf, protocol=pickle.HIGHEST_PROTOCOL)
+        write_canon_file(output_path, canon)
 
     return canon
 
@@ -78,47 +121,66 @@ def _ir_to_canon_using_pass(
     ir_data, output_path=None, bin_id=None, metadata=None, logger=None
 ):
     logger = _logger if logger is None else logger
+    # without an output path the pass output is streamed, nothing is written
+    jsonl_output = None
     if output_path:
         jsonl_output = os.path.splitext(output_path)[0] + ".canon.jsonl"
-    else:
-        fd, jsonl_output = tempfile.mkstemp()
-        os.close(fd)
 
     logger.debug(f"Creating IRCanonPassBinary")
     irb = IRCanonPassBinary(ir_data, output=jsonl_output, bin_id=bin_id)
     canon = prep_canon_file(irb, metadata)
 
     if output_path:
-        with open(output_path, "wb") as cf:
-            pickle.dump(canon, cf, protocol=pickle.HIGHEST_PROTOCOL)
+        write_canon_file(output_path, canon)
     return canon
 
 
 def _canon_to_sigmal_gene(
-    canon, output_path=None, gene_type=DEFAULT_GENE_TYPE, logger=None
+    canon,
+    output_path=None,
+    gene_type=DEFAULT_GENE_TYPE,
+    logger=None,
+    workers=SIGMAL_GENE_WORKERS,
+    chunk_size=SIGMAL_GENE_CHUNK_SIZE,
+    use_cache=GENE_CACHE_ENABLED,
+    gene_version=DEFAULT_GENE_VERSION,
 ):
     logger = _logger if logger is None else logger
     logger.debug(f"Creating Sigmal gene")
     t = time.time()
     sg = SigmalGene()
-    sg_genes = []
     # find unique genes
     gid_funcs = {}
+    uniq = []  # (gid, bc, meta) of the first function of each gene
     for gid, func, bc, meta in canon["funcs"]:
         if gid not in gid_funcs:
             gid_funcs[gid] = [func]
+            uniq.append((gid, bc, meta))
         else:
             gid_funcs[gid].append(func)
 
-    done = set()
-
-    for gid, func, bc, meta in canon["funcs"]:
-        if gid not in done:
-            raw_gene = sg.from_bitcode(bc, gene_type)
-            # format
-            gene_data = (gid, gid_funcs[gid], raw_gene, meta)
-            sg_genes.append(gene_data)
-            done.add(gid)
+    # genes of functions seen in other binaries
+    # cached genes are only valid for the same gene algorithm and config
+    gene_cfg = cache_key(gene_version, gene_type, GENE_TYPE_CONFIG.get(gene_type))
+    keys = [f"{gene_cfg}:{gid}" for gid, _, _ in uniq]
+    gene_cache = get_gene_cache() if use_cache else None
+    raw_genes = gene_cache.get_many(keys) if gene_cache is not None else {}
+    todo = [(k, x) for k, x in zip(keys, uniq) if k not in raw_genes]
+    logger.debug(f"Gene cache hits: {len(uniq) - len(todo)}/{len(uniq)}")
+
+    new = sg.from_bitcodes(
+        [x[1] for _, x in todo], gene_type, workers=workers, chunk_size=chunk_size
+    )
+    new = [(k, raw_gene) for (k, _), raw_gene in zip(todo, new)]
+    if gene_cache is not None:
+        gene_cache.put_many(new)
+    raw_genes.update(new)
+
+    # format
+    sg_genes = [
+        (gid, gid_funcs[gid], raw_genes[k], meta)
+        for k, (gid, bc, meta) in zip(keys, uniq)
+    ]
     t = time.time() - t
     out = prep_gene_file(sg_genes, canon["binid"], canon["file_meta"])
     logger.info("process_canon_to_gene time: %f" % (t))
@@ -132,6 +194,7 @@ def _canon_to_sigmal_gene(
 class RetdecSigmal(CGPipeline):
     def __init__(self):
         self.logger = logging.getLogger("codegenome.pipelines.RetdecSigmal")
+        self.gene_version = DEFAULT_GENE_VERSION
 
     def process_file(
         self,
@@ -145,11 +208,21 @@ class RetdecSigmal(CGPipeline):
         logger=None,
         return_genes=False,
         keep_gene_file=True,
+        gene_workers=SIGMAL_GENE_WORKERS,
+        gene_chunk_size=SIGMAL_GENE_CHUNK_SIZE,
     ):
-        metadata = get_file_meta(file_path)
-        if bin_id is None:
-            with open(file_path, "rb") as f:
-                bin_id = hashlib.sha256(f.read()).hexdigest()
+        """
+        Lifts, canonicalizes and computes the Sigmal genes of `file_path`.
+        Genes are extracted by `gene_workers` processes (0: number of CPUs)
+        in chunks of `gene_chunk_size` functions.
+
+        `file_path` can also be an `IngestContext` carrying the file id and
+        metadata computed by the caller.
+        """
+        ctx = IngestContext.of(file_path, bin_id=bin_id)
+        file_path = ctx.file_path
+        metadata = ctx.metadata
+        bin_id = ctx.bin_id
         output_dir = os.path.dirname(file_path) if output_dir is None else output_dir
         output_fname = (
             os.path.basename(file_path) if output_fname is None else output_fname
@@ -171,6 +244,7 @@ class RetdecSigmal(CGPipeline):
                 keep_aux_files=keep_aux_files,
                 overwrite=overwrite,
                 logger=logger,
+                bin_id=bin_id,
             )
             if not ir_data:
                 logger.error("_retdec_bin_to_ir failed.")
@@ -179,6 +253,14 @@ class RetdecSigmal(CGPipeline):
             logger.error(f"Exception: {ex}. {repr(traceback.format_exc())}")
             return False
 
+        dsm_path = os.path.join(output_dir, output_fname + ".dsm")
+        if keep_aux_files and os.path.exists(dsm_path):
+            # function byte ranges for `GenomeKG.get_asm`
+            try:
+                build_dsm_index(dsm_path)
+            except Exception as ex:
+                logger.warning(f"Indexing {dsm_path} failed. {ex}")
+
         logger.debug("IR to canonical IR")
 
         try:
@@ -209,7 +291,13 @@ class RetdecSigmal(CGPipeline):
                 gene_path = None
 
             genes = _canon_to_sigmal_gene(
-                canon, output_path=gene_path, gene_type=sigmal_gene_type, logger=logger
+                canon,
+                output_path=gene_path,
+                gene_type=sigmal_gene_type,
+                logger=logger,
+                workers=gene_workers,
+                chunk_size=gene_chunk_size,
+                gene_version=self.gene_version,
             )
             if canon is None:
                 logger.error("_ir_to_canon failed.")
@@ -239,6 +327,8 @@ class RetdecSigmalV1(RetdecSigmal):
         logger=None,
         return_genes=False,
         keep_gene_file=True,
+        gene_workers=SIGMAL_GENE_WORKERS,
+        gene_chunk_size=SIGMAL_GENE_CHUNK_SIZE,
     ):
 
         return super().process_file(
@@ -252,4 +342,6 @@ class RetdecSigmalV1(RetdecSigmal):
             logger=logger,
             return_genes=return_genes,
             keep_gene_file=keep_gene_file,
+            gene_workers=gene_workers,
+            gene_chunk_size=gene_chunk_size,
         )
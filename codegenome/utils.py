@@ -1,3 +1,5 @@
+import multiprocessing
+import os
 import time
 
 
@@ -12,3 +14,26 @@ class ProfileLog:
     def __exit__(self, type, value, traceback):
         self.t = time.time() - self.start
         self.logger.info(self.name + " time: %f" % self.t)
+
+
+def get_worker_count(workers):
+    # 0 or None: number of CPUs
+    if not workers:
+        workers = os.cpu_count() or 1
+    return max(1, int(workers))
+
+
+def parallel_map(func, iterable, workers=1, chunk_size=1):
+    """
+    Ordered and lazily consumed `map`. Runs `func` in a process pool when
+    `workers` > 1. `func` must be picklable (a module level function).
+    """
+    workers = get_worker_count(workers)
+    if workers == 1:
+        for x in iterable:
+            yield func(x)
+        return
+
+    with multiprocessing.Pool(workers) as pool:
+        for r in pool.imap(func, iterable, chunk_size):
+            yield r
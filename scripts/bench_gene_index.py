@@ -0,0 +1,104 @@
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+"""
+Recall@k and latency of the approximate gene indexes against the exact BallTree.
+
+usage:
+python bench_gene_index.py --kg ~/.cg/cache/local.kg
+python bench_gene_index.py --synthetic 200000 --nprobe 1 4 8 16 --rerank 0 4
+"""
+
+
+def synthetic_genes(n, dim, seed=0):
+    # clustered data, like genes of the same functions across binaries
+    rs = np.random.RandomState(seed)
+    centers = rs.rand(max(1, n // 50), dim).astype("float32")
+    genes = centers[rs.randint(len(centers), size=n)]
+    return genes + 0.02 * rs.randn(n, dim).astype("float32")
+
+
+def recall_at_k(truth, found):
+    hits = [len(set(t).intersection(f)) for t, f in zip(truth, found)]
+    return float(np.sum(hits)) / truth.size
+
+
+def main(args):
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+    from codegenome.kg import GenomeKG
+    from codegenome.kg.ann import build_gene_index
+
+    if args.kg:
+        kg = GenomeKG(args.kg)
+        kg.load(update=False)
+        genes = np.asarray(kg.genes.matrix(), dtype="float32")
+    else:
+        genes = synthetic_genes(args.synthetic, args.dim)
+
+    rs = np.random.RandomState(1)
+    queries = genes[rs.choice(len(genes), min(args.queries, len(genes)), False)]
+    queries = queries + args.noise * rs.randn(*queries.shape).astype("float32")
+    print("genes: %s, queries: %d, k: %d" % (genes.shape, len(queries), args.k))
+
+    t = time.time()
+    exact = build_gene_index(genes, index_type="balltree")
+    build_t = time.time() - t
+    t = time.time()
+    _, truth = exact.query(queries, k=args.k)
+    query_t = time.time() - t
+    print(
+        "%-36s build: %8.2fs  query: %8.3fms/q  recall@%d: %.4f"
+        % ("balltree", build_t, 1000 * query_t / len(queries), args.k, 1.0)
+    )
+
+    for nlist in args.nlist or [None]:
+        t = time.time()
+        index = build_gene_index(genes, index_type="ivfpq", nlist=nlist, m=args.m)
+        build_t = time.time() - t
+        for rerank in args.rerank:
+            for nprobe in args.nprobe:
+                index.nprobe, index.rerank = nprobe, rerank
+                if rerank and index.data is None:
+                    continue
+                t = time.time()
+                _, found = index.query(queries, k=args.k)
+                query_t = time.time() - t
+                name = "ivfpq(nlist=%d,nprobe=%d,rerank=%d)" % (
+                    len(index.centroids),
+                    nprobe,
+                    rerank,
+                )
+                print(
+                    "%-36s build: %8.2fs  query: %8.3fms/q  recall@%d: %.4f"
+                    % (
+                        name,
+                        build_t,
+                        1000 * query_t / len(queries),
+                        args.k,
+                        recall_at_k(truth, found),
+                    )
+                )
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--kg", default=None, help="GenomeKG directory to read genes.")
+    ap.add_argument(
+        "--synthetic", type=int, default=100000, help="Number of synthetic genes."
+    )
+    ap.add_argument("--dim", type=int, default=320, help="Synthetic gene size.")
+    ap.add_argument("--queries", type=int, default=1000)
+    ap.add_argument("--noise", type=float, default=0.01, help="Query perturbation.")
+    ap.add_argument("-k", type=int, default=10)
+    ap.add_argument("--nlist", type=int, nargs="*", default=None)
+    ap.add_argument("--nprobe", type=int, nargs="+", default=[1, 4, 8, 16, 32])
+    ap.add_argument("--rerank", type=int, nargs="+", default=[4])
+    ap.add_argument("-m", type=int, default=16, help="PQ sub-quantizers.")
+
+    args = ap.parse_args()
+
+    exit(main(args))
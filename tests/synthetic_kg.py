@@ -0,0 +1,41 @@
+"""
+Synthetic binaries for the KG tests: fake gene files built from gene keys,
+without RetDec or llvmlite.
+"""
+import hashlib
+
+import joblib
+import numpy as np
+
+from codegenome._file_format import prep_gene_file
+from codegenome.ids import id_hex
+
+
+def hash_id(x):
+    return hashlib.sha256(str(x).encode("utf-8")).hexdigest()
+
+
+def synthetic_genes(name, gene_keys):
+    """
+    Gene file content of a fake binary. Each entry of `gene_keys` becomes a
+    function gene; equal keys produce equal gene_ids and raw_genes.
+    """
+    genes = []
+    for i, key in enumerate(gene_keys):
+        rs = np.random.RandomState(int(hash_id(key)[:8], 16))
+        raw_gene = rs.rand(320).astype("float32")
+        genes.append((hash_id(key), ["func_%s" % key], raw_gene, (2000 + i, 0)))
+    return prep_gene_file(genes, hash_id(name), {"file_path": name, "file_size": 1})
+
+
+def add_synthetic_bin(kg, name, gene_keys):
+    genes = synthetic_genes(name, gene_keys)
+    kg._add_bin_genes(genes)
+    return id_hex(genes["binid"])
+
+
+def write_synthetic_gene_file(kg, name, gene_keys):
+    genes = synthetic_genes(name, gene_keys)
+    path = kg._get_gene_file_path(id_hex(genes["binid"]))
+    joblib.dump(genes, path)
+    return path
@@ -0,0 +1,158 @@
+import logging
+import os
+import pickle
+import shutil
+import sys
+import threading
+import unittest
+
+import numpy as np
+
+logging.basicConfig(
+    filename="/tmp/cg-test-ann.log",
+    level=logging.DEBUG,
+    format="%(asctime)s, %(name)s, %(levelname)s, %(message)s",
+    datefmt="%m/%d/%Y %H:%M:%S",
+)
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "../"))
+
+from synthetic_kg import add_synthetic_bin, hash_id  # noqa
+
+from codegenome.kg import GenomeKG  # noqa
+from codegenome.kg.ann import (BallTreeIndex, DeltaGeneIndex,  # noqa
+                               IVFPQIndex, build_gene_index)
+
+TEST_D = "/tmp/cg_ann_test"
+KG_REPO = os.path.join(TEST_D, "testkg.gkg")
+
+
+def clustered(n, dim, seed=0):
+    rs = np.random.RandomState(seed)
+    centers = rs.rand(n // 10, dim).astype("float32")
+    x = centers[rs.randint(len(centers), size=n)]
+    return x + 0.01 * rs.randn(n, dim).astype("float32")
+
+
+def recall(truth, found):
+    return np.mean([len(set(t).intersection(f)) / len(t) for t, f in zip(truth, found)])
+
+
+class TestANN(unittest.TestCase):
+    def setUp(self):
+        if os.path.exists(TEST_D):
+            shutil.rmtree(TEST_D)
+        os.makedirs(TEST_D)
+
+    def test_ivfpq_recall(self):
+        x = clustered(3000, 32)
+        q = x[:200] + 0.001
+        _, truth = BallTreeIndex(x).query(q, k=5)
+
+        index = IVFPQIndex(x, nlist=32, m=8, nprobe=4)
+        dist, found = index.query(q, k=5)
+        self.assertEqual(found.shape, (200, 5))
+        self.assertTrue(np.all(np.diff(dist, axis=1) >= 0))
+        self.assertGreater(recall(truth, found), 0.8)
+        self.assertGreater(recall(truth[:, :1], found[:, :1]), 0.95)
+
+        # exhaustive scan and rerank is exact
+        index.nprobe, index.rerank = 32, 3000
+        exact_dist, _ = BallTreeIndex(x).query(q, k=5)
+        dist, found = index.query(q, k=5)
+        self.assertTrue(np.allclose(dist, exact_dist, atol=1e-4))
+
+        # quantized distances only
+        index.nprobe, index.rerank = 4, 0
+        self.assertGreater(recall(truth[:, :1], index.query(q, k=1)[1]), 0.5)
+
+    def test_build_gene_index(self):
+        x = clustered(100, 8)
+        self.assertTrue(isinstance(build_gene_index(x), BallTreeIndex))
+        self.assertEqual(len(build_gene_index(x, index_type="ivfpq")), 100)
+        with self.assertRaises(ValueError):
+            build_gene_index(x, "cosine", "ivfpq")
+        with self.assertRaises(Exception):
+            build_gene_index(x, index_type="nope")
+
+    def test_kg_ivfpq(self):
+        kg = GenomeKG(KG_REPO, gene_index_type="ivfpq")
+        for i in range(20):
+            add_synthetic_bin(kg, "b%d" % i, ["x%d" % i, "y%d" % i, "z%d" % i])
+        kg.compute_tree(nlist=4)
+        self.assertTrue(isinstance(kg.gene_tree.main, IVFPQIndex))
+        for gid in kg.gene_ids:
+            d, g = kg.query_gene(kg.get_gene(gid))[0]
+            self.assertEqual(g, gid)
+
+        kg.save_index()
+        kg2 = GenomeKG(KG_REPO)
+        kg2.load(update=False)
+        self.assertTrue(isinstance(kg2.gene_tree.main, IVFPQIndex))
+        d, g = kg2.query_gene(kg.get_gene(hash_id("y3")))[0]
+        self.assertEqual(g, hash_id("y3"))
+
+    def test_delta_index(self):
+        x = clustered(1000, 16)
+        q = x[::7] + 0.001
+        exact_dist, exact_indx = BallTreeIndex(x).query(q, k=3)
+
+        index = DeltaGeneIndex(BallTreeIndex(x[:600]), builder=BallTreeIndex)
+        index.add(x[600:900])
+        index.add(x[900:])
+        self.assertEqual(len(index), 1000)
+        dist, indx = index.query(q, k=3)
+        self.assertTrue(np.allclose(dist, exact_dist, atol=1e-5))
+        self.assertTrue(np.array_equal(indx, exact_indx))
+
+        index = pickle.loads(pickle.dumps(index))
+        self.assertTrue(np.array_equal(index.query(q, k=3)[1], exact_indx))
+
+        # background compaction while appending
+        index = DeltaGeneIndex(
+            BallTreeIndex(x[:500]), builder=BallTreeIndex, compact_threshold=200
+        )
+        threads = []
+
+        def source(n):
+            threads.append(threading.current_thread())
+            return x[:n]
+
+        index.add(x[500:800], source=source)
+        self.assertTrue(index._compaction is not None)
+        index.add(x[800:], source=source)
+        index.wait()
+        # the rows are taken by the compaction thread
+        self.assertEqual(threads, [index._compaction])
+        self.assertEqual(len(index), 1000)
+        self.assertEqual(len(index.main), 800)
+        self.assertTrue(np.array_equal(index.query(q, k=3)[1], exact_indx))
+
+        index.compact(source, background=False)
+        self.assertEqual(len(index.main), 1000)
+        self.assertTrue(np.array_equal(index.query(q, k=3)[1], exact_indx))
+
+    def test_kg_append_without_rebuild(self):
+        kg = GenomeKG(KG_REPO)
+        add_synthetic_bin(kg, "b1", ["x", "y"])
+        kg.compute_tree()
+        tree = kg.gene_tree
+        add_synthetic_bin(kg, "b2", ["y", "z", "w"])
+        self.assertTrue(kg.gene_tree is tree)
+        self.assertEqual(len(tree), 4)
+        for key in ["x", "z", "w"]:
+            d, g = kg.query_gene(kg.get_gene(hash_id(key)))[0]
+            self.assertEqual(g, hash_id(key))
+
+        # appends to a saved tree
+        kg.save_index()
+        kg2 = GenomeKG(KG_REPO)
+        kg2.load(update=False)
+        add_synthetic_bin(kg2, "b3", ["v"])
+        d, g = kg2.query_gene(kg2.get_gene(hash_id("v")))[0]
+        self.assertEqual(g, hash_id("v"))
+        self.assertEqual(len(kg2.gene_tree), 5)
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
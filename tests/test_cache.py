@@ -0,0 +1,179 @@
+import logging
+import os
+import shutil
+import sys
+import time
+import unittest
+from unittest import mock
+
+import numpy as np
+
+logging.basicConfig(
+    filename="/tmp/cg-test-cache.log",
+    level=logging.DEBUG,
+    format="%(asctime)s, %(name)s, %(levelname)s, %(message)s",
+    datefmt="%m/%d/%Y %H:%M:%S",
+)
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "../"))
+
+import codegenome.cache  # noqa
+from codegenome.cache import BlobCache, GeneCache, cache_key  # noqa
+from codegenome.genes.sigmal import SigmalGene  # noqa
+from codegenome.lifters.retdec import CGRetdec  # noqa
+from codegenome.pipelines.retdecsigmal import _canon_to_sigmal_gene  # noqa
+from codegenome.pipelines.retdecsigmal import _retdec_bin_to_ir  # noqa
+
+TEST_D = "/tmp/cg_cache_test"
+
+
+def fake_retdec(path, version="RetDec v5.0"):
+    # retdec-decompiler writing `{output}.bc/.dsm/.ll` and counting its runs
+    os.makedirs(os.path.join(path, "bin"), exist_ok=True)
+    os.makedirs(os.path.join(path, "share/retdec"), exist_ok=True)
+    with open(os.path.join(path, "share/retdec/decompiler-config.json"), "w") as f:
+        f.write("{}")
+    exe = os.path.join(path, "bin/retdec-decompiler")
+    with open(exe, "w") as f:
+        f.write(
+            "#!/bin/sh\n"
+            'if [ "$1" = "--version" ]; then echo "%s"; exit 0; fi\n'
+            'echo run >> "%s/runs"\n'
+            'cat "$3" > "$2.bc"\n'
+            'echo dsm > "$2.dsm"\n'
+            'echo ll > "$2.ll"\n' % (version, path)
+        )
+    os.chmod(exe, 0o755)
+
+
+def run_count(path):
+    if not os.path.exists(os.path.join(path, "runs")):
+        return 0
+    with open(os.path.join(path, "runs")) as f:
+        return len(f.readlines())
+
+
+class TestCache(unittest.TestCase):
+    def setUp(self):
+        if os.path.exists(TEST_D):
+            shutil.rmtree(TEST_D)
+        os.makedirs(TEST_D)
+
+    def test_blob_cache(self):
+        cache = BlobCache(os.path.join(TEST_D, "blobs"), max_size=250)
+        keys = [cache_key("bin", i) for i in range(3)]
+        for i, k in enumerate(keys):
+            cache.put(k, bytes([i]) * 100)
+            os.utime(cache._path(k), (i, i))
+        # only two fit
+        self.assertTrue(cache.get(keys[0]) is None)
+        self.assertEqual(cache.get(keys[1]), b"\x01" * 100)
+        self.assertTrue(keys[2] in cache)
+
+        # keys[1] was used last
+        os.utime(cache._path(keys[2]), (1, 1))
+        cache.put(cache_key("bin", 3), b"x" * 100)
+        self.assertTrue(keys[1] in cache)
+        self.assertFalse(keys[2] in cache)
+
+    def test_ir_cache(self):
+        retdec_path = os.path.join(TEST_D, "retdec")
+        fake_retdec(retdec_path)
+        env = mock.patch.dict(os.environ, {"RETDEC_PATH": retdec_path})
+        env.start()
+        self.addCleanup(env.stop)
+        codegenome.cache._ir_cache = BlobCache(os.path.join(TEST_D, "ir"), ext=".bc")
+
+        fn = os.path.join(TEST_D, "bin")
+        with open(fn, "wb") as f:
+            f.write(b"binary")
+        args = dict(output_dir=TEST_D, output_fname="x", bin_id=cache_key("bin"))
+
+        self.assertEqual(_retdec_bin_to_ir(fn, **args), b"binary")
+        self.assertEqual(_retdec_bin_to_ir(fn, **args), b"binary")
+        self.assertEqual(run_count(retdec_path), 1)
+
+        # the aux files were not cached with the IR
+        _retdec_bin_to_ir(fn, keep_aux_files=True, **args)
+        self.assertEqual(run_count(retdec_path), 2)
+
+        # aux files are restored from the cache
+        for ext in [".bc", ".dsm", ".ll"]:
+            os.remove(os.path.join(TEST_D, "x" + ext))
+        _retdec_bin_to_ir(fn, keep_aux_files=True, **args)
+        self.assertEqual(run_count(retdec_path), 2)
+        for ext in [".bc", ".dsm", ".ll"]:
+            self.assertTrue(os.path.exists(os.path.join(TEST_D, "x" + ext)))
+        with open(os.path.join(TEST_D, "x.dsm")) as f:
+            self.assertEqual(f.read(), "dsm\n")
+
+        # a lifter config change is a miss
+        with open(
+            os.path.join(retdec_path, "share/retdec/decompiler-config.json"), "w"
+        ) as f:
+            f.write('{"x": 1}')
+        _retdec_bin_to_ir(fn, **args)
+        self.assertEqual(run_count(retdec_path), 3)
+
+        _retdec_bin_to_ir(fn, use_cache=False, **args)
+        self.assertEqual(run_count(retdec_path), 4)
+        self.assertEqual(CGRetdec(retdec_path).version(), "RetDec v5.0")
+
+    def test_gene_cache(self):
+        cache = GeneCache(os.path.join(TEST_D, "genes.sqlite"), max_entries=2)
+        g = np.arange(4, dtype="float32")
+        cache.put_many([("a", g), ("b", g + 1)])
+        got = cache.get_many(["a", "b", "c"])
+        self.assertEqual(sorted(got), ["a", "b"])
+        self.assertEqual(got["b"].dtype, g.dtype)
+        self.assertTrue(np.array_equal(got["b"], g + 1))
+
+        cache._conn().execute("UPDATE genes SET atime=0 WHERE key='a'")
+        cache.put_many([("c", g)])  # evicts the least recently used
+        self.assertEqual(sorted(cache.get_many(["a", "b", "c"])), ["b", "c"])
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.evict(max_entries=1), 1)
+
+    def test_canon_gene_cache(self):
+        codegenome.cache._gene_cache = GeneCache(os.path.join(TEST_D, "g.sqlite"))
+        computed = []
+
+        def from_bitcodes(self, bcs, gene_type, **kwargs):
+            computed.extend(bcs)
+            return [np.full(4, len(x), dtype="float32") for x in bcs]
+
+        patch = mock.patch.object(SigmalGene, "from_bitcodes", from_bitcodes)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+        g1, g2, g3 = [cache_key(x) for x in ["g1", "g2", "g3"]]
+
+        def canon(funcs):
+            return {
+                "binid": cache_key("b"),
+                "file_meta": {},
+                "funcs": [(gid, name, bc, {}) for gid, name, bc in funcs],
+            }
+
+        out1 = _canon_to_sigmal_gene(
+            canon([(g1, "f1", b"x"), (g2, "f2", b"yy"), (g1, "f3", b"x")])
+        )
+        self.assertEqual(computed, [b"x", b"yy"])
+        out2 = _canon_to_sigmal_gene(canon([(g2, "f2", b"yy"), (g3, "f", b"z")]))
+        self.assertEqual(computed, [b"x", b"yy", b"z"])
+        self.assertEqual(out1["genes"][1][2].tolist(), out2["genes"][0][2].tolist())
+
+        _canon_to_sigmal_gene(canon([(g3, "f", b"z")]), use_cache=False)
+        self.assertEqual(len(computed), 4)
+
+        # other gene algorithm version or config
+        _canon_to_sigmal_gene(canon([(g3, "f", b"z")]), gene_version="genes_v9")
+        self.assertEqual(len(computed), 5)
+        _canon_to_sigmal_gene(canon([(g3, "f", b"z")]), gene_type="sigmal2b")
+        self.assertEqual(len(computed), 6)
+        _canon_to_sigmal_gene(canon([(g3, "f", b"z")]))
+        self.assertEqual(len(computed), 6)
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
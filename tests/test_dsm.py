@@ -0,0 +1,76 @@
+import logging
+import os
+import shutil
+import sys
+import time
+import unittest
+
+logging.basicConfig(
+    filename="/tmp/cg-test-dsm.log",
+    level=logging.DEBUG,
+    format="%(asctime)s, %(name)s, %(levelname)s, %(message)s",
+    datefmt="%m/%d/%Y %H:%M:%S",
+)
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "../"))
+
+from codegenome.lifters.dsm import (DSM_INDEX_EXT, build_dsm_index,  # noqa
+                                    find_func_asm, get_func_asm,
+                                    load_dsm_index)
+
+TEST_D = "/tmp/cg_dsm_test"
+
+
+def synthetic_dsm(names, addr=0x1000):
+    lines = [";;", ";; This file was generated by the Retargetable Decompiler", ";;"]
+    lines += ["", "; section: .text"]
+    for i, name in enumerate(names):
+        start = addr
+        body = []
+        for j in range(3 + i):
+            body.append("0x%x:   48 83 ec %02x      \tsub rsp, %d" % (addr, j, j))
+            addr += 4
+        lines.append("; function: %s at 0x%x -- 0x%x" % (name, start, addr))
+        lines += body
+        if i % 2:
+            lines.append("")
+    lines.append("; section: .fini")
+    return "\n".join(lines) + "\n"
+
+
+class TestDsm(unittest.TestCase):
+    def setUp(self):
+        if os.path.exists(TEST_D):
+            shutil.rmtree(TEST_D)
+        os.makedirs(TEST_D)
+        self.path = os.path.join(TEST_D, "bin.dsm")
+        with open(self.path, "w") as f:
+            f.write(synthetic_dsm(["_init", "main", "f_é", "function_1100", "_fini"]))
+
+    def test_find_func_asm(self):
+        expected = list(get_func_asm(self.path))
+        self.assertEqual(len(expected), 5)
+        index = build_dsm_index(self.path)
+        self.assertTrue(os.path.exists(self.path + DSM_INDEX_EXT))
+        self.assertEqual(len(index["funcs"]), 5)
+
+        for fobj in expected:
+            meta = fobj["metadata"]
+            self.assertEqual(find_func_asm(self.path, name=meta["name"]), fobj)
+            self.assertEqual(find_func_asm(self.path, addr=meta["start_addr"]), fobj)
+        self.assertIsNone(find_func_asm(self.path, name="missing"))
+        self.assertIsNone(find_func_asm(self.path, addr=0x10))
+
+    def test_stale_index(self):
+        build_dsm_index(self.path)
+        with open(self.path, "w") as f:
+            f.write(synthetic_dsm(["other"]))
+        os.utime(self.path, ns=(time.time_ns(), time.time_ns() + 10**9))
+        self.assertEqual(list(load_dsm_index(self.path)["names"]), ["other"])
+        self.assertEqual(
+            find_func_asm(self.path, name="other"), next(get_func_asm(self.path))
+        )
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
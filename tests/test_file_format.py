@@ -0,0 +1,99 @@
+import hashlib
+import logging
+import os
+import pickle
+import shutil
+import sys
+import unittest
+
+logging.basicConfig(
+    filename="/tmp/cg-test-file-format.log",
+    level=logging.DEBUG,
+    format="%(asctime)s, %(name)s, %(levelname)s, %(message)s",
+    datefmt="%m/%d/%Y %H:%M:%S",
+)
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "../"))
+
+from codegenome._file_format import LEGACY_CANON_FILE_VERSION  # noqa
+from codegenome._file_format import (CanonFile, CanonFileCache,
+                                     read_canon_file, write_canon_file)
+
+TEST_D = "/tmp/cg_file_format_test"
+
+
+def synthetic_canon(binid, names):
+    funcs = []
+    for name in names:
+        bc = ("bitcode of %s" % name.split(".")[0]).encode() * 10
+        funcs.append((hashlib.sha256(bc).hexdigest(), name, bc, (len(bc), 0)))
+    return {
+        "type": "canon",
+        "version": LEGACY_CANON_FILE_VERSION,
+        "binid": binid,
+        "funcs": funcs,
+        "file_meta": {"file_path": binid, "file_size": 1},
+    }
+
+
+class TestFileFormat(unittest.TestCase):
+    def setUp(self):
+        if os.path.exists(TEST_D):
+            shutil.rmtree(TEST_D)
+        os.makedirs(TEST_D)
+
+    def test_canon_file(self):
+        # f1.dup has the same bitcode as f1
+        canon = synthetic_canon("b1", ["f1", "f2", "f3", "f1.dup"])
+        path = write_canon_file(os.path.join(TEST_D, "b1.canon"), canon)
+
+        data = read_canon_file(path)
+        self.assertEqual(data["funcs"], canon["funcs"])
+        self.assertEqual(data["binid"], "b1")
+        self.assertEqual(data["file_meta"], canon["file_meta"])
+
+        for use_mmap in [True, False]:
+            with CanonFile(path, use_mmap=use_mmap) as cf:
+                self.assertEqual(cf.binid, "b1")
+                self.assertEqual(len(cf.funcs), 4)
+                self.assertEqual(len(cf.gene_ids()), 3)
+                for gid, _, bc, _ in canon["funcs"]:
+                    self.assertTrue(gid.upper() in cf)
+                    self.assertEqual(cf.get_bc(gid), bc)
+                self.assertIsNone(cf.get_bc("0" * 64))
+
+    def test_legacy_canon_file(self):
+        canon = synthetic_canon("b1", ["f1", "f2"])
+        path = os.path.join(TEST_D, "b1.canon")
+        with open(path, "wb") as f:
+            pickle.dump(canon, f)
+        self.assertEqual(read_canon_file(path)["funcs"], canon["funcs"])
+        cf = CanonFile(path)
+        for gid, _, bc, _ in canon["funcs"]:
+            self.assertEqual(cf.get_bc(gid), bc)
+
+    def test_canon_file_cache(self):
+        cache = CanonFileCache(max_open=2)
+        paths = []
+        for i in range(3):
+            canon = synthetic_canon("b%d" % i, ["f%d" % i])
+            paths.append(write_canon_file(os.path.join(TEST_D, "b%d.canon" % i), canon))
+        cf0 = cache.get(paths[0])
+        self.assertIs(cache.get(paths[0]), cf0)
+        cache.get(paths[1])
+        cache.get(paths[2])
+        self.assertEqual(len(cache), 2)
+        self.assertIsNot(cache.get(paths[0]), cf0)
+
+        # replaced on disk
+        canon = synthetic_canon("b0", ["g0"])
+        write_canon_file(paths[0], canon)
+        os.utime(paths[0], ns=(0, 0))
+        cf = cache.get(paths[0])
+        self.assertEqual(cf.get_bc(canon["funcs"][0][0]), canon["funcs"][0][2])
+        # the evicted reader is still usable
+        self.assertEqual(cf0.binid, "b0")
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
@@ -0,0 +1,62 @@
+import hashlib
+import logging
+import os
+import shutil
+import sys
+import unittest
+from unittest import mock
+
+logging.basicConfig(
+    filename="/tmp/cg-test-ingest.log",
+    level=logging.DEBUG,
+    format="%(asctime)s, %(name)s, %(levelname)s, %(message)s",
+    datefmt="%m/%d/%Y %H:%M:%S",
+)
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "../"))
+
+import codegenome.ingest  # noqa
+from codegenome.ingest import IngestContext, sha256_file  # noqa
+
+TEST_D = "/tmp/cg_ingest_test"
+
+
+class TestIngest(unittest.TestCase):
+    def setUp(self):
+        if os.path.exists(TEST_D):
+            shutil.rmtree(TEST_D)
+        os.makedirs(TEST_D)
+
+    def _file(self, name, data):
+        fn = os.path.join(TEST_D, name)
+        with open(fn, "wb") as f:
+            f.write(data)
+        return fn
+
+    def test_sha256_file(self):
+        for data in [b"", b"x", os.urandom(3000)]:
+            fn = self._file("bin", data)
+            expected = hashlib.sha256(data).hexdigest()
+            self.assertEqual(sha256_file(fn), expected)
+            self.assertEqual(sha256_file(fn, chunk_size=7), expected)
+            with mock.patch.object(codegenome.ingest, "HASH_MMAP_MIN_SIZE", 1):
+                self.assertEqual(sha256_file(fn), expected)
+
+    def test_ingest_context(self):
+        fn = self._file("bin", b"binary")
+        with mock.patch.object(
+            codegenome.ingest, "sha256_file", wraps=sha256_file
+        ) as h:
+            ctx = IngestContext(fn)
+            self.assertEqual(ctx.bin_id, hashlib.sha256(b"binary").hexdigest())
+            self.assertEqual(IngestContext.of(ctx).bin_id, ctx.bin_id)
+            self.assertEqual(h.call_count, 1)
+        self.assertEqual(ctx.metadata, {"file_path": fn, "file_size": 6})
+
+        ctx = IngestContext.of(fn, bin_id="abc")
+        self.assertEqual(ctx.bin_id, "abc")
+        self.assertEqual(str(ctx), fn)
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
@@ -57,5 +57,96 @@ class TestIR(unittest.TestCase):
         self.assertFalse("local_func" in f0_str)
 
 
+CANON_RECORDS = [
+    {
+        "name": "f0",
+        "extern": False,
+        "data": "",
+        "code": "define i64 @_F() {\nb1:\n  ret i64 1\n}",
+    },
+    {"name": "ext", "extern": True, "data": "", "code": ""},
+    {"name": "bad", "extern": False, "data": "", "code": "not llvm ir"},
+    {
+        "name": "f1",
+        "extern": False,
+        "data": "@gv2 = global i64 2\n@gv1 = global i64 1\n",
+        "code": "define i64 @_F() {\nb1:\n  %v1 = load i64, ptr @gv1\n  ret i64 %v1\n}",
+    },
+]
+
+
+class _JsonlCanonPassBinary(object):
+    # canonicalization pass replaced by an existing jsonl output
+    def canon_pass(self):
+        return self.output
+
+
+class TestCanon(unittest.TestCase):
+    def test_serialize(self):
+        import io
+
+        from codegenome.ir.canon import IRCanonPassBinary
+
+        class CanonBinary(_JsonlCanonPassBinary, IRCanonPassBinary):
+            pass
+
+        path = "/tmp/cg-test-canon.jsonl"
+        with open(path, "w") as f:
+            for r in CANON_RECORDS:
+                f.write(json.dumps(r) + "\n")
+
+        out = []
+        for workers in [1, 2]:
+            statf = io.StringIO()
+            irb = CanonBinary(
+                b"", output=path, bin_id="x", workers=workers, chunk_size=1
+            )
+            out.append(irb.serialize(statf))
+            stat = json.loads(statf.getvalue().strip().split("\n")[-1])
+            self.assertEqual(stat["total"], 2)
+            self.assertEqual(stat["errors"], 1)
+            self.assertEqual(stat["func_count"], 3)
+            for k in ["sort_time", "parse_time", "bitcode_time", "hash_time"]:
+                self.assertTrue(k in stat)
+
+        self.assertEqual(out[0], out[1])
+        self.assertEqual([x[1] for x in out[0]], ["f0", "f1"])
+        gid, _, bc, meta = out[0][0]
+        self.assertEqual(meta, (len(bc), 0))
+
+    def test_serialize_stream(self):
+        from codegenome.ir.canon import IRCanonPassBinary
+
+        # fake llvm with an `opt` writing the records to --canon-out
+        llvm_path = "/tmp/cg-test-llvm"
+        os.makedirs(os.path.join(llvm_path, "bin"), exist_ok=True)
+        opt = os.path.join(llvm_path, "bin", "opt")
+        with open(opt, "w") as f:
+            f.write(
+                "#!%s\n"
+                "import json, sys\n"
+                "ir = sys.stdin.buffer.read()\n"
+                "out = open(sys.argv[sys.argv.index('--canon-out') + 1], 'w')\n"
+                "for r in %r:\n"
+                "    out.write(json.dumps(r) + '\\n')\n"
+                "    out.flush()\n"
+                "sys.exit(int(ir == b'fail'))\n" % (sys.executable, CANON_RECORDS)
+            )
+        os.chmod(opt, 0o755)
+
+        for workers in [1, 2]:
+            irb = IRCanonPassBinary(
+                b"ir" * 100000, output=None, llvm_path=llvm_path, workers=workers
+            )
+            fns = irb.serialize()
+            self.assertEqual([x[1] for x in fns], ["f0", "f1"])
+            self.assertTrue("pass_time" in irb.stat)
+
+        irb = IRCanonPassBinary(b"fail", output=None, llvm_path=llvm_path)
+        self.assertTrue(irb.serialize() is None)
+        irb = IRCanonPassBinary(b"", output=None, llvm_path="/nonexistent")
+        self.assertTrue(irb.serialize() is None)
+
+
 if __name__ == "__main__":
     unittest.main(verbosity=2)
@@ -0,0 +1,247 @@
+import logging
+import os
+import shutil
+import sqlite3
+import sys
+import threading
+import time
+import unittest
+
+logging.basicConfig(
+    filename="/tmp/cg-test-jobs.log",
+    level=logging.DEBUG,
+    format="%(asctime)s, %(name)s, %(levelname)s, %(message)s",
+    datefmt="%m/%d/%Y %H:%M:%S",
+)
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "../utils/app")
+)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "../"))
+
+from app.core.genome_service import API_STATE_RESULT_NOT_READY  # noqa
+from app.core.genome_service import GenomeService, JobDBDict  # noqa
+from app.core.scheduler import JobScheduler  # noqa
+from app.core.scheduler import (JOB_CANCELLED, JOB_COMPLETED,  # noqa
+                                JOB_ERROR, JOB_QUEUED, JOB_RUNNING)
+from synthetic_kg import add_synthetic_bin  # noqa
+
+TEST_D = "/tmp/cg_test_jobs"
+WAIT_SECS = 20
+
+
+def wait_for(cond, secs=WAIT_SECS):
+    end = time.time() + secs
+    while time.time() < end:
+        if cond():
+            return True
+        time.sleep(0.05)
+    return False
+
+
+def committed_rows(fn):
+    # rows visible to another connection
+    conn = sqlite3.connect(fn)
+    try:
+        return conn.execute("SELECT COUNT(*) FROM jobs").fetchone()[0]
+    finally:
+        conn.close()
+
+
+class TestJobs(unittest.TestCase):
+    def setUp(self):
+        shutil.rmtree(TEST_D, ignore_errors=True)
+        os.makedirs(TEST_D)
+        self.fn = os.path.join(TEST_D, "jobs.sqlite")
+        self.done = []
+        self.release = threading.Event()
+
+    def tearDown(self):
+        self.release.set()
+
+    def _scheduler(self, jobs, workers=1):
+        self.sched = JobScheduler(jobs, resolve=self._target, workers=workers)
+        return self.sched
+
+    def _target(self, name):
+        return getattr(self, "_" + name)
+
+    def _record(self, job_id):
+        self.done.append(job_id)
+        job = self.sched._jobs[job_id]
+        job["status"] = JOB_COMPLETED
+        job["end_ts"] = time.time()
+        self.sched._jobs[job_id] = job
+
+    def _block(self, job_id):
+        self.release.wait(WAIT_SECS)
+        self._record(job_id)
+
+    def _sleep(self, job_id):
+        self.sched.run_command(["sleep", "30"])
+        self._record(job_id)
+
+    def test_priority_order(self):
+        jobs = JobDBDict(self.fn, commit_interval=0)
+        sched = self._scheduler(jobs)
+        for job_id, priority in [("a", 20), ("b", 5), ("c", 10), ("d", 5)]:
+            sched.submit(job_id, "record", [job_id], priority)
+        self.assertEqual(
+            sched.metrics()["queued_by_priority"], {"20": 1, "5": 2, "10": 1}
+        )
+        sched.start()
+        self.assertTrue(wait_for(lambda: len(self.done) == 4))
+        # lower first, submit order within a priority
+        self.assertEqual(self.done, ["b", "d", "c", "a"])
+        self.assertTrue(wait_for(lambda: sched.counts[JOB_COMPLETED] == 4))
+        self.assertNotIn("args", jobs["a"])
+
+    def test_cancel_queued(self):
+        jobs = JobDBDict(self.fn, commit_interval=0)
+        sched = self._scheduler(jobs)
+        sched.start()
+        sched.submit("a", "block", ["a"])
+        self.assertTrue(wait_for(lambda: jobs["a"]["status"] == JOB_RUNNING))
+        sched.submit("b", "record", ["b"])
+        sched.submit("c", "record", ["c"])
+        self.assertTrue(sched.cancel("b"))
+        self.assertFalse(sched.is_active("b"))
+        self.assertEqual(jobs["b"]["status"], JOB_CANCELLED)
+        self.assertNotIn("args", jobs["b"])
+        self.assertFalse(sched.cancel("b"))
+
+        self.release.set()
+        self.assertTrue(wait_for(lambda: self.done == ["a", "c"]))
+        self.assertEqual(jobs["b"]["status"], JOB_CANCELLED)
+
+    def test_cancel_running_command(self):
+        jobs = JobDBDict(self.fn, commit_interval=0)
+        sched = self._scheduler(jobs)
+        sched.start()
+        sched.submit("a", "sleep", ["a"])
+        self.assertTrue(wait_for(lambda: jobs["a"]["status"] == JOB_RUNNING))
+        time.sleep(0.2)  # the command is started
+        ts = time.time()
+        self.assertTrue(sched.cancel("a"))
+        self.assertTrue(wait_for(lambda: not sched.is_active("a")))
+        self.assertLess(time.time() - ts, 10)
+        self.assertTrue(wait_for(lambda: jobs["a"]["status"] == JOB_CANCELLED))
+        self.assertEqual(self.done, [])
+        self.assertEqual(sched.counts[JOB_CANCELLED], 1)
+
+    def test_recover(self):
+        jobs = JobDBDict(self.fn, commit_interval=0)
+        sched = self._scheduler(jobs)  # never started, as if stopped
+        sched.submit("a", "record", ["a"], 10)
+        sched.submit("b", "record", ["b"], 5)
+        running = jobs["a"]
+        running["status"] = JOB_RUNNING
+        jobs["r"] = running
+        jobs["x"] = {"start_ts": 0, "status": JOB_COMPLETED, "end_ts": 1}
+        jobs.close()
+
+        jobs = JobDBDict(self.fn, commit_interval=0)
+        sched = self._scheduler(jobs)
+        self.assertEqual(sched.recover(), 2)
+        # the running job of the previous run is lost
+        self.assertEqual(jobs["r"]["status"], JOB_ERROR)
+        self.assertEqual(jobs["x"]["status"], JOB_COMPLETED)
+        sched.start()
+        self.assertTrue(wait_for(lambda: len(self.done) == 2))
+        self.assertEqual(self.done, ["b", "a"])
+
+    def test_commit_interval(self):
+        jobs = JobDBDict(self.fn, commit_interval=0.2)
+        jobs["a"] = {"status": JOB_QUEUED}
+        # pending, but visible to this connection
+        self.assertEqual(committed_rows(self.fn), 0)
+        self.assertEqual(jobs["a"]["status"], JOB_QUEUED)
+        self.assertTrue(wait_for(lambda: committed_rows(self.fn) == 1))
+        jobs.close()
+
+        jobs = JobDBDict(self.fn, commit_interval=60, commit_batch=3)
+        jobs["b"] = {"status": JOB_QUEUED}
+        jobs["c"] = {"status": JOB_QUEUED}
+        self.assertEqual(committed_rows(self.fn), 1)
+        jobs["d"] = {"status": JOB_QUEUED}
+        self.assertEqual(committed_rows(self.fn), 4)
+        jobs["e"] = {"status": JOB_QUEUED}
+        jobs.close()
+        self.assertEqual(committed_rows(self.fn), 5)
+
+    def test_evict(self):
+        jobs = JobDBDict(self.fn, commit_interval=0)
+        now = time.time()
+        jobs["old"] = {"status": JOB_COMPLETED, "end_ts": now - 120}
+        jobs["new"] = {"status": JOB_COMPLETED, "end_ts": now - 10}
+        jobs["newer"] = {"status": JOB_ERROR, "end_ts": now - 5}
+        jobs["queued"] = {"status": JOB_QUEUED, "start_ts": now - 1000}
+        jobs["running"] = {"status": JOB_RUNNING, "start_ts": now - 1000}
+
+        self.assertEqual(jobs.evict(max_age_secs=-1), 0)
+        self.assertEqual(jobs.evict(max_age_secs=60), 1)
+        self.assertEqual(sorted(jobs.keys()), ["new", "newer", "queued", "running"])
+        self.assertEqual(jobs.evict(max_count=1), 1)
+        self.assertEqual(sorted(jobs.keys()), ["newer", "queued", "running"])
+        self.assertEqual(jobs.evict(max_age_secs=0, max_count=0), 1)
+        self.assertEqual(sorted(jobs.keys()), ["queued", "running"])
+        jobs.vacuum()
+        self.assertEqual(len(jobs), 2)
+
+
+class TestServiceJobs(unittest.TestCase):
+    def setUp(self):
+        shutil.rmtree(TEST_D, ignore_errors=True)
+        os.makedirs(TEST_D)
+        self.service = GenomeService(
+            {
+                "cache_dir": TEST_D,
+                "gene_dir": os.path.join(TEST_D, "local.kg"),
+                "service_workers": 1,
+                "jobs_commit_interval_secs": 0,
+                "jobs_reap_interval_secs": 0,
+                "jobs_result_ttl_secs": 60,
+            }
+        )
+
+    def _compare(self, file_id1, file_id2):
+        ret = self.service.api_files_compare_kg(file_id1, file_id2)
+        if ret.get("status") == API_STATE_RESULT_NOT_READY:
+            job_id = ret["job_id"]
+            self.assertTrue(
+                wait_for(lambda: self.service._jobs[job_id].get("result") is not None)
+            )
+            ret = self.service.api_files_compare_kg(file_id1, file_id2)
+        return ret
+
+    def test_delete_file_invalidates_compares(self):
+        kg = self.service.kg
+        b1 = add_synthetic_bin(kg, "b1", ["x", "y", "z"])
+        b2 = add_synthetic_bin(kg, "b2", ["x", "y"])
+        b3 = add_synthetic_bin(kg, "b3", ["x", "w"])
+
+        ret = self._compare(b1, b2)
+        self.assertEqual(ret["results"]["matches"]["match_count"], 2)
+        self._compare(b1, b3)
+        self.assertEqual(len(self.service._jobs.keys_by_file_id(b2)), 1)
+        self.assertEqual(len(self.service._jobs.keys_by_file_id(b1)), 2)
+
+        self.service.delete_file(b2)
+        self.assertEqual(self.service._jobs.keys_by_file_id(b2), [])
+        # the compare with b3 is still cached
+        self.assertEqual(len(self.service._jobs.keys_by_file_id(b1)), 1)
+        ret = self.service.api_files_compare_kg(b1, b3)
+        self.assertEqual(ret["results"]["matches"]["match_count"], 1)
+
+    def test_cleanup_jobs(self):
+        jobs = self.service._jobs
+        jobs["old"] = {"status": JOB_COMPLETED, "end_ts": time.time() - 120}
+        jobs["new"] = {"status": JOB_COMPLETED, "end_ts": time.time()}
+        jobs["queued"] = {"status": JOB_QUEUED, "start_ts": 0}
+        self.assertEqual(self.service._cleanup_jobs(), 1)
+        self.assertEqual(sorted(jobs.keys()), ["new", "queued"])
+        self.assertEqual(self.service.status()["jobs"]["evicted"], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
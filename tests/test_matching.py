@@ -0,0 +1,248 @@
+import logging
+import os
+import sys
+import unittest
+
+import numpy as np
+
+logging.basicConfig(
+    filename="/tmp/cg-test-matching.log",
+    level=logging.DEBUG,
+    format="%(asctime)s, %(name)s, %(levelname)s, %(message)s",
+    datefmt="%m/%d/%Y %H:%M:%S",
+)
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "../"))
+
+from codegenome.genes.utils import gene_similarity_by_ver  # noqa
+from codegenome.kg.matching import near_match_hits  # noqa
+from codegenome.kg.matching import (match_extra_genes,
+                                    optimal_match_extra_genes,
+                                    similarity_blocks)
+
+
+def legacy_match_extra_genes(
+    g1extra, g2extra, g1dict, g2dict, e1dict, f2dict, match_sim_thr, mismatch_sim_thr
+):
+    # reference: the former pairwise loop of files_compare_by_shared_genes
+    g2extra = list(g2extra)
+    xmatch = []
+    xdel = []
+    xadd = []
+    xmismatch = []
+    for g1id in g1extra:
+        best_match_id = None
+        best_match_sim = 0.0
+
+        f1s = e1dict.get(g1id).get("func_names", [])
+        func_match = None
+        for f1 in f1s:
+            g2id = f2dict.get(f1)
+            if g2id:
+                best_match_id = g2id
+                best_match_sim = gene_similarity_by_ver(
+                    g1dict[g1id], g2dict[g2id], adjusted=False, normalized=True
+                )
+                if best_match_sim >= match_sim_thr:
+                    xmatch.append([g1id, best_match_id, best_match_sim])
+                    if best_match_id in g2extra:
+                        g2extra.remove(best_match_id)
+                    func_match = True
+                    break
+                func_match = False
+
+        if func_match is not None:
+            if not f1.startswith("function_"):
+                if func_match == False:
+                    if best_match_sim > mismatch_sim_thr:
+                        xmismatch.append([g1id, g2id, best_match_sim])
+                    else:
+                        xdel.append([g1id, best_match_id, best_match_sim])
+                        xadd.append([g2id, best_match_sim])
+                    if g2id in g2extra:
+                        g2extra.remove(g2id)
+                continue
+
+        if best_match_sim < match_sim_thr:
+            for g2id in g2extra:
+                sim = gene_similarity_by_ver(
+                    g1dict[g1id], g2dict[g2id], adjusted=False, normalized=True
+                )
+                if best_match_sim is None:
+                    best_match_sim = sim
+                    best_match_id = g2id
+                elif best_match_sim < sim:
+                    best_match_sim = sim
+                    best_match_id = g2id
+
+        if best_match_sim >= match_sim_thr:
+            xmatch.append([g1id, best_match_id, best_match_sim])
+            if best_match_id in g2extra:
+                g2extra.remove(best_match_id)
+        else:
+            xdel.append([g1id, best_match_id, best_match_sim])
+
+    return xmatch, xmismatch, xdel, xadd, g2extra
+
+
+def synthetic_compare_input(seed, n1=120, n2=100, dim=64):
+    """
+    Two files sharing mutated genes, renamed, address named (`function_*`) and
+    duplicated functions.
+    """
+    rs = np.random.RandomState(seed)
+    base = rs.rand(n1, dim).astype("float32")
+    g1dict, e1dict, g2dict, f2dict = {}, {}, {}, {}
+
+    def add(gdict, gid, value):
+        gdict[gid] = {"id": gid, "value": value}
+
+    for i in range(n1):
+        gid = "a%d" % i
+        add(g1dict, gid, base[i])
+        name = ("function_%x" % i) if i % 7 == 0 else "f%d" % i
+        e1dict[gid] = {"to": gid, "func_names": [name] if i % 11 else []}
+
+    for j in range(n2):
+        gid = "b%d" % j
+        i = rs.randint(n1)
+        noise = rs.choice([0.0, 0.001, 0.01, 0.05, 0.5])
+        value = base[i] + noise * rs.randn(dim).astype("float32")
+        if j % 13 == 0:
+            value = g2dict["b%d" % (j - 1)]["value"] if j else value  # exact ties
+        add(g2dict, gid, value.astype("float32"))
+        r = rs.rand()
+        if r < 0.5:
+            f2dict["f%d" % i] = gid
+        elif r < 0.6:
+            f2dict["function_%x" % i] = gid
+        elif r < 0.7:
+            f2dict["f%d" % rs.randint(n1)] = gid
+    return list(g1dict), list(g2dict), g1dict, g2dict, e1dict, f2dict
+
+
+class TestMatching(unittest.TestCase):
+    def test_match_extra_genes_equivalence(self):
+        for seed in range(4):
+            args = synthetic_compare_input(seed)
+            for thr, mthr in [(0.99, 0.8), (0.9, 0.7), (0.5, 0.3)]:
+                expected = legacy_match_extra_genes(*args, thr, mthr)
+                for block_size in [7, 1024]:
+                    got = match_extra_genes(*args, thr, mthr, block_size=block_size)
+                    self.assertEqual(got, expected)
+
+    def test_match_extra_genes_empty(self):
+        g1, g2, g1dict, g2dict, e1dict, f2dict = synthetic_compare_input(0)
+        args = (g1dict, g2dict, e1dict, f2dict, 0.99, 0.8)
+        self.assertEqual(
+            match_extra_genes(g1, [], *args), legacy_match_extra_genes(g1, [], *args)
+        )
+        self.assertEqual(match_extra_genes([], g2, *args), ([], [], [], [], g2))
+
+    def test_optimal_match_extra_genes(self):
+        g1, g2, g1dict, g2dict, e1dict, _ = synthetic_compare_input(0)
+        xmatch, xmismatch, xdel, xadd, g2rest = optimal_match_extra_genes(
+            g1, g2, g1dict, g2dict, 0.99, 0.8
+        )
+        # one to one and every gene accounted for
+        pairs = xmatch + xmismatch
+        self.assertEqual(len(set(x[0] for x in pairs)), len(pairs))
+        self.assertEqual(len(set(x[1] for x in pairs)), len(pairs))
+        self.assertEqual(len(pairs) + len(xdel), len(g1))
+        self.assertEqual(len(pairs) + len(g2rest), len(g2))
+        self.assertEqual([x[0] for x in xadd], g2rest)
+        for _, _, sim in xmatch:
+            self.assertGreaterEqual(sim, 0.99)
+        for _, _, sim in xmismatch:
+            self.assertTrue(0.8 < sim < 0.99)
+
+        # deterministic
+        got = optimal_match_extra_genes(g1[::-1], g2[::-1], g1dict, g2dict, 0.99, 0.8)
+        self.assertEqual(got, (xmatch, xmismatch, xdel, xadd, g2rest))
+
+        # at least as many matches as the greedy matching
+        greedy = match_extra_genes(g1, g2, g1dict, g2dict, e1dict, {}, 0.99, 0.8)
+        self.assertGreaterEqual(len(xmatch), len(greedy[0]))
+
+    def test_optimal_match_beats_greedy(self):
+        # a1 is greedily matched to b1, leaving a2 without a match
+        v = np.zeros(4, dtype="float32")
+        g1dict = {"a1": {"value": v + 0.5}, "a2": {"value": v + 0.52}}
+        g2dict = {"b1": {"value": v + 0.51}, "b2": {"value": v + 0.49}}
+        e1dict = {"a1": {}, "a2": {}}
+        greedy = match_extra_genes(
+            ["a1", "a2"], ["b1", "b2"], g1dict, g2dict, e1dict, {}, 0.985, 0.9
+        )
+        self.assertEqual([x[:2] for x in greedy[0]], [["a1", "b1"]])
+        xmatch, _, _, _, g2rest = optimal_match_extra_genes(
+            ["a1", "a2"], ["b1", "b2"], g1dict, g2dict, 0.985, 0.9
+        )
+        self.assertEqual([x[:2] for x in xmatch], [["a1", "b2"], ["a2", "b1"]])
+        self.assertEqual(g2rest, [])
+
+    def test_optimal_match_prefers_matches(self):
+        # two mismatches (0.85) have a greater total similarity than the
+        # single match (0.995), the match is kept anyway
+        v = np.random.RandomState(0).rand(320).astype("float32")
+        g1dict = {"a1": {"value": v}, "a2": {"value": v - 0.145}}
+        g2dict = {"b1": {"value": v + 0.005}, "b2": {"value": v + 0.15}}
+        e1dict = {"a1": {}, "a2": {}}
+        args = (["a1", "a2"], ["b1", "b2"], g1dict, g2dict)
+        greedy = match_extra_genes(*args, e1dict, {}, 0.99, 0.8)
+        self.assertEqual([x[:2] for x in greedy[0]], [["a1", "b1"]])
+        xmatch, xmismatch, xdel, _, g2rest = optimal_match_extra_genes(*args, 0.99, 0.8)
+        self.assertEqual([x[:2] for x in xmatch], [["a1", "b1"]])
+        self.assertEqual(xmismatch, [])
+        self.assertEqual([x[0] for x in xdel], ["a2"])
+        self.assertEqual(g2rest, ["b2"])
+
+    def test_optimal_match_symmetric(self):
+        # genes are compared by value, equal genes are interchangeable
+        def result(out, gdict, swap=False):
+            xmatch, xmismatch, xdel, xadd, _ = out
+            key = lambda x: gdict[x]["value"].tobytes()
+            pairs = [
+                sorted(
+                    (key(x[0]), key(x[1]))[:: -1 if swap else 1] + (x[2],) for x in xs
+                )
+                for xs in [xmatch, xmismatch]
+            ]
+            rest = [sorted(key(x[0]) for x in xs) for xs in [xdel, xadd]]
+            return pairs + (rest[::-1] if swap else rest)
+
+        # the nearest gene of b0 and b1 is a0 with k=1
+        e0 = np.ones(1, dtype="float32")
+        g1dict = {"a0": {"value": 0.04 * e0}, "a1": {"value": 0.17 * e0}}
+        g2dict = {"b0": {"value": 0.0 * e0}, "b1": {"value": 0.1 * e0}}
+        cases = [(list(g1dict), list(g2dict), g1dict, g2dict, 0.9, 0.8, 1)]
+        for seed in range(3):
+            g1, g2, g1dict, g2dict, _, _ = synthetic_compare_input(seed)
+            for k in [1, 3]:
+                cases.append((g1, g2, g1dict, g2dict, 0.99, 0.8, k))
+
+        for i, (g1, g2, g1dict, g2dict, thr, mthr, k) in enumerate(cases):
+            gdict = dict(g1dict, **g2dict)
+            ab = optimal_match_extra_genes(g1, g2, g1dict, g2dict, thr, mthr, k=k)
+            ba = optimal_match_extra_genes(g2, g1, g2dict, g1dict, thr, mthr, k=k)
+            self.assertEqual(result(ab, gdict), result(ba, gdict, swap=True))
+            if i == 0:
+                self.assertEqual(len(ab[0]), 2)
+
+    def test_near_match_hits(self):
+        rs = np.random.RandomState(0)
+        m1 = rs.rand(30, 16)
+        m2 = np.concatenate([m1[rs.randint(30, size=40)], rs.rand(20, 16)])
+        m2 += 0.01 * rs.randn(*m2.shape)
+        starts = [0, 7, 25, 26, 50]
+        sims = np.concatenate([b for _, b in similarity_blocks(m1, m2)])
+        ends = starts[1:] + [len(m2)]
+        for block_size in [4, 1024]:
+            hits, cols = near_match_hits(m1, m2, starts, 0.98, block_size=block_size)
+            for j, (s, e) in enumerate(zip(starts, ends)):
+                seg = sims[:, s:e] >= 0.98
+                self.assertTrue(np.array_equal(hits[:, j], seg.any(axis=1)))
+                self.assertEqual(cols[j], seg.any(axis=0).sum())
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
@@ -41,6 +41,19 @@ class TestSigmal(unittest.TestCase):
         self.assertFalse(np.array_equal(g3, g4))
         self.assertFalse(np.array_equal(g4, g5))
 
+    def test_gene_batch(self):
+        bcs = [self.irb.fs[f].get_bc() for f in sorted(self.irb.fs)]
+        expected = [self.sm.from_bitcode(bc, "sigmal2") for bc in bcs]
+        for workers, chunk_size in [(1, 64), (2, 1)]:
+            genes = list(
+                self.sm.from_bitcodes(
+                    bcs, "sigmal2", workers=workers, chunk_size=chunk_size
+                )
+            )
+            self.assertEqual(len(genes), len(bcs))
+            for g1, g2 in zip(genes, expected):
+                self.assertTrue(np.array_equal(g1, g2))
+
 
 if __name__ == "__main__":
     unittest.main(verbosity=2)
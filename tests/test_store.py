@@ -0,0 +1,487 @@
+import logging
+import os
+import shutil
+import sys
+import unittest
+
+import joblib
+import numpy as np
+
+logging.basicConfig(
+    filename="/tmp/cg-test-store.log",
+    level=logging.DEBUG,
+    format="%(asctime)s, %(name)s, %(levelname)s, %(message)s",
+    datefmt="%m/%d/%Y %H:%M:%S",
+)
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "../"))
+
+from synthetic_kg import synthetic_genes  # noqa
+from synthetic_kg import add_synthetic_bin, hash_id, write_synthetic_gene_file
+
+from codegenome._defaults import RANKING_CALCULATION_METHODS  # noqa
+from codegenome._file_format import LEGACY_GENE_FILE_VERSION  # noqa
+from codegenome._file_format import (GKGIndexFile, write_canon_file,
+                                     write_gkg_index)
+from codegenome.ids import id_bytes, id_hex  # noqa
+from codegenome.kg import GenomeKG  # noqa
+from codegenome.kg.graph import (GRAPH_COLUMNS, GRAPH_ID_COLUMNS,  # noqa
+                                 BinGeneGraph)
+from codegenome.kg.store import DigestIDRegistry  # noqa
+from codegenome.kg.store import (GENE_ID_DTYPE, FuncNameIndex, GeneIDRegistry,
+                                 GeneStore)
+
+TEST_D = "/tmp/cg_store_test"
+KG_REPO = os.path.join(TEST_D, "testkg.gkg")
+
+
+class TestStore(unittest.TestCase):
+    def setUp(self):
+        if os.path.exists(TEST_D):
+            shutil.rmtree(TEST_D)
+        os.makedirs(TEST_D)
+
+    def test_registry(self):
+        reg = GeneIDRegistry(["a", "b"])
+        self.assertEqual(reg.append("c"), 2)
+        self.assertEqual(reg.append("a"), 0)
+        self.assertEqual(len(reg), 3)
+        self.assertEqual(reg[1], "b")
+        self.assertEqual(reg.row("c"), 2)
+        self.assertTrue(reg.row("x") is None)
+
+        reg.rebuild(["c", "a"])
+        self.assertEqual(reg.ids, ["c", "a"])
+        self.assertEqual(reg.row("a"), 1)
+        self.assertFalse("b" in reg)
+
+    def test_digest_registry(self):
+        a, b = hash_id("a"), hash_id("b")
+        reg = DigestIDRegistry([a, id_bytes(b)])
+        self.assertEqual(reg.digests, [id_bytes(a), id_bytes(b)])
+        self.assertEqual(reg.append(a.upper()), 0)
+        self.assertEqual(reg[1], b)
+        self.assertEqual(reg.ids, [a, b])
+        self.assertEqual(reg.ids[-1:], [b])
+        self.assertEqual(reg.row(id_bytes(b)), 1)
+        self.assertTrue(reg.row("b") is None)
+        self.assertFalse(None in reg)
+        self.assertRaises(ValueError, reg.append, "b")
+
+    def test_kg_legacy_hex_ids(self):
+        # gene files and index columns written with hex ids
+        kg = GenomeKG(KG_REPO)
+        genes = synthetic_genes("b1", ["x", "y"])
+        genes["version"] = LEGACY_GENE_FILE_VERSION
+        genes["binid"] = id_hex(genes["binid"])
+        genes["genes"] = [(id_hex(x[0]),) + x[1:] for x in genes["genes"]]
+        joblib.dump(genes, kg._get_gene_file_path(genes["binid"]))
+        kg.load(workers=1)
+        self.assertEqual(kg.gene_ids, [hash_id("x"), hash_id("y")])
+        self.assertEqual(list(kg.bins), [hash_id("b1")])
+        self.assertEqual(kg.genes.columns()["gene_ids"].dtype, GENE_ID_DTYPE)
+
+        columns = kg.genes.columns()
+        columns["gene_ids"] = np.array(list(kg.gene_ids), dtype="S64")
+        store = GeneStore.from_columns(columns)
+        self.assertEqual(store.ids, kg.gene_ids)
+        self.assertEqual(
+            store.columns()["gene_ids"].tobytes(), b"".join(store.registry.digests)
+        )
+
+        columns = kg.graph.columns()
+        columns["strings"].update(
+            {k: list(getattr(kg.graph, k)) for k in GRAPH_ID_COLUMNS}
+        )
+        graph = BinGeneGraph.from_columns(
+            {k: v for k, v in columns.items() if k not in GRAPH_ID_COLUMNS}
+        )
+        self.assertEqual(dict(graph.gene_2_bin), dict(kg.gene_2_bin))
+
+    def test_kg_gene_ids(self):
+        kg = GenomeKG(KG_REPO)
+        b1 = add_synthetic_bin(kg, "b1", ["x", "y", "z"])
+        b2 = add_synthetic_bin(kg, "b2", ["y", "w"])
+
+        self.assertEqual(kg.gene_ids, [hash_id(x) for x in ["x", "y", "z", "w"]])
+
+        # query returns the gene at the registry row
+        for gid in kg.gene_ids:
+            d, g = kg.query_gene(kg.get_gene(gid))[0]
+            self.assertEqual(g, gid)
+            self.assertAlmostEqual(d, 0.0)
+
+        kg.delete_file(b1)
+        self.assertEqual(kg.gene_ids, [hash_id(x) for x in ["y", "w"]])
+        self.assertTrue(kg.gene_tree is None)
+        self.assertEqual(kg.gene_2_bin[hash_id("y")], [b2])
+        d, g = kg.query_gene(kg.get_gene(hash_id("w")))[0]
+        self.assertEqual(g, hash_id("w"))
+
+    def test_gene_store(self):
+        store = GeneStore(capacity=2)
+        genes = np.random.RandomState(0).rand(5, 320).astype("float32")
+        for i in range(5):
+            self.assertEqual(store.add(hash_id(i), genes[i], (i, 0)), i)
+        self.assertEqual(store.add(hash_id(0), genes[1], (9, 9)), 0)
+        self.assertEqual(len(store), 5)
+        self.assertTrue(np.array_equal(store.matrix(), genes))
+        self.assertEqual(store[hash_id(3)][1], (3, 0))
+
+        path = os.path.join(TEST_D, "index")
+        write_gkg_index(path, store.columns())
+        idx = GKGIndexFile(path)
+        store = GeneStore.from_columns({k: idx.load(k) for k in idx.sections})
+        self.assertTrue(isinstance(store.matrix(), np.memmap))
+        self.assertEqual(store.ids, [hash_id(i) for i in range(5)])
+
+        # append to a memory mapped store
+        store.add(hash_id(5), genes[0], (5, 0))
+        self.assertTrue(np.array_equal(store.matrix([5, 1]), genes[[0, 1]]))
+        self.assertTrue(np.array_equal(store.head(3), genes[:3]))
+        self.assertTrue(np.array_equal(store.head(6), store.matrix()))
+
+        store.remove([hash_id(1), hash_id(3)])
+        self.assertEqual(store.ids, [hash_id(i) for i in [0, 2, 4, 5]])
+        self.assertTrue(np.array_equal(store.get_gene(hash_id(4)), genes[4]))
+        self.assertEqual(store.get_meta(hash_id(5)), (5, 0))
+
+    def test_index_verify(self):
+        path = os.path.join(TEST_D, "index")
+        genes = np.random.RandomState(0).rand(5, 320).astype("float32")
+        write_gkg_index(path, {"genes": genes, "meta": {"x": 1}})
+        fpath = os.path.join(path, GKGIndexFile(path).toc["sections"]["genes"]["file"])
+        with open(fpath, "r+b") as f:
+            f.seek(-1, os.SEEK_END)
+            f.write(b"x")
+
+        # sections are verified on first access, memory mapped or not
+        idx = GKGIndexFile(path)
+        self.assertEqual(idx.load("meta"), {"x": 1})
+        with self.assertRaises(Exception):
+            idx.load("genes")
+        with self.assertRaises(Exception):
+            GKGIndexFile(path).load("genes", mmap_mode=None)
+        with self.assertRaises(Exception):
+            GKGIndexFile(path, verify="full").load("genes")
+        idx = GKGIndexFile(path, verify="size")
+        self.assertEqual(idx.load("genes").shape, genes.shape)
+        self.assertEqual(GKGIndexFile(path, verify=False).load("genes").shape, (5, 320))
+
+        with open(fpath, "ab") as f:
+            f.write(b"x")
+        with self.assertRaises(Exception):
+            GKGIndexFile(path).load("genes")
+
+    def test_kg_index(self):
+        kg = GenomeKG(KG_REPO)
+        add_synthetic_bin(kg, "b1", ["x", "y", "z"])
+        add_synthetic_bin(kg, "b2", ["y", "w"])
+        kg.save_index()
+
+        kg2 = GenomeKG(KG_REPO)
+        kg2.load(update=False)
+        self.assertEqual(kg2.gene_ids, kg.gene_ids)
+        self.assertEqual(kg2.bins, kg.bins)
+        for gid in kg.gene_ids:
+            self.assertTrue(np.array_equal(kg2.get_gene(gid), kg.get_gene(gid)))
+            self.assertEqual(kg2.get_gene_size(gid), kg.get_gene_size(gid))
+
+    def test_kg_index_lazy_sections(self):
+        kg = GenomeKG(KG_REPO)
+        add_synthetic_bin(kg, "b1", ["x", "y", "z"])
+        kg.compute_tree()
+        path = kg.save_index()
+
+        kg2 = GenomeKG(KG_REPO)
+        self.assertTrue(kg2.load_index())
+        self.assertEqual(kg2._index._cache, {})
+        self.assertEqual(len(kg2.bins), 1)
+        self.assertEqual(
+            sorted(kg2._index._cache.keys()),
+            sorted(
+                "graph." + x for x in GRAPH_COLUMNS + GRAPH_ID_COLUMNS + ["strings"]
+            ),
+        )
+        d, g = kg2.query_gene(kg.get_gene(hash_id("y")))[0]
+        self.assertEqual(g, hash_id("y"))
+
+        # corrupt a section
+        with open(os.path.join(path, "bin_metas.pkl"), "ab") as f:
+            f.write(b"x")
+        kg3 = GenomeKG(KG_REPO)
+        kg3.load_index()
+        with self.assertRaises(Exception):
+            kg3.bin_metas
+
+        # a memory mapped section of the same size
+        with open(os.path.join(path, "store.genes.npy"), "r+b") as f:
+            f.seek(-1, os.SEEK_END)
+            f.write(b"x")
+        kg4 = GenomeKG(KG_REPO)
+        kg4.load_index()
+        self.assertEqual(len(kg4.bins), 1)
+        with self.assertRaises(Exception):
+            kg4.get_gene(hash_id("y"))
+
+    def test_kg_parallel_load(self):
+        kg = GenomeKG(KG_REPO)
+        for i in range(6):
+            write_synthetic_gene_file(kg, "b%d" % i, ["x", "y%d" % i, "z%d" % i])
+        with open(kg._get_gene_file_path(hash_id("corrupt")), "wb") as f:
+            f.write(b"not a gene file")
+
+        progress = []
+        kg = GenomeKG(KG_REPO)
+        self.assertTrue(
+            kg.load(workers=2, batch_size=2, progress=lambda x: progress.append(x))
+        )
+        self.assertEqual(len(kg.bins), 6)
+        self.assertEqual(len(kg.gene_ids), 13)
+        self.assertEqual(len(kg.gene_2_bin[hash_id("x")]), 6)
+        self.assertEqual(progress[-1]["skipped"], 1)
+        self.assertEqual(progress[-1]["files"], 6)
+
+        kg2 = GenomeKG(KG_REPO)
+        kg2.load(workers=1)
+        self.assertEqual(kg2.gene_ids, kg.gene_ids)
+        self.assertTrue(np.array_equal(kg2.genes.matrix(), kg.genes.matrix()))
+
+    def test_kg_refresh_index(self):
+        kg = GenomeKG(KG_REPO)
+        for i in range(3):
+            write_synthetic_gene_file(kg, "b%d" % i, ["x", "y%d" % i])
+        kg.load(workers=1)
+        kg.compute_tree()
+        kg.save_index()
+
+        # nothing changed
+        kg2 = GenomeKG(KG_REPO)
+        self.assertEqual(kg2.refresh_index(workers=1), {"added": 0, "removed": 0})
+
+        # re-adding known genes only rewrites the non gene sections
+        os.remove(kg._get_gene_file_path(hash_id("b0")))
+        write_synthetic_gene_file(kg, "b3", ["x", "y1"])
+        kg2 = GenomeKG(KG_REPO)
+        self.assertTrue(kg2.load(incremental=True, workers=1))
+        self.assertEqual(
+            sorted(kg2.bins.keys()), sorted(hash_id(x) for x in ["b1", "b2", "b3"])
+        )
+        self.assertEqual(
+            sorted(kg2.gene_ids), sorted(hash_id(x) for x in ["x", "y1", "y2"])
+        )
+
+        kg3 = GenomeKG(KG_REPO)
+        kg3.load(update=False)
+        self.assertEqual(sorted(kg3.bins.keys()), sorted(kg2.bins.keys()))
+        self.assertEqual(kg3.gene_ids, kg2.gene_ids)
+        self.assertTrue("gene_tree" not in kg3._index)
+
+        # new genes
+        write_synthetic_gene_file(kg, "b4", ["new"])
+        kg4 = GenomeKG(KG_REPO)
+        self.assertEqual(kg4.refresh_index(workers=1), {"added": 1, "removed": 0})
+        self.assertTrue(hash_id("new") in kg4.genes)
+        kg5 = GenomeKG(KG_REPO)
+        kg5.load(update=False)
+        self.assertEqual(kg5.gene_ids, kg4.gene_ids)
+        self.assertEqual(len(kg5.bins), 4)
+
+    def test_kg_incremental_load(self):
+        kg = GenomeKG(KG_REPO)
+        for i in range(3):
+            write_synthetic_gene_file(kg, "b%d" % i, ["x", "y%d" % i])
+
+        def load():
+            loaded = []
+            kg = GenomeKG(KG_REPO)
+            kg.load(incremental=True, workers=1, progress=loaded.append)
+            return kg, loaded[-1]["total"] if loaded else 0
+
+        # no index yet: full load, then the index is saved
+        kg, total = load()
+        self.assertEqual(total, 3)
+        self.assertTrue(kg._has_index())
+
+        kg, total = load()
+        self.assertEqual(total, 0)
+        self.assertEqual(len(kg.bins), 3)
+
+        write_synthetic_gene_file(kg, "b3", ["x", "y3"])
+        kg, total = load()
+        self.assertEqual(total, 1)
+        self.assertEqual(len(kg.bins), 4)
+
+    def test_func_name_index(self):
+        b1, b2, g1, g2 = [hash_id(x) for x in ["b1", "b2", "g1", "g2"]]
+        index = FuncNameIndex()
+        index.add(b1, g1, ["main", "ssl_read"])
+        index.add(b1, g2, ["ssl_write", "ssl_read"])
+        index.add(b2, g1, ["main"])
+        index.add(b2, g1, ["main"])
+        self.assertEqual(index.get("main"), [(g1, b1), (g1, b2)])
+        self.assertEqual(index.get("main", b2), [(g1, b2)])
+        self.assertEqual(index.prefix("ssl_"), ["ssl_read", "ssl_write"])
+        self.assertEqual(index.glob("ssl_[rw]*e"), ["ssl_write"])
+        self.assertEqual(index.glob("*a*"), ["main", "ssl_read"])
+        self.assertEqual(index.glob("main"), ["main"])
+        self.assertEqual(
+            index.find("ssl_*", b1),
+            {"ssl_read": [(g1, b1), (g2, b1)], "ssl_write": [(g2, b1)]},
+        )
+
+        index.remove_bin(b1, {g1: ["main", "ssl_read"], g2: ["ssl_read"]})
+        self.assertEqual(index.prefix("ssl_"), ["ssl_write"])
+        self.assertEqual(index.get("main"), [(g1, b2)])
+        self.assertEqual(len(index), 2)
+
+    def test_bin_gene_graph(self):
+        b1, b2, b3 = [hash_id(x) for x in ["b1", "b2", "b3"]]
+        g1, g2, g3, g4 = [hash_id(x) for x in ["g1", "g2", "g3", "g4"]]
+        bins = {
+            b1: {g1: ["main", "start"], g2: ["f"]},
+            b2: {g2: ["f", "f2"], g3: []},
+        }
+        graph = BinGeneGraph.from_bins(bins)
+        self.assertEqual({k: dict(v) for k, v in graph.bins.items()}, bins)
+        self.assertEqual(dict(graph.gene_2_bin), {g1: [b1], g2: [b1, b2], g3: [b2]})
+        self.assertEqual(graph.bins[b2][g2], ["f", "f2"])
+        self.assertFalse(g3 in graph.bins[b1])
+        self.assertEqual(len(graph.bins[b1]), 2)
+
+        # tail: modified, added and removed bins
+        self.assertEqual(graph.add(b1, g3, ["h"]), ["h"])
+        self.assertEqual(graph.add(b1, g1, ["main", "main2"]), ["main2"])
+        graph.add(b3, g4, ["k"])
+        self.assertEqual(graph.remove_bin(b2), [])
+        self.assertEqual(graph.remove_bin(b3), [g4])
+        self.assertEqual(graph.remove_bin(b3), [])
+        expected = {b1: {g1: ["main", "start", "main2"], g2: ["f"], g3: ["h"]}}
+        self.assertEqual({k: dict(v) for k, v in graph.bins.items()}, expected)
+        self.assertEqual(sorted(graph.gene_2_bin), sorted([g1, g2, g3]))
+        self.assertEqual(graph.gene_2_bin[g3], [b1])
+        self.assertFalse(g4 in graph.gene_2_bin)
+        self.assertFalse(b2 in graph.bins)
+
+        columns = graph.columns()
+        self.assertEqual(len(columns["gene_ids"]), 3)
+        self.assertEqual(len(columns["strings"]["func_names"]), 5)
+        graph2 = BinGeneGraph.from_columns(columns)
+        self.assertEqual({k: dict(v) for k, v in graph2.bins.items()}, expected)
+        self.assertEqual(dict(graph2.gene_2_bin), dict(graph.gene_2_bin))
+        graph2.add(b2, g1, [])
+        self.assertEqual(graph2.gene_2_bin[g1], [b1, b2])
+        self.assertEqual(len(graph2.bins), 2)
+
+        # lookups in bins whose slots are not in gene row order
+        bins = {
+            b1: {g4: ["a"], g2: ["b"]},
+            b2: {g3: ["c"], g1: [], g4: ["d", "e"], g2: ["f"]},
+        }
+        graph3 = BinGeneGraph.from_bins(bins)
+        for bin_id, genes in bins.items():
+            view = graph3.bins[bin_id]
+            self.assertEqual(list(view), list(genes))
+            for gene_id in [g1, g2, g3, g4, hash_id("g5")]:
+                self.assertEqual(gene_id in view, gene_id in genes)
+                self.assertEqual(view.get(gene_id), genes.get(gene_id))
+
+        # views outlive the row renumbering of `compact`
+        held = graph2.bins[b2]
+        graph2.remove_bin(b1)
+        graph2.compact()
+        self.assertEqual(dict(held), {g1: []})
+        graph2.remove_bin(b2)
+        self.assertEqual(dict(held), {})
+
+    def test_kg_func_index(self):
+        kg = GenomeKG(KG_REPO)
+        b1 = add_synthetic_bin(kg, "b1", ["x", "y"])
+        b2 = add_synthetic_bin(kg, "b2", ["x", "z"])
+        self.assertEqual(sorted(kg.get_gene_ids("func_x")), [hash_id("x")])
+        self.assertEqual(
+            sorted(kg.get_gene_ids("func_x", include_bin_id=True)),
+            sorted([(hash_id("x"), b1), (hash_id("x"), b2)]),
+        )
+        self.assertEqual(kg.get_gene_ids("func_y", b2), [])
+        self.assertEqual(sorted(kg.find_functions("func_[yz]")), ["func_y", "func_z"])
+        kg.save_index()
+
+        kg2 = GenomeKG(KG_REPO)
+        kg2.load(update=False)
+        self.assertEqual(kg2.find_functions("func_*"), kg.find_functions("func_*"))
+        kg2._remove_bin(b1)
+        self.assertEqual(kg2.get_gene_ids("func_y"), [])
+        self.assertEqual(
+            kg2.get_gene_ids("func_x", include_bin_id=True), [(hash_id("x"), b2)]
+        )
+
+        # index written without the section, with the legacy bins dict
+        bins = {k: dict(v) for k, v in kg.bins.items()}
+        graph = GRAPH_COLUMNS + GRAPH_ID_COLUMNS + ["strings"]
+        remove = ["func_index"] + ["graph." + x for x in graph]
+        write_gkg_index(kg._index_dir, {"bins": bins}, replace=False, remove=remove)
+        kg3 = GenomeKG(KG_REPO)
+        kg3.load(update=False)
+        self.assertEqual(kg3.find_functions("func_*"), kg.find_functions("func_*"))
+
+    def test_kg_get_bc(self):
+        kg = GenomeKG(KG_REPO)
+        binid = add_synthetic_bin(kg, "a", ["x", "y"])
+        funcs = [(hash_id(k), "func_%s" % k, k.encode() * 100, (200, 0)) for k in "xy"]
+        canon = {"type": "canon", "binid": binid, "funcs": funcs, "file_meta": {}}
+        write_canon_file(os.path.join(kg._aux_dir, binid + ".canon"), canon)
+
+        self.assertEqual(kg.get_bc(hash_id("x")), b"x" * 100)
+        self.assertEqual(kg.get_bc(hash_id("y").upper()), b"y" * 100)
+        self.assertIsNone(kg.get_bc(hash_id("z")))
+        self.assertEqual(kg.get_bin(binid).get_bc("func_y"), b"y" * 100)
+        self.assertEqual(len(kg._canon_files), 1)
+
+    def test_kg_files_compare_one_to_many(self):
+        kg = GenomeKG(KG_REPO)
+        keys = ["k%d" % i for i in range(10)]
+        a = add_synthetic_bin(kg, "a", keys)
+        b = add_synthetic_bin(kg, "b", keys[:5] + ["x%d" % i for i in range(5)])
+        c = add_synthetic_bin(kg, "c", keys[::-1])
+        d = add_synthetic_bin(kg, "d", ["y%d" % i for i in range(10)])
+
+        for method in RANKING_CALCULATION_METHODS:
+            ranked = kg.files_compare_one_to_many(a, method=method)
+            self.assertEqual([x[0] for x in ranked], [c, b, d])
+            for node_id, results in ranked:
+                expected, _ = kg.files_compare_by_shared_genes(
+                    a, node_id, gene_version=kg.gene_version, method=method
+                )
+                del expected["diff_details"]
+                results = dict(results)
+                estimate = results.pop("candidate_similarity")
+                # exact and distinct genes only, the estimate is reached
+                self.assertEqual(estimate, expected["similarity"])
+                self.assertEqual(results, expected)
+
+            batched = kg.files_compare_one_to_many(a, method=method, batch_genes=1)
+            self.assertEqual(batched, ranked)
+
+        top = kg.files_compare_one_to_many(a, nodes=[b, d], top_k=1)
+        self.assertEqual([x[0] for x in top], [b])
+        # only the best estimate is rescored
+        compared = []
+        compare = kg._compare_file_genes
+
+        def counted(genes1, genes2, *args, **kwargs):
+            compared.append(genes2)
+            return compare(genes1, genes2, *args, **kwargs)
+
+        kg._compare_file_genes = counted
+        top = kg.files_compare_one_to_many(a, top_k=1, rescore_factor=1)
+        self.assertEqual([x[0] for x in top], [c])
+        self.assertEqual(len(compared), 1)
+
+        # validated before any work
+        with self.assertRaises(ValueError):
+            kg.files_compare_one_to_many(a, method="all")
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
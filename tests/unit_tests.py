@@ -10,10 +10,17 @@ logging.basicConfig(
     datefmt="%m/%d/%Y %H:%M:%S",
 )
 
+from test_ann import *
+from test_cache import *
+from test_dsm import *
+from test_file_format import *
+from test_ingest import *
 from test_ir import *
 from test_kg import *
 from test_lifters import *
+from test_matching import *
 from test_sigmal import *
+from test_store import *
 
 if __name__ == "__main__":
     unittest.main()
@@ -11,6 +11,7 @@ from werkzeug.datastructures import FileStorage
 
 from ..core.genome_service import (API_STATE_EMPTY_RESULT, API_STATE_ERROR,
                                    API_STATE_RESULT_NOT_READY)
+from ..core.scheduler import DEFAULT_JOB_PRIORITY
 from ..defaults import *
 from ..main import kgs
 from .api import api
@@ -20,6 +21,13 @@ ns = api.namespace("api/v1/add", description="Add to KG.")
 
 upload_parser = api.parser()
 upload_parser.add_argument("file", location="files", type=FileStorage, required=True)
+upload_parser.add_argument(
+    "priority",
+    location="form",
+    type=int,
+    default=DEFAULT_JOB_PRIORITY,
+    help="Job priority. Lower values are processed first.",
+)
 
 
 @ns.route("/file")
@@ -44,7 +52,7 @@ class Add(Resource):
             tmpfn = os.path.join(tmpdir, os.path.basename(uploaded_file.filename))
             uploaded_file.save(tmpfn)
 
-            ret = kgs.api_add_file(tmpfn)
+            ret = kgs.api_add_file(tmpfn, priority=args["priority"])
             if ret.get("status") == API_STATE_RESULT_NOT_READY:
                 return ret, 202
             elif ret.get("status") == API_STATE_EMPTY_RESULT:
@@ -1,6 +1,8 @@
+import json
 import logging
 import traceback
 
+from flask import Response, stream_with_context
 from flask_restx import Resource, fields
 
 from ..core.genome_service import (API_STATE_EMPTY_RESULT,
@@ -27,6 +29,7 @@ compare_file_id_args = api.model(
             default=DEFAULT_COMPARE_METHOD,
             description="Internal query method to be used. \
     Currently supported values: [`gene_v0`, `genes_v1_3_0`, `genes_v1_3_0.jaccard_distance`, `genes_v1_3_0.jaccard_distance_w`,\
+         `genes_v1_3_0.jaccard_distance_opt`, `genes_v1_3_0.jaccard_distance_w_opt`,\
          `genes_v1_3_0.composition_ratio`, `genes_v1_3_0.composition_ratio_w`,\
          `genes_v1_3_0.containment_ratio`]",
         ),
@@ -36,13 +39,23 @@ compare_file_id_args = api.model(
             description="Output format. \
     Supported values: ['simple','complete']",
         ),
+        "match_sim_thr": fields.Float(
+            required=False,
+            description="Minimum similarity of matching functions. Default: 0.99",
+        ),
+        "mismatch_sim_thr": fields.Float(
+            required=False,
+            description="Minimum similarity of modified functions. Default: 0.80",
+        ),
     },
 )
 
 
 @ns.route("/files/by_file_ids")
 @ns.response(200, "Final result")
-@ns.response(202, "Request received. Result not ready. Must retry.")
+@ns.response(
+    202, "Request received. Result not ready. Must check using `status/job/<job_id>`."
+)
 @ns.response(204, "Result empty")
 @ns.response(404, "File id not found")
 class KGCompareFileIDs(Resource):
@@ -54,11 +67,17 @@ class KGCompareFileIDs(Resource):
         args = api.payload
         check_event_loop()
         try:
+            thrs = {
+                k: args[k]
+                for k in ["match_sim_thr", "mismatch_sim_thr"]
+                if args.get(k) is not None
+            }
             ret = kgs.api_files_compare_kg(
                 file_id1=args["id1"],
                 file_id2=args["id2"],
                 method=args.get("method", DEFAULT_COMPARE_METHOD),
                 output_detail=args.get("output_detail", DEFAULT_OUTPUT_DETAIL),
+                **thrs,
             )
             if ret.get("status") == API_STATE_RESULT_NOT_READY:
                 return ret, 202
@@ -73,6 +92,77 @@ class KGCompareFileIDs(Resource):
             api.abort(405, f"Exception: {e}")
 
 
+compare_one_to_many_args = api.model(
+    "compare_one_to_many_args",
+    {
+        "id": fields.String(
+            required=True, description="The file identifier (file sha256 hash)"
+        ),
+        "candidate_ids": fields.List(
+            fields.String,
+            required=False,
+            description="File identifiers to compare with. Default: all the files.",
+        ),
+        "method": fields.String(
+            required=False,
+            default=DEFAULT_COMPARE_METHOD,
+            description="Internal query method to be used. \
+    Currently supported values: [`genes_v1_3_0.jaccard_distance`, `genes_v1_3_0.jaccard_distance_w`,\
+         `genes_v1_3_0.jaccard_distance_opt`, `genes_v1_3_0.jaccard_distance_w_opt`]",
+        ),
+        "top_k": fields.Integer(
+            required=False,
+            default=0,
+            description="Number of most similar files returned. Default: 0 (all)",
+        ),
+        "match_sim_thr": fields.Float(
+            required=False,
+            description="Minimum similarity of matching functions. Default: 0.99",
+        ),
+        "mismatch_sim_thr": fields.Float(
+            required=False,
+            description="Minimum similarity of modified functions. Default: 0.80",
+        ),
+    },
+)
+
+
+@ns.route("/files/one_to_many")
+@ns.response(
+    200,
+    "Newline delimited JSON stream: the query record, one record per file \
+    ranked by similarity, then the stats record. The similarities are the ones \
+    of /files/by_file_ids. With top_k, only the candidates with the best \
+    estimated similarity (`candidate_similarity`) are compared.",
+)
+class KGCompareOneToMany(Resource):
+    """Rank binaries by similarity to a binary."""
+
+    @ns.expect(compare_one_to_many_args)
+    def post(self):
+        """Rank binaries by similarity to a binary."""
+        args = api.payload
+        check_event_loop()
+        kwargs = {
+            k: args[k]
+            for k in ["candidate_ids", "top_k", "match_sim_thr", "mismatch_sim_thr"]
+            if args.get(k) is not None
+        }
+        records = kgs.api_files_compare_one_to_many(
+            file_id=args["id"],
+            method=args.get("method", DEFAULT_COMPARE_METHOD),
+            **kwargs,
+        )
+
+        def generate():
+            for record in records:
+                yield json.dumps(record, default=str) + "\n"
+
+        return Response(
+            stream_with_context(generate()), mimetype="application/x-ndjson"
+        )
+
+
 # TODO
 # @ns.route("/packages/by_package_ids")
 # @ns.route("/genes/by_gene_ids")
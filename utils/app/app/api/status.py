@@ -2,7 +2,7 @@ import logging
 
 from flask_restx import Resource, fields
 
-from ..core.genome_service import (API_STATE_EMPTY_RESULT,
+from ..core.genome_service import (API_STATE_EMPTY_RESULT, API_STATE_ERROR,
                                    API_STATE_RESULT_NOT_READY)
 from ..main import kgs
 from .api import api
@@ -46,3 +46,14 @@ class Job(Resource):
             return ret
         except Exception as e:
             api.abort(500, f"Exception: {e}")
+
+    def delete(self, job_id):
+        """Cancel a queued or running job."""
+
+        try:
+            ret = kgs.cancel_job(job_id)
+            if ret.get("status") == API_STATE_ERROR:
+                return ret, 404
+            return ret
+        except Exception as e:
+            api.abort(500, f"Exception: {e}")
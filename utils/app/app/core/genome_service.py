@@ -1,10 +1,14 @@
+import atexit
 import binascii
 import datetime
 import hashlib
 import json
 import logging
 import os
+import pickle
 import shutil
+import sqlite3
+import subprocess
 import sys
 import threading
 import time
@@ -12,12 +16,15 @@ import traceback
 from textwrap import indent
 
 import numpy as np
-from sqlitedict import SqliteDict
 
 import codegenome as cg
 import codegenome._defaults as defaults
+from codegenome.ids import to_id_bytes
+from codegenome.ingest import IngestContext
 
 from ..defaults import *
+from .scheduler import (DEFAULT_JOB_PRIORITY, JOB_CANCELLED, JOB_COMPLETED,
+                        JOB_QUEUED, JOB_RUNNING, JobCancelled, JobScheduler)
 from .schema import KGNodeID
 
 CG_CACHE_DIR = defaults.CG_CACHE_DIR
@@ -37,6 +44,13 @@ DEFAULT_API_CACHE_NODE_AGE_THRESHOLD_SECS = 60 * 60
 DEFAULT_RECORD_API_STATS = 1  # record api stats in cache db
 DEFAULT_API_COMPUTE_TIMEOUT_SECS = 24 * 60 * 60  # 1 day
 DEFAULT_KEEP_AUX_FILES = 0
+DEFAULT_SERVICE_WORKERS = 2  # concurrent jobs, e.g. binaries being genified
+DEFAULT_JOBS_COMMIT_INTERVAL_SECS = 1.0  # write batching, 0: commit each write
+DEFAULT_JOBS_COMMIT_BATCH = 100  # pending job store writes forcing a commit
+DEFAULT_JOBS_RESULT_TTL_SECS = 7 * 24 * 60 * 60  # negative value, never expire
+DEFAULT_JOBS_MAX_COUNT = 10000  # finished jobs kept, negative value: unbounded
+DEFAULT_JOBS_REAP_INTERVAL_SECS = 5 * 60
+DEFAULT_JOBS_VACUUM_INTERVAL_SECS = 24 * 60 * 60
 
 API_STATE_SUCCESS = "Success"
 API_STATE_RESULT_NOT_READY = "ResultNotReady"
@@ -58,20 +72,275 @@ def is_exec(obj):
     return True
 
 
-class JobDBDict(SqliteDict):
-    def __init__(self, *args, **kwargs):
-        self._lock = threading.Lock()
-        super().__init__(*args, **kwargs)
+class JobDBDict(object):
+    _missing = object()
+
+    def __init__(
+        self,
+        filename,
+        commit_interval=DEFAULT_JOBS_COMMIT_INTERVAL_SECS,
+        commit_batch=DEFAULT_JOBS_COMMIT_BATCH,
+    ):
+        """
+        Persistent dict of job records in sqlite (WAL mode).
+
+        Writes are batched: they are committed every `commit_interval` seconds
+        by a background thread, or once `commit_batch` writes are pending.
+        `commit_interval <= 0` commits every write. The status and the file
+        ids of the records are indexed, see `items_by_status` and
+        `keys_by_file_id`. File ids are indexed as digests.
+        """
+        self.filename = filename
+        self.commit_interval = commit_interval
+        self.commit_batch = max(1, commit_batch)
+        self._lock = threading.RLock()
+        self._pending = 0
+        self._conn = sqlite3.connect(
+            filename, check_same_thread=False, isolation_level=None
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs (key TEXT PRIMARY KEY, value BLOB, "
+            "status TEXT, file_id TEXT, end_ts REAL)"
+        )
+        self._migrate()
+        self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_file_id ON jobs (file_id)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_end_ts ON jobs (end_ts)")
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS job_files_file_id ON job_files (file_id)"
+        )
+        self._conn.execute(
+            "CREATE TRIGGER IF NOT EXISTS jobs_delete AFTER DELETE ON jobs "
+            "BEGIN DELETE FROM job_files WHERE key=old.key; END"
+        )
+
+        self._closed = threading.Event()
+        if self.commit_interval > 0:
+            th = threading.Thread(target=self._commit_loop, daemon=True)
+            th.start()
+        atexit.register(self.close)
+
+    def _migrate(self):
+        # all the files of a job, e.g. both files of a compare
+        if not self._conn.execute(
+            "SELECT name FROM sqlite_master WHERE type='table' AND name='job_files'"
+        ).fetchone():
+            self._conn.execute("CREATE TABLE job_files (key TEXT, file_id TEXT)")
+            self._conn.execute(
+                "INSERT INTO job_files SELECT key, file_id FROM jobs "
+                "WHERE file_id IS NOT NULL"
+            )
+
+        cols = [x[1] for x in self._conn.execute("PRAGMA table_info(jobs)")]
+        if "end_ts" not in cols:
+            rows = self._conn.execute("SELECT key, value FROM jobs").fetchall()
+            self._conn.execute("ALTER TABLE jobs ADD COLUMN end_ts REAL")
+            with self._lock:
+                for key, value in rows:
+                    self._write(key, pickle.loads(bytes(value)))
+                self.commit()
+
+        # records of the former SqliteDict based store
+        if self._conn.execute(
+            "SELECT name FROM sqlite_master WHERE type='table' AND name='unnamed'"
+        ).fetchone():
+            rows = self._conn.execute("SELECT key, value FROM unnamed").fetchall()
+            with self._lock:
+                for key, value in rows:
+                    self._write(key, pickle.loads(bytes(value)))
+                self._conn.execute("DROP TABLE unnamed")
+                self.commit()
+
+        # file ids indexed as hex text
+        with self._lock:
+            for table in ["jobs", "job_files"]:
+                rows = self._conn.execute(
+                    f"SELECT rowid, file_id FROM {table} WHERE typeof(file_id)='text'"
+                ).fetchall()
+                rows = [(self._file_id_key(v), k) for k, v in rows]
+                rows = [x for x in rows if isinstance(x[0], bytes)]
+                if rows:
+                    if self._pending == 0:
+                        self._conn.execute("BEGIN")
+                    self._conn.executemany(
+                        f"UPDATE {table} SET file_id=? WHERE rowid=?", rows
+                    )
+                    self._pending += 1
+            self.commit()
+
+    @staticmethod
+    def _file_id_key(file_id):
+        # digest of a file id, other values as is
+        return to_id_bytes(file_id, file_id)
+
+    @staticmethod
+    def _file_id(value):
+        file_id = value.get("file_id")
+        if file_id is None and isinstance(value.get("result"), dict):
+            file_id = value["result"].get("file_id")
+        return file_id
+
+    @staticmethod
+    def _file_ids(value):
+        file_ids = set(value.get("file_ids") or [])
+        file_id = JobDBDict._file_id(value)
+        if file_id is not None:
+            file_ids.add(file_id)
+        return file_ids
+
+    def _write(self, key, value):
+        if self._pending == 0:
+            self._conn.execute("BEGIN")
+        self._conn.execute(
+            "INSERT OR REPLACE INTO jobs VALUES (?,?,?,?,?)",
+            (
+                key,
+                sqlite3.Binary(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)),
+                value.get("status"),
+                self._file_id_key(self._file_id(value)),
+                value.get("end_ts"),
+            ),
+        )
+        self._conn.execute("DELETE FROM job_files WHERE key=?", (key,))
+        self._conn.executemany(
+            "INSERT INTO job_files VALUES (?,?)",
+            [(key, self._file_id_key(x)) for x in self._file_ids(value)],
+        )
+        self._pending += 1
+
+    def _after_write(self):
+        if self.commit_interval <= 0 or self._pending >= self.commit_batch:
+            self.commit()
+
+    def commit(self):
+        with self._lock:
+            if self._pending:
+                self._conn.execute("COMMIT")
+                self._pending = 0
+
+    def _commit_loop(self):
+        while not self._closed.wait(self.commit_interval):
+            try:
+                self.commit()
+            except Exception as err:
+                log.error(f"Exception committing jobs. {err}")
+
+    def close(self):
+        if not self._closed.is_set():
+            self._closed.set()
+            self.commit()
 
     def __setitem__(self, key, value):
         with self._lock:
-            super().__setitem__(key, value)
-            super().commit()
+            self._write(key, value)
+            self._after_write()
 
     def __delitem__(self, key):
         with self._lock:
-            super().__delitem__(key)
-            super().commit()
+            if self._pending == 0:
+                self._conn.execute("BEGIN")
+            cur = self._conn.execute("DELETE FROM jobs WHERE key=?", (key,))
+            self._pending += 1
+            self._after_write()
+        if cur.rowcount == 0:
+            raise KeyError(key)
+
+    def _query(self, sql, args=()):
+        with self._lock:
+            return self._conn.execute(sql, args).fetchall()
+
+    def get(self, key, default=None):
+        rows = self._query("SELECT value FROM jobs WHERE key=?", (key,))
+        if not rows:
+            return default
+        return pickle.loads(bytes(rows[0][0]))
+
+    def __getitem__(self, key):
+        value = self.get(key, self._missing)
+        if value is self._missing:
+            raise KeyError(key)
+        return value
+
+    def pop(self, key, default=_missing):
+        with self._lock:
+            value = self.get(key, self._missing)
+            if value is self._missing:
+                if default is self._missing:
+                    raise KeyError(key)
+                return default
+            del self[key]
+            return value
+
+    def __contains__(self, key):
+        return len(self._query("SELECT 1 FROM jobs WHERE key=?", (key,))) > 0
+
+    def __len__(self):
+        return self._query("SELECT COUNT(*) FROM jobs")[0][0]
+
+    def keys(self):
+        return [x[0] for x in self._query("SELECT key FROM jobs")]
+
+    def items(self):
+        rows = self._query("SELECT key, value FROM jobs")
+        return [(k, pickle.loads(bytes(v))) for k, v in rows]
+
+    def items_by_status(self, *statuses):
+        rows = self._query(
+            "SELECT key, value FROM jobs WHERE status IN (%s)"
+            % ",".join("?" * len(statuses)),
+            statuses,
+        )
+        return [(k, pickle.loads(bytes(v))) for k, v in rows]
+
+    def evict(self, max_age_secs=-1, max_count=-1):
+        """
+        Removes finished jobs that ended more than `max_age_secs` ago, then
+        the oldest finished jobs above `max_count`. Negative values disable
+        the limit. Queued and running jobs are kept. Returns the removed count.
+        """
+        n = 0
+        with self._lock:
+            if self._pending == 0:
+                self._conn.execute("BEGIN")
+            if max_age_secs >= 0:
+                n += self._conn.execute(
+                    "DELETE FROM jobs WHERE end_ts < ?", (time.time() - max_age_secs,)
+                ).rowcount
+            if max_count >= 0:
+                n += self._conn.execute(
+                    "DELETE FROM jobs WHERE key IN (SELECT key FROM jobs "
+                    "WHERE end_ts IS NOT NULL ORDER BY end_ts DESC LIMIT -1 OFFSET ?)",
+                    (max_count,),
+                ).rowcount
+            self._pending += 1
+            self.commit()
+        return n
+
+    def vacuum(self):
+        # returns the space of the removed records to the file system
+        with self._lock:
+            self.commit()
+            self._conn.execute("VACUUM")
+            self._conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    def size(self):
+        # bytes on disk, including the write ahead log
+        out = 0
+        for fn in [self.filename, self.filename + "-wal"]:
+            if os.path.exists(fn):
+                out += os.path.getsize(fn)
+        return out
+
+    def keys_by_file_id(self, file_id):
+        return [
+            x[0]
+            for x in self._query(
+                "SELECT DISTINCT key FROM job_files WHERE file_id=?",
+                (self._file_id_key(file_id),),
+            )
+        ]
 
 
 class GenomeService(object):
@@ -112,34 +381,82 @@ class GenomeService(object):
             ),
         )
 
+        self.service_workers = self.config.get(
+            "service_workers",
+            int(os.environ.get("CG_SERVICE_WORKERS", DEFAULT_SERVICE_WORKERS)),
+        )
+
+        self.jobs_commit_interval = self.config.get(
+            "jobs_commit_interval_secs",
+            float(
+                os.environ.get(
+                    "JOBS_COMMIT_INTERVAL_SECS", DEFAULT_JOBS_COMMIT_INTERVAL_SECS
+                )
+            ),
+        )
+
         self.kg = cg.GenomeKG(db_dir=config.get("gene_dir"))
         self._jobs = JobDBDict(
-            os.path.join(self.config.get("cache_dir"), "jobs.sqlite")
+            os.path.join(self.config.get("cache_dir"), "jobs.sqlite"),
+            commit_interval=self.jobs_commit_interval,
+        )
+        self._scheduler = JobScheduler(
+            self._jobs, resolve=self._job_target, workers=self.service_workers
         )
-        self._threads = {}
+
+        self.jobs_result_ttl = self.config.get(
+            "jobs_result_ttl_secs",
+            int(os.environ.get("JOBS_RESULT_TTL_SECS", DEFAULT_JOBS_RESULT_TTL_SECS)),
+        )
+        self.jobs_max_count = self.config.get(
+            "jobs_max_count",
+            int(os.environ.get("JOBS_MAX_COUNT", DEFAULT_JOBS_MAX_COUNT)),
+        )
+        self.jobs_reap_interval = self.config.get(
+            "jobs_reap_interval_secs",
+            int(
+                os.environ.get(
+                    "JOBS_REAP_INTERVAL_SECS", DEFAULT_JOBS_REAP_INTERVAL_SECS
+                )
+            ),
+        )
+        self.jobs_vacuum_interval = self.config.get(
+            "jobs_vacuum_interval_secs",
+            int(
+                os.environ.get(
+                    "JOBS_VACUUM_INTERVAL_SECS", DEFAULT_JOBS_VACUUM_INTERVAL_SECS
+                )
+            ),
+        )
+        self._jobs_evicted = 0
+        self._jobs_vacuum_ts = time.time()
 
         self._update_status()
+        self._scheduler.start()
+        if self.jobs_reap_interval > 0:
+            th = threading.Thread(target=self._reap_jobs, daemon=True)
+            th.start()
+
+    def _job_target(self, name):
+        # queued jobs are persisted with the name of their target method
+        return getattr(self, name)
 
     def _update_status(self):
-        updates = {}
-        for k, v in self._jobs.items():
-            if (v.get("end_ts") is None) and (k not in self._threads):
-                v["status"] = "error"
-                updates[k] = v
-        for k, v in updates.items():
-            self._jobs[k] = v
+        n = self._scheduler.recover()
+        if n:
+            log.info(f"Re-queued {n} jobs.")
 
     def status(self):
         incomplete = []
-        for k, v in self._jobs.items():
-            if "end_ts" not in v:
-                incomplete.append(
-                    {
-                        "job_id": str(k),
-                        "job": v,
-                        "duration_secs": int(time.time() - v.get("start_ts")),
-                    }
-                )
+        for k, v in self._jobs.items_by_status(JOB_QUEUED, JOB_RUNNING):
+            v.pop("args", None)  # may not be serializable
+            incomplete.append(
+                {
+                    "job_id": str(k),
+                    "job": v,
+                    "duration_secs": int(time.time() - v.get("start_ts")),
+                }
+            )
 
         return {
             "start_time": str(datetime.datetime.fromtimestamp(int(self.start_ts))),
@@ -147,7 +464,16 @@ class GenomeService(object):
             "total_genes": len(self.kg.gene_ids),
             "total_binaries": len(self.kg.bins),
             "gene_version": self.kg.gene_version,
-            "jobs": {"total": len(self._jobs), "incomplete": incomplete},
+            "jobs": {
+                "total": len(self._jobs),
+                "incomplete": incomplete,
+                "evicted": self._jobs_evicted,
+                "db_size_bytes": self._jobs.size(),
+                "last_vacuum": str(
+                    datetime.datetime.fromtimestamp(int(self._jobs_vacuum_ts))
+                ),
+            },
+            "queue": self._scheduler.metrics(),
         }
 
     def make_fileid(self, data):
@@ -155,13 +481,36 @@ class GenomeService(object):
         h.update(data)
         return h.digest().hex()
 
+    def _genify_file(self, ctx):
+        # CPU and memory heavy, run in a cancellable child process
+        cmd = [sys.executable, "-m", "codegenome.kg", self.kg._dbdir]
+        cmd += [ctx.file_path, "--bin-id", ctx.bin_id]
+        cmd += ["--gene-version", self.kg.gene_version]
+        if self.config.get("keep_aux_files"):
+            cmd.append("--keep-aux-files")
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+        log_fn = os.path.join(self.kg._log_dir, ctx.bin_id + ".log")
+        with open(log_fn, "ab") as f:
+            ret = self._scheduler.run_command(
+                cmd, env=env, stdout=f, stderr=subprocess.STDOUT
+            )
+        if ret != 0:
+            log.error(f"Genification of {ctx.file_path} failed. See {log_fn}.")
+        return ret == 0
+
     def _add_file(self, file_id, file_path, cleanup=True):
+        # `file_path` is the IngestContext of api_add_file or a path
+        ctx = IngestContext.of(file_path)
+        file_path = ctx.file_path
         log.debug(f"add_file(file_path={file_path})")
         qkey = ["add_file", file_path, cleanup]
         try:
-            fid = self.kg.add_file(
-                file_path=file_path, keep_aux_files=self.config.get("keep_aux_files")
-            )
+            fid = None
+            if self._genify_file(ctx):
+                # loads the .gene file written by the child process
+                fid = self.kg.add_file(
+                    file_path=ctx, keep_aux_files=self.config.get("keep_aux_files")
+                )
             if fid is None:
                 out = {
                     "status": API_STATE_ERROR,
@@ -180,6 +529,10 @@ class GenomeService(object):
                     "file_id": file_id,
                     "ret_status": "new_file",
                 }
+                # results computed with former genes of the file
+                self._invalidate_file_jobs(
+                    file_id, keep=self._create_job_id(file_id, qkey)
+                )
             self._api_thread_final(file_id, qkey, out)
             if cleanup:
                 tdir = os.path.dirname(file_path)
@@ -188,6 +541,19 @@ class GenomeService(object):
                     shutil.rmtree(tdir)
 
             return out
+        except JobCancelled:
+            log.warning(f"add_file({file_path}) cancelled.")
+            out = {
+                "status": API_STATE_ERROR,
+                "file_id": file_id,
+                "status_msg": "Job cancelled.",
+            }
+            self._api_thread_final(file_id, qkey, out, status=JOB_CANCELLED)
+            if cleanup:
+                tdir = os.path.dirname(file_path)
+                if tdir.startswith(TMP_DIR_PREFIX):
+                    shutil.rmtree(tdir, ignore_errors=True)
+            return out
         except Exception as err:
             log.error(
                 f"Exception at add_file({file_path}). {err}. {repr(traceback.format_exc())}."
@@ -196,11 +562,12 @@ class GenomeService(object):
             self._api_thread_final(file_id, qkey, out)
             return out
 
-    def api_add_file(self, file_path):
+    def api_add_file(self, file_path, priority=DEFAULT_JOB_PRIORITY):
         log.debug(f"api_add_file({file_path})")
 
-        with open(file_path, "rb") as f:
-            file_id = self.make_fileid(f.read())
+        # hashed once, the id is passed on to the KG and the pipeline
+        ctx = IngestContext(file_path)
+        file_id = ctx.bin_id
 
         n = self.kg.get_node(file_id)
 
@@ -211,9 +578,11 @@ class GenomeService(object):
                 "ret_status": "existing_file",
             }
 
-        qkey = ["add_file", file_path, True]
+        qkey = ["add_file", ctx, True]
 
-        ret = self._api_thread_enter(file_id, qkey, target=self._add_file)
+        ret = self._api_thread_enter(
+            file_id, qkey, target=self._add_file, priority=priority
+        )
         ret["file_id"] = file_id
         return ret
 
@@ -264,9 +633,25 @@ class GenomeService(object):
 
         return output
 
-    def _cleanup_jobs(self, job_id):
-        # TODO implement
-        pass
+    def _cleanup_jobs(self):
+        n = self._jobs.evict(self.jobs_result_ttl, self.jobs_max_count)
+        if n:
+            log.info(f"Evicted {n} jobs.")
+        self._jobs_evicted += n
+        if time.time() - self._jobs_vacuum_ts >= self.jobs_vacuum_interval:
+            self._jobs.vacuum()
+            self._jobs_vacuum_ts = time.time()
+        return n
+
+    def _reap_jobs(self):
+        while True:
+            time.sleep(self.jobs_reap_interval)
+            try:
+                self._cleanup_jobs()
+            except Exception as err:
+                log.error(
+                    f"Exception at _cleanup_jobs(). {err}. {repr(traceback.format_exc())}"
+                )
 
     def check_job(self, job_id):
         job = self._jobs.get(job_id)
@@ -280,6 +665,7 @@ class GenomeService(object):
                 "status": API_STATE_RESULT_NOT_READY,
                 "start_ts": job.get("start_ts"),
                 "job_id": job_id,
+                "job_status": job.get("status"),
             }
             file_id = job.get("file_id")
             if file_id:
@@ -289,9 +675,22 @@ class GenomeService(object):
 
         return {"status": API_STATE_ERROR, "status_msg": f"Job {job_id} not found"}
 
+    def cancel_job(self, job_id):
+        if self._scheduler.cancel(job_id):
+            log.warning(f"Cancelling job({job_id}).")
+            return {"status": API_STATE_SUCCESS, "job_id": job_id}
+
+        if job_id in self._jobs:
+            return {
+                "status": API_STATE_ERROR,
+                "status_msg": f"Job {job_id} is not queued or running",
+            }
+        return {"status": API_STATE_ERROR, "status_msg": f"Job {job_id} not found"}
+
     def del_job(self, job_id):
         if job_id in self._jobs:
             log.warning(f"Deleting job({job_id}).")
+            self._scheduler.cancel(job_id)
             self._jobs.pop(job_id)
             return {"status": API_STATE_SUCCESS}
 
@@ -300,12 +699,7 @@ class GenomeService(object):
     def delete_file(self, file_id):
         log.warning(f"Deleting file({file_id}).")
         # try removing jobs
-        dels = []
-        for k, v in self._jobs.items():
-            if file_id == v.get("result", {}).get("file_id"):
-                dels.append(k)
-        for k in dels:
-            self._jobs.pop(k)
+        self._invalidate_file_jobs(file_id)
 
         ret = self.kg.delete_file(file_id=file_id)
         if ret:
@@ -316,13 +710,27 @@ class GenomeService(object):
             "status_msg": f"Error deleting file {file_id}.",
         }
 
+    def _invalidate_file_jobs(self, file_id, keep=None):
+        # drops the jobs, including cached compare results, of `file_id`
+        n = 0
+        for k in self._jobs.keys_by_file_id(file_id):
+            if k != keep:
+                self._scheduler.cancel(k)
+                self._jobs.pop(k, None)
+                n += 1
+        if n:
+            log.info(f"Invalidated {n} jobs of file {file_id}.")
+        return n
+
     def _create_job_id(self, obj_id, qkey):
         if qkey[0] == "add_file":
             # file path will be random
             return crc32([obj_id])
         return crc32([obj_id, qkey])
 
-    def _api_thread_enter(self, obj_id, qkey, target):
+    def _api_thread_enter(
+        self, obj_id, qkey, target, priority=DEFAULT_JOB_PRIORITY, file_ids=None
+    ):
         if not callable(target):
             raise Exception(f"target [{target}] argument must be callable.")
         try:
@@ -333,7 +741,6 @@ class GenomeService(object):
             if job:
                 ret = job.get("result")
                 if ret:
-                    self._cleanup_jobs(job_id)
                     dt = time.time() - job["end_ts"]
 
                     cache_ok = False
@@ -354,69 +761,58 @@ class GenomeService(object):
                         log.info(f"Returning cached result for {(obj_id,qkey)}")
                         return ret
                 else:
-                    dt = time.time() - job.get("start_ts")
-                    # is thread live?
-                    running = False
-                    try:
-                        if job_id in self._threads and self._threads[job_id].is_alive():
-                            running = True
-                    except:
-                        pass
-                    if running:
-                        if dt < self.api_compute_timeout:
-                            # still computing
-                            return {
-                                "status": API_STATE_RESULT_NOT_READY,
-                                "start_ts": job["start_ts"],
-                                "job_id": job_id,
-                            }
-                        else:
-                            # you can not kill the thread
-                            # signal to stop, thread function need to cooperate
-                            job["stop"] = True
-                            job["status"] = "stopping"
-                            if job_id in self._threads:
-                                self._threads.pop(job_id)
-                    else:
-                        # job crashed
-                        job["status"] = "error"
+                    if self._scheduler.is_active(job_id):
+                        dt = time.time() - job.get("run_ts", time.time())
+                        if dt >= self.api_compute_timeout:
+                            # killed within seconds, the next call resubmits it
+                            log.warning(f"Job {job_id} timed out. Cancelling.")
+                            self._scheduler.cancel(job_id)
+                        # still queued or computing
+                        return {
+                            "status": API_STATE_RESULT_NOT_READY,
+                            "start_ts": job["start_ts"],
+                            "job_id": job_id,
+                            "job_status": job.get("status"),
+                        }
 
-            try:
-                args = [obj_id] + qkey[1:]
-                th = threading.Thread(target=target, args=args)
-                th.start()
-                sts = int(time.time())
-                self._threads[job_id] = th
-                self._jobs[job_id] = {"start_ts": sts, "status": "running"}
-                if prev_out:
-                    return prev_out
-                else:
-                    return {
-                        "status": API_STATE_RESULT_NOT_READY,
-                        "start_ts": sts,
-                        "job_id": job_id,
-                    }
-            except Exception as err:
-                log.error(
-                    f"Exception creating job thread. {err} Using blocking call for {target.__name__}{(obj_id, qkey)})"
-                )
-                return target(*args)
+            args = [obj_id] + qkey[1:]
+            job = self._scheduler.submit(
+                job_id,
+                target.__name__,
+                args,
+                priority,
+                file_id=obj_id,
+                file_ids=file_ids,
+            )
+            if prev_out:
+                return prev_out
+            else:
+                return {
+                    "status": API_STATE_RESULT_NOT_READY,
+                    "start_ts": job["start_ts"],
+                    "job_id": job_id,
+                }
 
         except Exception as err:
             log.error(
                 f"Exception at _api_thread_enter({(obj_id, qkey, target.__name__)}). {err}. {repr(traceback.format_exc())}"
             )
 
-    def _api_thread_final(self, obj_id, qkey, out):
+    def _api_thread_final(self, obj_id, qkey, out, status=JOB_COMPLETED):
         try:
             job_id = self._create_job_id(obj_id, qkey)
-            job = self._jobs.get(job_id, {})
+            job = self._jobs.get(job_id)
+            if job is None:
+                # invalidated while running, e.g. its file was deleted
+                log.info(f"Dropping the result of removed job {job_id}")
+                return
+            if status != JOB_CANCELLED and self._scheduler.is_cancelled():
+                log.info(f"Dropping the result of cancelled job {job_id}")
+                return
             job["result"] = out
             job["end_ts"] = time.time()
-            job["status"] = "completed"
+            job["status"] = status
             self._jobs[job_id] = job
-            if job_id in self._threads:
-                self._threads.pop(job_id)
         except Exception as err:
             log.error(
                 f"Exception at _api_thread_final({(obj_id,qkey)}). {err}. {repr(traceback.format_exc())}"
@@ -428,9 +824,14 @@ class GenomeService(object):
         file_id2,
         method=DEFAULT_COMPARE_METHOD,
         output_detail=DEFAULT_OUTPUT_DETAIL,
+        match_sim_thr=defaults.FILE_COMPARE_FUNC_MATCH_SIM_THRESHOLD,
+        mismatch_sim_thr=defaults.FILE_COMPARE_FUNC_MISMATCH_SIM_THRESHOLD,
     ):
         """
         Main api exposed to the external UI rest-api.
+
+        Compares run as jobs. Results are cached by the file ids, method,
+        output detail, thresholds and gene version.
         """
         log.debug(
             f"api_files_compare_kg(file_id1={file_id1}, file_id2={file_id2}, method={method}, output_detail={output_detail}"
@@ -439,20 +840,47 @@ class GenomeService(object):
         file_id2 = KGNodeID.file_id(file_hash=file_id2)
 
         obj_id = file_id1
-        qkey = ["files_compare_kg", file_id2, method, output_detail]
+        qkey = self._compare_qkey(
+            file_id2, method, output_detail, match_sim_thr, mismatch_sim_thr
+        )
 
-        # test direct
-        return self._files_compare_kg(obj_id, file_id2, method, output_detail)
+        return self._api_thread_enter(
+            obj_id,
+            qkey,
+            target=self._files_compare_kg,
+            file_ids=[file_id1, file_id2],
+        )
 
-        return self._api_thread_enter(obj_id, qkey, target=self._files_compare_kg)
+    def _compare_qkey(
+        self, file_id2, method, output_detail, match_sim_thr, mismatch_sim_thr
+    ):
+        # cache key of a compare with `file_id2`, the job arguments after file_id1
+        return [
+            "files_compare_kg",
+            file_id2,
+            method,
+            output_detail,
+            float(match_sim_thr),
+            float(mismatch_sim_thr),
+            self.kg.gene_version,
+        ]
 
     def _files_compare_kg(
-        self, file_id1, file_id2, method="gene_v0", output_detail=DEFAULT_OUTPUT_DETAIL
+        self,
+        file_id1,
+        file_id2,
+        method="gene_v0",
+        output_detail=DEFAULT_OUTPUT_DETAIL,
+        match_sim_thr=defaults.FILE_COMPARE_FUNC_MATCH_SIM_THRESHOLD,
+        mismatch_sim_thr=defaults.FILE_COMPARE_FUNC_MISMATCH_SIM_THRESHOLD,
+        gene_version=None,
     ):
         log.debug(
             f"_files_compare_kg(file_id1={file_id1}, file_id2={file_id2}, method={method}, output_detail={output_detail}"
         )
-        qkey = ["files_compare_kg", file_id2, method, output_detail]
+        qkey = self._compare_qkey(
+            file_id2, method, output_detail, match_sim_thr, mismatch_sim_thr
+        )
         try:
             t1 = time.time()
             fnode1 = self.kg.get_node(file_id1)
@@ -474,6 +902,7 @@ class GenomeService(object):
                 self._api_thread_final(file_id1, qkey, out)
                 log.warn(f"_files_compare_kg returning: {out}")
                 return out
+            self._scheduler.check_cancelled()
 
             if (not is_exec(fnode1)) or (not is_exec(fnode2)):
                 # not a executable file, reset version to gene_v0
@@ -493,9 +922,13 @@ class GenomeService(object):
                 )
                 self._update_output(fnode1, results, fnode2)
             elif version in ["genes_v1_3_0", "genes_v1_3_1"]:
-                # TODO pass match/mimatch thrs
                 results, stats = self.kg.bindiff(
-                    fnode1, fnode2, method=method, output_detail=output_detail
+                    fnode1,
+                    fnode2,
+                    match_sim_thr=match_sim_thr,
+                    mismatch_sim_thr=mismatch_sim_thr,
+                    method=method,
+                    output_detail=output_detail,
                 )
                 self._update_output(fnode1, results, fnode2)
             else:
@@ -519,8 +952,11 @@ class GenomeService(object):
             elif len(results) == 0:
                 out["status"] = API_STATE_EMPTY_RESULT
             out = self._prep_output(out, output_detail)
+            self._scheduler.check_cancelled()
             self._api_thread_final(file_id1, qkey, out)
             return out
+        except JobCancelled:
+            raise
         except Exception as err:
             log.error(
                 f"Exception at _files_compare_kg(). {err}. {repr(traceback.format_exc())}."
@@ -529,6 +965,80 @@ class GenomeService(object):
             self._api_thread_final(file_id1, qkey, out)
             return out
 
+    def api_files_compare_one_to_many(
+        self,
+        file_id,
+        candidate_ids=None,
+        method=DEFAULT_COMPARE_METHOD,
+        top_k=0,
+        match_sim_thr=defaults.FILE_COMPARE_FUNC_MATCH_SIM_THRESHOLD,
+        mismatch_sim_thr=defaults.FILE_COMPARE_FUNC_MISMATCH_SIM_THRESHOLD,
+    ):
+        """
+        Main api exposed to the external UI rest-api.
+
+        Ranks the candidate files (default: all the files) by similarity to
+        `file_id`, see `GenomeKG.files_compare_one_to_many`. Yields the output
+        records: a header with the query node, one record per ranked file and
+        a final record with the stats. The ranking is computed in the request
+        thread before the header, it is not a cached job; use
+        `api_files_compare_kg` for the diff of a pair.
+        """
+        log.debug(
+            f"api_files_compare_one_to_many(file_id={file_id}, candidates={None if candidate_ids is None else len(candidate_ids)}, method={method}, top_k={top_k})"
+        )
+        t1 = time.time()
+        file_id = KGNodeID.file_id(file_hash=file_id)
+        fnode = self.kg.get_node(file_id)
+        if fnode is None:
+            yield {
+                "status": API_STATE_EMPTY_RESULT,
+                "status_msg": f"file_id:{file_id} could not be found.",
+            }
+            return
+
+        flags = method.split(".")
+        version = flags[0]
+        calc_method = flags[1] if len(flags) > 1 else DEFAULT_CALCULATION_METHOD
+        if (
+            version not in ["genes_v1_3_0", "genes_v1_3_1"]
+            or calc_method not in defaults.RANKING_CALCULATION_METHODS
+            or not is_exec(fnode)
+        ):
+            yield {
+                "status": API_STATE_ERROR,
+                "status_msg": f"version: {version}, method: {calc_method} not supported.",
+            }
+            return
+
+        if candidate_ids is not None:
+            candidate_ids = [KGNodeID.file_id(file_hash=x) for x in candidate_ids]
+
+        try:
+            ranked = self.kg.files_compare_one_to_many(
+                file_id,
+                nodes=candidate_ids,
+                match_sim_thr=match_sim_thr,
+                mismatch_sim_thr=mismatch_sim_thr,
+                method=calc_method,
+                top_k=top_k,
+            )
+        except Exception as err:
+            log.error(
+                f"Exception at api_files_compare_one_to_many(). {err}. {repr(traceback.format_exc())}."
+            )
+            yield {"status": API_STATE_ERROR, "status_msg": str(err)}
+            return
+
+        self._update_output(fnode, None)
+        yield {"status": API_STATE_SUCCESS, "query": fnode, "method": method}
+        for rank, (node_id, results) in enumerate(ranked, 1):
+            fnode2 = self.kg.get_node(node_id)
+            self._update_output(fnode2, None)
+            yield {"rank": rank, "file": fnode2, "results": results}
+
+        yield {"count": len(ranked), "stats": {"total_time": time.time() - t1}}
+
     def api_get_gene_info(
         self,
         gene_id=None,
@@ -615,7 +1125,7 @@ class GenomeService(object):
                 data = self.kg.get_node(obj_id)
                 if data:
                     if include_genes:
-                        data["genes"] = self.kg.bins.get(obj_id, {})
+                        data["genes"] = dict(self.kg.bins.get(obj_id, {}))
                     out = {"status": API_STATE_SUCCESS, "data": data}
                 else:
                     out = {
@@ -665,7 +1175,8 @@ def create_genome_service():
     # do it from api to reduce service startup
     log.debug("updating index.")
     t1 = time.time()
-    kgs.kg.load()
+    # only reads the .gene files changed since the last saved index
+    kgs.kg.load(incremental=True)
     t2 = time.time()
     log.debug("updating index completed.")
     return kgs
@@ -0,0 +1,279 @@
+import heapq
+import itertools
+import logging
+import os
+import signal
+import subprocess
+import threading
+import time
+import traceback
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_COMPLETED = "completed"
+JOB_CANCELLED = "cancelled"
+JOB_ERROR = "error"
+
+DEFAULT_JOB_PRIORITY = 10  # lower runs first
+JOB_POLL_SECS = 0.5  # how often a running command checks for cancellation
+JOB_KILL_TIMEOUT_SECS = 5  # SIGTERM to SIGKILL delay of a cancelled command
+
+log = logging.getLogger("codegenome.rest.scheduler")
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class _RunningJob(object):
+    def __init__(self, job_id):
+        self.job_id = job_id
+        self.cancel = threading.Event()
+        self.run_ts = time.time()
+
+
+class JobScheduler(object):
+    def __init__(self, jobs, resolve, workers=2):
+        """
+        Runs jobs on a fixed number of worker threads in `(priority, submit
+        time)` order.
+
+        Job records live in `jobs` (a `JobDBDict`); a queued record keeps
+        the name of its target and its arguments, so the queue survives a
+        restart (see `recover`). `resolve(name)` returns the callable of a
+        target. CPU heavy targets should run their work in a child process
+        through `run_command`, which is what makes a job cancellable.
+        """
+        self._jobs = jobs
+        self._resolve = resolve
+        self.workers = max(1, workers)
+        self._cond = threading.Condition()
+        self._heap = []  # (priority, queue_ts, seq, job_id)
+        self._seq = itertools.count()
+        self._queued = {}  # job_id: heap entry. Cancelled jobs are skipped on pop.
+        self._running = {}  # job_id: _RunningJob
+        self._local = threading.local()
+        self._threads = []
+        self.counts = {JOB_COMPLETED: 0, JOB_CANCELLED: 0, JOB_ERROR: 0}
+        self._wait_secs = 0.0
+        self._run_secs = 0.0
+
+    def start(self):
+        with self._cond:
+            while len(self._threads) < self.workers:
+                th = threading.Thread(
+                    target=self._worker,
+                    name=f"cg-job-worker-{len(self._threads)}",
+                    daemon=True,
+                )
+                th.start()
+                self._threads.append(th)
+
+    def recover(self):
+        """
+        Re-queues the queued jobs of a previous run and marks the jobs that
+        were running as failed. Returns the number of re-queued jobs.
+        """
+        requeue = []
+        updates = {}
+        for k, v in self._jobs.items_by_status(JOB_QUEUED, JOB_RUNNING):
+            if v.get("status") == JOB_QUEUED and v.get("target"):
+                requeue.append((k, v))
+            elif k not in self._running:
+                v["status"] = JOB_ERROR
+                v["end_ts"] = time.time()
+                updates[k] = v
+        for k, v in updates.items():
+            self._jobs[k] = v
+        with self._cond:
+            for k, v in requeue:
+                self._push(k, v.get("priority", DEFAULT_JOB_PRIORITY), v["start_ts"])
+            self._cond.notify_all()
+        return len(requeue)
+
+    def _push(self, job_id, priority, queue_ts):
+        entry = (priority, queue_ts, next(self._seq), job_id)
+        self._queued[job_id] = entry
+        heapq.heappush(self._heap, entry)
+
+    def submit(
+        self,
+        job_id,
+        target,
+        args,
+        priority=DEFAULT_JOB_PRIORITY,
+        file_id=None,
+        file_ids=None,
+    ):
+        """
+        Queues `target(*args)`. `target` is a name known to `resolve`.
+        `file_ids` are all the files the result depends on.
+        """
+        ts = time.time()
+        self._jobs[job_id] = {
+            "start_ts": int(ts),
+            "status": JOB_QUEUED,
+            "target": target,
+            "args": list(args),
+            "priority": priority,
+            "file_id": file_id,
+            "file_ids": file_ids,
+        }
+        with self._cond:
+            self._push(job_id, priority, ts)
+            self._cond.notify()
+        return self._jobs[job_id]
+
+    def is_active(self, job_id):
+        with self._cond:
+            return job_id in self._queued or job_id in self._running
+
+    def cancel(self, job_id):
+        """
+        Cancels a queued or running job. A running job stops at its next
+        `check_cancelled` or within `JOB_POLL_SECS` of `run_command`, which
+        kills the command and everything it started. Returns False if the job
+        is not active.
+        """
+        with self._cond:
+            if job_id in self._running:
+                self._running[job_id].cancel.set()
+                return True
+            if self._queued.pop(job_id, None) is None:
+                return False
+        job = self._jobs.get(job_id, {})
+        job["status"] = JOB_CANCELLED
+        job["end_ts"] = time.time()
+        job.pop("args", None)
+        self._jobs[job_id] = job
+        self.counts[JOB_CANCELLED] += 1
+        return True
+
+    def _current(self):
+        return getattr(self._local, "job", None)
+
+    def is_cancelled(self):
+        # True if the job of the calling worker is cancelled
+        job = self._current()
+        return job is not None and job.cancel.is_set()
+
+    def check_cancelled(self):
+        """
+        Raises `JobCancelled` if the job of the calling worker is cancelled.
+        """
+        if self.is_cancelled():
+            raise JobCancelled(self._current().job_id)
+
+    def run_command(self, cmd, **kwargs):
+        """
+        Runs `cmd` in a new session and waits for it. Returns the exit code.
+        If the calling job is cancelled, the process group is killed and
+        `JobCancelled` is raised.
+        """
+        self.check_cancelled()
+        job = self._current()
+        p = subprocess.Popen(cmd, start_new_session=True, **kwargs)
+        while True:
+            try:
+                return p.wait(timeout=JOB_POLL_SECS)
+            except subprocess.TimeoutExpired:
+                pass
+            if job is not None and job.cancel.is_set():
+                self._kill(p)
+                raise JobCancelled(job.job_id)
+
+    @staticmethod
+    def _kill(p):
+        for sig in [signal.SIGTERM, signal.SIGKILL]:
+            try:
+                os.killpg(p.pid, sig)
+            except ProcessLookupError:
+                pass
+            try:
+                p.wait(timeout=JOB_KILL_TIMEOUT_SECS)
+                return
+            except subprocess.TimeoutExpired:
+                pass
+
+    def _next(self):
+        with self._cond:
+            while True:
+                while self._heap:
+                    entry = heapq.heappop(self._heap)
+                    job_id = entry[3]
+                    if self._queued.get(job_id) is entry:
+                        self._queued.pop(job_id)
+                        job = _RunningJob(job_id)
+                        self._running[job_id] = job
+                        return job
+                self._cond.wait()
+
+    def _worker(self):
+        while True:
+            job = self._next()
+            record = self._jobs.get(job.job_id)
+            if record is None:  # deleted while queued
+                with self._cond:
+                    self._running.pop(job.job_id, None)
+                continue
+            self._wait_secs += job.run_ts - record.get("start_ts", job.run_ts)
+            record["status"] = JOB_RUNNING
+            record["run_ts"] = job.run_ts
+            self._jobs[job.job_id] = record
+
+            self._local.job = job
+            try:
+                self._resolve(record["target"])(*record.get("args", []))
+            except JobCancelled:
+                pass
+            except Exception as err:
+                log.error(
+                    f"Exception at job {job.job_id}. {err}. {repr(traceback.format_exc())}"
+                )
+            finally:
+                self._local.job = None
+                with self._cond:
+                    self._running.pop(job.job_id, None)
+                self._run_secs += time.time() - job.run_ts
+                self._finish(job)
+
+    def _finish(self, job):
+        # targets store their result, only the bookkeeping is left
+        record = self._jobs.get(job.job_id)
+        if record is None or record.get("run_ts") != job.run_ts:
+            # removed, or resubmitted under the same id after a cancel
+            return
+        if record.get("end_ts") is None:
+            record["end_ts"] = time.time()
+            record["status"] = JOB_CANCELLED if job.cancel.is_set() else JOB_ERROR
+        elif job.cancel.is_set():
+            record["status"] = JOB_CANCELLED
+        record.pop("args", None)
+        self._jobs[job.job_id] = record
+        self.counts[record["status"]] = self.counts.get(record["status"], 0) + 1
+
+    def metrics(self):
+        now = time.time()
+        with self._cond:
+            queued = list(self._queued.values())
+            running = list(self._running.values())
+        by_priority = {}
+        for priority, _, _, _ in queued:
+            by_priority[str(priority)] = by_priority.get(str(priority), 0) + 1
+        done = sum(self.counts.values())
+        return {
+            "workers": self.workers,
+            "queue_depth": len(queued),
+            "queued_by_priority": by_priority,
+            "oldest_queued_secs": int(now - min(x[1] for x in queued)) if queued else 0,
+            "running": len(running),
+            "running_jobs": [
+                {"job_id": str(x.job_id), "duration_secs": int(now - x.run_ts)}
+                for x in running
+            ],
+            "completed": self.counts[JOB_COMPLETED],
+            "cancelled": self.counts[JOB_CANCELLED],
+            "errors": self.counts[JOB_ERROR],
+            "avg_wait_secs": self._wait_secs / done if done else 0.0,
+            "avg_run_secs": self._run_secs / done if done else 0.0,
+        }
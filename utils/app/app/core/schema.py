@@ -3,6 +3,8 @@ import uuid
 
 import numpy as np
 
+from codegenome.ingest import sha256_file
+
 DEFAULT_ID_DELIMITER = ":"  # TODO move to a separate common module
 
 
@@ -41,8 +43,7 @@ class KGNodeID:
                 hash = hashlib.sha256(data).hexdigest()
 
             elif file_path is not None:
-                with open(file_path, "rb") as f:
-                    hash = hashlib.sha256(f.read()).hexdigest()
+                hash = sha256_file(file_path)
             else:
                 raise Exception("parameter missing")
 